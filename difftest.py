@@ -0,0 +1,455 @@
+"""
+Differential tests of the engine's lookups against the simple scanning versions they replaced,
+which are kept here as the reference (see reference_engine): thing_by_shortname, look's
+discovery of related things, Room.get_portal and relation_test (one query at a time, and in
+batches: relation_test_many and relation_pairs).
+
+Random worlds are played with random command streams twice, by the reference engine and by
+the optimised one, and the output and world state are compared after every command. The
+lookups are also compared (and timed) head to head on a bigger random world.
+
+Usage, e.g.:
+    python difftest.py --seed 1 --worlds 20 --commands 200
+Exits with status 1 if anything diverged.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import re
+import sys
+import time
+
+from main import session, Game, Thing, Room, Agent, BY, WITH, HAS, OVER, UNDER, ON, IN
+
+
+# ********** REFERENCE ENGINE **********
+# The original implementations: loops through all things (or portals), as simple as can be.
+
+def reference_thing_by_shortname(self, short_name, player=None):
+    # (Game) loop through things for the first with this short name (one around the player, if any)
+    if type(short_name) == str:
+        found = [thing for thing in self.things.values() if short_name in thing.short_names]
+        if len(found) > 1:
+            context = reference_context_things(self, player or session.player)
+            for thing in found:
+                if thing in context:
+                    return thing
+        if found:
+            return found[0]
+    return None
+
+
+def reference_context_things(self, player):
+    # (Game) things around the player (see Game.context_thing_ids), with portals found by looping through them all
+    # (of several portals between two rooms, only the first counts, as in Game.portal_between)
+    if player is None or player.room is None:
+        return set()
+    room = player.room
+    context = {room}
+    for things in room.relations:
+        context.update(things)
+    for thing in list(context):
+        for things in thing.relations:
+            context.update(things)
+    context.update(player.relations[HAS])
+    portals = {}  # key: coords of the room on the other side; value: first portal found (the one used)
+    for portal in self.portals.values():
+        if portal.room1_coords == room.coords:
+            portals.setdefault(portal.room2_coords, portal)
+        elif portal.room2_coords == room.coords:
+            portals.setdefault(portal.room1_coords, portal)
+    context.update(portals.values())
+    return context
+
+
+def reference_related_things(self, relations, player=None):
+    # (Thing) loop through all things to find things in select relations with self
+    player = player or session.player
+    relations_things = {relation: set() for relation in relations}
+    for thing_x in session.game.things.values():
+        for relation in relations:
+            for thing_y in thing_x.relations[relation]:
+                if (thing_y == self) and (thing_x != player):
+                    relations_things[relation].add(thing_x)
+    return relations_things
+
+
+def reference_get_portal(self, target_room):
+    # (Room) loop through portals searching for both this room and target_room
+    found_portal = None
+    for portal in session.game.portals.values():
+        p1 = portal.room1_coords
+        p2 = portal.room2_coords
+        slf = self.coords
+        tgt = target_room.coords
+        if (p1 == slf and p2 == tgt) or (p1 == tgt and p2 == slf):
+            found_portal = portal
+            break
+    return found_portal
+
+
+def reference_relation_test(self, thing_x, relation_arg, thing_y):
+    # (Game) see Game.relation_test
+    IR_un_map = {
+        BY: [BY, WITH, HAS, OVER, UNDER, ON, IN],
+        OVER: [UNDER, WITH, IN, ON],
+        UNDER: [OVER, WITH, IN, ON]
+    }
+    IR_ss_map = {
+        BY: [BY, WITH, OVER, UNDER, ON, IN]
+    }
+
+    # test for valid inputs
+    if thing_x not in self.things.values():
+        msg = "(DEV) '{}' is not a known thing.".format(str(thing_x))
+        raise Exception(msg)
+    if thing_y not in self.things.values():
+        msg = "(DEV) '{}' is not a known thing.".format(str(thing_y))
+        raise Exception(msg)
+    if relation_arg not in set().union({'near'}, session.relations_list, range(len(session.relations_list))):
+        msg = "Sorry, I don't know the relation '{}'.".format(str(relation_arg))
+        raise Exception(msg)
+
+    if relation_arg == 'near':
+        relations = list(session.near_relations)
+    else:
+        relations = [session.relation_ids.get(relation_arg, relation_arg)]
+
+    for relation in relations:
+
+        # A. TEST DIRECT RELATION
+        if thing_y in thing_x.relations[relation]:
+            return True
+
+        # B1. TEST INDIRECT_UN RELATION (UNCLE-NEPHEW): any Z for which X-R-Z and Y-IR_un-Z
+        IR_un = IR_un_map.get(relation, None)
+        if not not IR_un:
+            s1 = thing_x.relations[relation]
+            s2 = set().union(*[things for (R, things) in enumerate(thing_y.relations) if R in IR_un])
+            if s1.intersection(s2):
+                return True
+
+        # B2. TEST INDIRECT_SS RELATION (SIBLING-SIBLING): any Z for which X-IR_ss-Z and Y-IR_ss-Z
+        IR_ss = IR_ss_map.get(relation, None)
+        if not not IR_ss:
+            s1 = set().union(*[things for (R, things) in enumerate(thing_x.relations) if R in IR_ss])
+            s2 = set().union(*[things for (R, things) in enumerate(thing_y.relations) if R in IR_ss])
+            if s1.intersection(s2):
+                return True
+
+    return False
+
+
+def reference_relation_test_many(self, thing_x, relation_arg, things_y):
+    # (Game) see Game.relation_test_many
+    return {thing_y: reference_relation_test(self, thing_x, relation_arg, thing_y) for thing_y in things_y}
+
+
+def reference_relation_pairs(self, relation_arg, things):
+    # (Game) see Game.relation_pairs
+    return {(thing_x, thing_y) for thing_x in things for thing_y in things
+            if thing_x is not thing_y and reference_relation_test(self, thing_x, relation_arg, thing_y)}
+
+
+# key: (class, method name); value: reference implementation
+reference = {
+    (Game, 'thing_by_shortname'): reference_thing_by_shortname,
+    (Thing, 'related_things'): reference_related_things,
+    (Room, 'get_portal'): reference_get_portal,
+    (Game, 'relation_test'): reference_relation_test
+}
+
+
+@contextlib.contextmanager
+def reference_engine():
+    # swaps the reference implementations into the engine for a while
+    optimised = {(cls, name): cls.__dict__[name] for (cls, name) in reference}
+    for (cls, name), function in reference.items():
+        setattr(cls, name, function)
+    try:
+        yield
+    finally:
+        for (cls, name), function in optimised.items():
+            setattr(cls, name, function)
+
+
+# ********** RANDOM WORLDS AND COMMANDS **********
+
+nouns = ['key', 'box', 'lamp', 'coin', 'book', 'bag', 'cup', 'pen', 'torch', 'rope']
+colours = ['red', 'blue', 'old', 'small', 'green']
+furniture_nouns = ['table', 'chair', 'desk', 'shelf', 'bench', 'bed']
+fixture_nouns = ['window', 'painting', 'fireplace', 'mirror']
+room_nouns = ['hall', 'kitchen', 'study', 'cellar', 'attic', 'library', 'pantry']
+portal_nouns = ['door', 'gate', 'hatch']
+directions = ['north', 'east', 'south', 'west']
+
+
+def random_world(rng, size=5, things=40):
+    """ Makes random content: a grid of rooms (some missing), portals, fixtures, furniture and items.
+    Short names are drawn from small word lists, so they're often shared (as lookups must cope with).
+
+    :return: tuple (content dict, key: content name, as Game takes it; start room coords)
+    """
+    def thing_dict(thing_id, noun, **extra):
+        colour = rng.choice(colours)
+        thing = {'thing_id': thing_id, 'name': 'a {} {}'.format(colour, noun),
+                 'short_names': [noun, '{} {}'.format(colour, noun)],
+                 'descriptions': {'looks': ['It is a {} {}.'.format(colour, noun)],
+                                  'sounds': ['You hear the {} {}.'.format(colour, noun)]},
+                 'states_unique': {}, 'qualities_unique': {}}
+        thing.update(extra)
+        return thing
+
+    content = {name: {} for name in ('rooms', 'portals', 'fixtures', 'furniture', 'items', 'relations')}
+    coords = [(y, x) for y in range(1, size + 1) for x in range(1, size + 1) if rng.random() < 0.85]
+    start = coords[0]
+    for room_coords in coords:
+        thing_id = Room.to_thing_id(room_coords)
+        content['rooms'][thing_id] = thing_dict(thing_id, rng.choice(room_nouns))
+    room_ids = sorted(content['rooms'])
+
+    for (y, x) in coords:
+        for neighbour in ((y - 1, x), (y, x + 1)):
+            if neighbour in coords and rng.random() < 0.5:
+                for _ in range(2 if rng.random() < 0.05 else 1):  # (now and then two portals between a pair)
+                    thing_id = 'po_{:04d}'.format(len(content['portals']) + 1)
+                    content['portals'][thing_id] = thing_dict(
+                        thing_id, rng.choice(portal_nouns),
+                        room1_thing_id=Room.to_thing_id(neighbour), room2_thing_id=Room.to_thing_id((y, x)),
+                        states_unique={'openness': rng.choice(['open', 'closed'])})
+
+    for i in range(things):
+        kind = rng.choice(['fixtures', 'furniture', 'items', 'items'])
+        thing_id = '{}_{:04d}'.format({'fixtures': 'fx', 'furniture': 'fr', 'items': 'it'}[kind], i + 1)
+        if kind == 'fixtures':
+            content[kind][thing_id] = thing_dict(thing_id, rng.choice(fixture_nouns))
+            content['relations'][thing_id] = {'of': [rng.choice(room_ids)]}
+        elif kind == 'furniture':
+            content[kind][thing_id] = thing_dict(
+                thing_id, rng.choice(furniture_nouns),
+                qualities_unique={'can_put_things_on_it': rng.random() < 0.7, 'openable': rng.random() < 0.3})
+            content['relations'][thing_id] = {'in': [rng.choice(room_ids)]}
+        else:
+            content[kind][thing_id] = thing_dict(thing_id, rng.choice(nouns),
+                                                 qualities_unique={'weight_kg': rng.choice([0.1, 1.0, 30.0])})
+            holders = [holder for holder in content['furniture'] if holder in content['relations']]
+            if holders and rng.random() < 0.6:
+                content['relations'][thing_id] = {rng.choice(['on', 'in', 'under']): [rng.choice(holders)]}
+            else:
+                content['relations'][thing_id] = {'in': [rng.choice(room_ids)]}
+    return content, start
+
+
+def random_commands(rng, content, count):
+    """ Makes a random command stream for a world (mostly sensible, some not)
+
+    :return: list of command phrases
+    """
+    names = sorted({short_name for name, things in content.items() if name != 'relations'
+                    for thing in things.values() for short_name in thing['short_names']})
+    templates = [
+        (4, lambda: 'look'), (3, lambda: 'look at ' + rng.choice(names)),
+        (2, lambda: 'look {} {}'.format(rng.choice(['in', 'on', 'under']), rng.choice(names))),
+        (6, lambda: 'go ' + rng.choice(directions)), (4, lambda: 'go to ' + rng.choice(names)),
+        (4, lambda: 'get ' + rng.choice(names)), (2, lambda: 'drop ' + rng.choice(names)),
+        (3, lambda: 'put {} {} {}'.format(rng.choice(names), rng.choice(['on', 'in', 'by', 'under']), rng.choice(names))),
+        (2, lambda: 'open ' + rng.choice(names)), (1, lambda: 'close ' + rng.choice(names)),
+        (3, lambda: 'is {} {} {}'.format(rng.choice(names), rng.choice(['near', 'by', 'on', 'in', 'over', 'under']),
+                                         rng.choice(names))),
+        (1, lambda: 'listen'), (1, lambda: 'undo'), (1, lambda: 'redo'),
+        # the player and the agent sharing the world (see play) as things
+        (1, lambda: '{} {}'.format(rng.choice(['look at', 'examine', 'go to', 'open', 'listen to', 'help']),
+                                   rng.choice(['me', 'myself', 'gertrude'])))
+    ]
+    weights = [weight for weight, _ in templates]
+    return [rng.choices(templates, weights)[0][1]() for _ in range(count)]
+
+
+# ********** COMPARING **********
+
+def snapshot(game):
+    # the world state: the player's room, every relation edge and every thing's states
+    names = session.relations_list
+    edges = sorted((thing_x.thing_id, names[R], thing_y.thing_id)
+                   for thing_x in game.things.values() for R, things in enumerate(thing_x.relations) for thing_y in things)
+    states = sorted((thing.thing_id, json.dumps(thing.states, sort_keys=True)) for thing in game.things.values())
+    return session.player.room.thing_id, edges, states
+
+
+def play(content, start, commands, seed):
+    """ Plays a command stream on a new game of a world
+
+    :return: tuple (list of (output, error or None, snapshot) for each command, seconds in commands)
+    """
+    random.seed(seed)  # (the engine's own random choices, e.g. wall messages)
+    output = io.StringIO()
+    game = Game(content_source=content, player_name='Tester', output=output, initial_room=start)
+    Agent('Gertrude', 'ag_0001', game.get_room(start))  # (not simulated: just there, to be looked at)
+    results = []
+    seconds = 0.0
+    for command in commands:
+        error = None
+        started = time.perf_counter()
+        try:
+            game.command(command)
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, re.sub(r' at 0x[0-9a-f]+', '', str(e)))
+        seconds += time.perf_counter() - started
+        results.append((output.getvalue(), error, snapshot(game)))
+        output.seek(0)
+        output.truncate(0)
+    return results, seconds
+
+
+def state_difference(state_r, state_o):
+    # describes how two snapshots differ, as lines of text
+    lines = []
+    if state_r[0] != state_o[0]:
+        lines.append("player's room: reference {}, optimised {}".format(state_r[0], state_o[0]))
+    for what, (part_r, part_o) in (('edges', (state_r[1], state_o[1])), ('states', (state_r[2], state_o[2]))):
+        if set(part_r) - set(part_o):
+            lines.append("{} only in reference: {}".format(what, sorted(set(part_r) - set(part_o))))
+        if set(part_o) - set(part_r):
+            lines.append("{} only in optimised: {}".format(what, sorted(set(part_o) - set(part_r))))
+    return lines
+
+
+def describe(value):
+    # a readable form of lookup arguments and results (things by thing_id)
+    if isinstance(value, Thing):
+        return value.thing_id
+    if isinstance(value, dict):
+        return {session.relations_list[key] if isinstance(key, int) else describe(key): describe(item)
+                for key, item in value.items()}
+    if isinstance(value, (set, frozenset)):
+        return sorted(describe(item) for item in value)
+    if isinstance(value, (list, tuple)):
+        return type(value)(describe(item) for item in value)
+    return value
+
+
+def compare_stream(content, start, commands, seed):
+    """ Plays a command stream with the reference engine and the optimised one
+
+    :return: tuple (first divergence as a dict, or None; reference seconds; optimised seconds)
+        (a command raising an error counts as a divergence, even if both engines raise it)
+    """
+    with reference_engine():
+        expected, reference_seconds = play(content, start, commands, seed)
+    actual, optimised_seconds = play(content, start, commands, seed)
+    for i, (command, (output_r, error_r, state_r), (output_o, error_o, state_o)) in \
+            enumerate(zip(commands, expected, actual)):
+        if (output_r, error_r, state_r) != (output_o, error_o, state_o) or error_o is not None:
+            divergence = {'index': i, 'command': command, 'commands': commands[:i + 1]}
+            if output_r != output_o:
+                divergence['output'] = (output_r, output_o)
+            if error_r != error_o:
+                divergence['error'] = (error_r, error_o)
+            if state_r != state_o:
+                divergence['state'] = state_difference(state_r, state_o)
+            return divergence, reference_seconds, optimised_seconds
+    return None, reference_seconds, optimised_seconds
+
+
+def compare_lookups(rng, content, start, queries=2000):
+    """ Compares (and times) each lookup head to head with its reference, on random queries
+
+    :return: dict, key: lookup name; value: dict with 'queries', 'mismatches' (first few),
+        'reference' and 'optimised' (seconds)
+    """
+    game = Game(content_source=content, player_name='Tester', output=io.StringIO(), initial_room=start)
+    things = list(game.things.values())
+    names = sorted({short_name for thing in things for short_name in thing.short_names}) + ['nothing at all']
+    rooms = list(game.rooms.values())
+    relation_args = ['near'] + session.relations_list
+    relations_choices = [(BY, OVER, WITH), (IN,), (UNDER,), (ON,)]
+    cases = {
+        'thing_by_shortname': (Game.thing_by_shortname, reference_thing_by_shortname,
+                               lambda: (game, rng.choice(names))),
+        'look discovery': (Thing.related_things, reference_related_things,
+                           lambda: (rng.choice(things), rng.choice(relations_choices))),
+        'get_portal': (Room.get_portal, reference_get_portal,
+                       lambda: (rng.choice(rooms), rng.choice(rooms))),
+        'relation_test': (Game.relation_test, reference_relation_test,
+                          lambda: (game, rng.choice(things), rng.choice(relation_args), rng.choice(things))),
+        # (batches: a thing against a room's contents, and every pair in a room's contents)
+        'relation_test_many': (Game.relation_test_many, reference_relation_test_many,
+                               lambda: (game, rng.choice(things), rng.choice(relation_args),
+                                        room_contents(rng.choice(rooms)))),
+        'relation_pairs': (Game.relation_pairs, reference_relation_pairs,
+                           lambda: (game, rng.choice(relation_args), room_contents(rng.choice(rooms))))
+    }
+    batch_queries = max(1, queries // 10)  # (a batch is many queries)
+
+    def room_contents(room):
+        return sorted(game.containment.contents(room), key=lambda thing: thing.thing_id)
+
+    report = {}
+    for name, (optimised, reference_function, make_args) in cases.items():
+        count = batch_queries if name in ('relation_test_many', 'relation_pairs') else queries
+        args_list = [make_args() for _ in range(count)]
+        started = time.perf_counter()
+        expected = [reference_function(*args) for args in args_list]
+        reference_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        actual = [optimised(*args) for args in args_list]
+        optimised_seconds = time.perf_counter() - started
+        mismatches = [(describe(args), describe(e), describe(a))
+                      for args, e, a in zip(args_list, expected, actual) if e != a]
+        report[name] = {'queries': count, 'mismatches': mismatches[:5], 'mismatch_count': len(mismatches),
+                        'reference': reference_seconds, 'optimised': optimised_seconds}
+    return report
+
+
+def speedup(reference_seconds, optimised_seconds):
+    return reference_seconds / optimised_seconds if optimised_seconds else float('inf')
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Compares the optimised engine with the reference engine.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--worlds', type=int, default=20, help="random worlds to play")
+    parser.add_argument('--commands', type=int, default=200, help="commands played in each world")
+    parser.add_argument('--size', type=int, default=5, help="rooms along each side of a world")
+    parser.add_argument('--things', type=int, default=40, help="fixtures, furniture and items in a world")
+    parser.add_argument('--lookup-size', type=int, default=20, help="rooms along each side of the lookup world")
+    parser.add_argument('--lookup-things', type=int, default=2000, help="things in the lookup world")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    diverged = 0
+    reference_total, optimised_total = 0.0, 0.0
+    for world in range(args.worlds):
+        content, start = random_world(rng, args.size, args.things)
+        commands = random_commands(rng, content, args.commands)
+        divergence, reference_seconds, optimised_seconds = compare_stream(content, start, commands, args.seed + world)
+        reference_total += reference_seconds
+        optimised_total += optimised_seconds
+        if divergence is not None:
+            diverged += 1
+            print("World {}: diverged at command {}, '{}'".format(world, divergence['index'], divergence['command']))
+            for key in ('output', 'error'):
+                if key in divergence:
+                    print("  {}:\n    reference: {!r}\n    optimised: {!r}".format(key, *divergence[key]))
+            for line in divergence.get('state', []):
+                print("  " + line)
+    print("Command streams: {} worlds x {} commands, {} diverged; reference {:.3f}s, optimised {:.3f}s ({:.1f}x)".format(
+        args.worlds, args.commands, diverged, reference_total, optimised_total,
+        speedup(reference_total, optimised_total)))
+
+    content, start = random_world(rng, args.lookup_size, args.lookup_things)
+    for name, result in compare_lookups(rng, content, start).items():
+        diverged += result['mismatch_count'] > 0
+        print("{}: {} queries, {} mismatched; reference {:.2f}ms, optimised {:.2f}ms ({:.1f}x)".format(
+            name, result['queries'], result['mismatch_count'], result['reference'] * 1000,
+            result['optimised'] * 1000, speedup(result['reference'], result['optimised'])))
+        for query, expected, actual in result['mismatches']:
+            print("  {}: reference {!r}, optimised {!r}".format(query, expected, actual))
+    return 1 if diverged else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -1,26 +1,144 @@
 """
 A text-based adventure game by Josh Lock.
 A puzzle.
+
+Run this file to play (--new for a new game, --save PATH to choose where play is saved).
+To embed the engine (e.g. in a server, test harness or benchmark), import it and construct
+a Game; importing does no I/O:
+    game = Game(content_source='.', player_name='Alice', output=io.StringIO(), initial_room=(1,7))
+    game.command('go to bed')
 """
 
+import time
+_import_started = time.perf_counter()
+
 import json
+import re
+import os
+import io
+import sys
+import heapq
+import bisect
+import threading
+import contextlib
+import mmap
+import array
+import struct
+import weakref
+import collections.abc
 import textwrap
-import time
 import random
-import copy
+import collections
 
-def get_json_dict(filename):
+content_names = ('rooms', 'portals', 'fixtures', 'furniture', 'items', 'relations')
+optional_content_names = ('triggers',)  # content that needn't be there (loaded after the rest)
+
+
+def get_json_dict(filename, content_dir=''):
     filename += ('' if filename.endswith('.json') else '.json')
-    with open(filename, 'r') as f:
+    with open(os.path.join(content_dir, filename), 'r') as f:
         json_string = f.read()
         json_dict = json.loads(json_string)
     return json_dict
 
 
+def parse_content_file(path):
+    """ Reads and parses a json content file (run by workers, see Game.load_content)
+
+    :return: tuple (content dict, read seconds, parse seconds)
+    """
+    started = time.perf_counter()
+    with open(path, 'r') as f:
+        json_string = f.read()
+    read_seconds = time.perf_counter() - started
+    json_dict = json.loads(json_string)
+    return json_dict, read_seconds, time.perf_counter() - started - read_seconds
+
+
+number_tail = re.compile(r'[0-9.eE+-]*')  # what may follow a number cut short, e.g. '1' of '1.5e3'
+
+
+def iter_content_file(path, timing=None, chunk_size=1 << 20):
+    """ Reads and parses a json content file one entry at a time, e.g. ('rm_0107', {...room dict...}),
+    so that only a chunk of text and the entry being parsed are held, not the whole file's text and dict
+
+    :param path: content file, a json object, e.g. 'rooms.json'
+    :param timing: dict to add 'read' and 'parse' seconds to, if given
+    :param chunk_size: characters to read at a time (more are read for an entry that doesn't fit)
+    :return: generator of (key, value)
+    """
+    read_seconds = parse_seconds = 0.0
+    # keys seen, so that entries share key strings (e.g. 'short_names') as they would from one json.loads
+    keys = {}
+    json_decoder = json.JSONDecoder(object_pairs_hook=lambda pairs: {keys.setdefault(k, k): v for k, v in pairs})
+    with open(path, 'r') as f:
+        buffer, pos = '', 0
+        expected = '{'  # next: '{', 'key', ':', 'value', or ',' (or '}')
+        key = None
+        need_more = False
+        while True:
+            # skip whitespace, reading more text when the buffer runs out (or an entry is cut off)
+            while pos < len(buffer) and buffer[pos] in ' \t\n\r':
+                pos += 1
+            if pos == len(buffer) or need_more:
+                started = time.perf_counter()
+                chunk = f.read(max(chunk_size, len(buffer) - pos))  # (doubles for an entry that doesn't fit)
+                read_seconds += time.perf_counter() - started
+                if not chunk:
+                    raise ValueError("{}: the file ends before the content does.".format(path))
+                buffer, pos = buffer[pos:] + chunk, 0
+                need_more = False
+                continue
+
+            char = buffer[pos]
+            if expected in ('{', ':') or (expected == ',' and char == ','):
+                if char != expected:
+                    raise ValueError("{}: expected '{}' but found '{}'.".format(path, expected, char))
+                pos += 1
+                expected = 'value' if expected == ':' else 'key'
+            elif char == '}' and expected in ('key', ','):
+                break
+            elif expected in ('key', 'value'):
+                started = time.perf_counter()
+                try:
+                    value, end = json_decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    value, end = None, len(buffer)  # (probably cut off: read more, then try again)
+                parse_seconds += time.perf_counter() - started
+                if end == len(buffer) or (isinstance(value, (int, float))
+                                          and number_tail.match(buffer, end).end() == len(buffer)):
+                    need_more = True  # (a value running to the end of the buffer may be cut off too)
+                    continue
+                pos = end
+                if expected == 'key':
+                    key, expected = value, ':'
+                else:
+                    yield key, value
+                    key, value = None, None
+                    expected = ','
+            else:
+                raise ValueError("{}: expected ',' or '}}' but found '{}'.".format(path, char))
+    if timing is not None:
+        timing['read'] = timing.get('read', 0.0) + read_seconds
+        timing['parse'] = timing.get('parse', 0.0) + parse_seconds
+
+
+# relation ids (see Session.relations_list for their names)
+OF, BY, WITH, HAS, OVER, UNDER, ON, IN = range(8)
+
+# capability bits: what can be done with a thing, compiled from its class, qualities and verbables
+# (see Thing.compile_capabilities), so verbs can check with one lookup, e.g. thing.capabilities & CAN_OPEN
+CAN_GET_KIND, CAN_MOVE, CAN_LIFT, CAN_OPEN = 1, 2, 4, 8  # (the kind of thing that can be got: furniture, items)
+CAN_GET = CAN_GET_KIND | CAN_MOVE | CAN_LIFT  # (all of them)
+CAN_PUT = tuple(1 << (8 + relation) for relation in range(8))  # by relation id: things can be put in R with it
+CAN_GO = tuple(1 << (16 + relation) for relation in range(8))  # by relation id: players can go in R with it
+
+
 class Session:  # acts as a gateway for global variables
 
     game = None
     player = None
+    output = None  # file-like sink for printw (None: stdout)
     directions_map = {
         'north': 'north', 'n': 'north',
         'east': 'east', 'e': 'east',
@@ -63,44 +181,44 @@ class Session:  # acts as a gateway for global variables
     Relations describe geometric relations between things and things or between things and player.
     E.g. player-in-room, room-has-player; torch-in-bag, bag-has-torch; player-by-door, door-by-player...
     Relations are stored with subject of the relation (e.g. with the chair for chair-in-room)
+    Relations are interned as small ids (OF, BY, ... IN): a thing's relations are a list of sets
+    indexed by relation id, e.g. chair.relations[IN] = {room}
     '''
-    inverse_relations = {
-        'of': 'has',  # window of room, room has window
-        'by': 'by',  # chair by window, window by chair
-        'with': 'has',  # key with player, player has key
-        'over': 'under',  # jar over candle, candle under jar
-        'under': 'over',  # bag under sink, sink over bag
-        'on': 'has',  # lamp on desk, desk has lamp
-        'in': 'has'  # chair in room, room has chair
-    }
-    relations_template = {
-        'of': set(),
-        'by': set(),
-        'with': set(), 'has': set(),
-        'over': set(), 'under': set(),
-        'on': set(),
-        'in': set()
-    }
-    relations_list = ['of', 'by', 'with', 'has', 'over', 'under', 'on', 'in']
-    near_relations = ['by', 'with', 'has', 'over', 'under', 'on', 'in']
+    relations_list = ['of', 'by', 'with', 'has', 'over', 'under', 'on', 'in']  # relation names by id
+    relation_ids = {name: relation for relation, name in enumerate(relations_list)}  # e.g. 'by': BY
+    inverse_relations = (  # inverse relation ids by relation id
+        HAS,  # window of room, room has window
+        BY,  # chair by window, window by chair
+        HAS,  # key with player, player has key
+        None,  # 'has' is the inverse of several relations, so it has none of its own
+        UNDER,  # jar over candle, candle under jar
+        OVER,  # bag under sink, sink over bag
+        HAS,  # lamp on desk, desk has lamp
+        HAS  # chair in room, room has chair
+    )
+    near_relations = (BY, WITH, HAS, OVER, UNDER, ON, IN)
+    # relations to test by relation_test argument, e.g. 'by': (BY,), 'near': near_relations
+    relation_args = dict([(name, (relation,)) for name, relation in relation_ids.items()] +
+                         [(relation, (relation,)) for relation in relation_ids.values()] +
+                         [('near', near_relations)])
     verbs_prepositions_relations = {
         # For command in the form [verb x preposition y], e.g. 'put chair by window'
         # This map gives resulting relation for verb-preposition combination,
-        # E.g. 'chair-by-window' stores as: (chair).relations['by']={(window)...}
+        # E.g. 'chair-by-window' stores as: (chair).relations[BY]={(window)...}
         'go': {
-            'to': 'by', 'by': 'by', 'beside': 'by', 'near': 'by',
-            'over': 'over',
-            'under': 'under', 'underneath': 'under',
-            'on': 'on', 'onto': 'on',
-            'in': 'in', 'into': 'in'
+            'to': BY, 'by': BY, 'beside': BY, 'near': BY,
+            'over': OVER,
+            'under': UNDER, 'underneath': UNDER,
+            'on': ON, 'onto': ON,
+            'in': IN, 'into': IN
         },
         'put': {
-            'by': 'by', 'beside': 'by', 'near': 'by',  # TODO simplify this by earlier preposition condensing?
-            'with': 'with',
-            'over': 'over',
-            'under': 'under', 'underneath': 'under',
-            'on': 'on', 'onto': 'on',
-            'in': 'in', 'into': 'in'
+            'by': BY, 'beside': BY, 'near': BY,  # TODO simplify this by earlier preposition condensing?
+            'with': WITH,
+            'over': OVER,
+            'under': UNDER, 'underneath': UNDER,
+            'on': ON, 'onto': ON,
+            'in': IN, 'into': IN
         }
     }  # TODO: more content?
     '''
@@ -116,11 +234,33 @@ class Session:  # acts as a gateway for global variables
     #     }
     # }
 
+    @staticmethod
+    @contextlib.contextmanager
+    def redirect(output):
+        # sends printw output to another sink for a while, e.g.: with session.redirect(agent.output): ...
+        previous = session.output
+        session.output = output
+        try:
+            yield
+        finally:
+            session.output = previous
+
+    @staticmethod
+    def new_relations():
+        # empty relations for a thing: one set of related things per relation id
+        return [set(), set(), set(), set(), set(), set(), set(), set()]
+
     @staticmethod
     def printw(msg):
-        print('')
-        for line in textwrap.wrap(msg):
-            print(line)
+        output = session.output
+        if isinstance(output, NullOutput):  # nobody will read it (e.g. agents, solver): don't wrap it
+            return
+        (output or sys.stdout).write(session.wrapped(msg))
+
+    @staticmethod
+    def wrapped(msg):
+        # a message as printw writes it: a blank line, then the message wrapped to lines
+        return '\n' + ''.join(line + '\n' for line in textwrap.wrap(msg))
 
     @staticmethod
     def english_list(strings_list):
@@ -138,9 +278,24 @@ class Session:  # acts as a gateway for global variables
 session = Session()
 
 
+class NullOutput:
+    # output sink that discards everything (e.g. for what agents see)
+
+    @staticmethod
+    def write(text):
+        pass
+
+    @staticmethod
+    def flush():
+        pass
+
+
 class Thing:
     # Parent class for all things: rooms, portals, fixtures, furniture, & items
 
+    kind_capabilities = 0  # capability bits of all things of the class
+    go_relations = None  # relation ids players can go in with things of the class (None: any)
+
     def __init__(self, thing_id, name, short_names, descriptions,
                  qualities=None,
                  states=None,
@@ -158,67 +313,136 @@ class Thing:
         self.qualities = qualities
         self.states = states
         self.verbables = verbables
+        self.capabilities = self.compile_capabilities()
 
         '''
         Set up relations
         Need to instantiate empty sets) to be populated later by game.setup.
-        E.g.: {'in': (thing1, thing2, ...), ...})
+        E.g.: [..., {thing1, thing2, ...} (things it is in, at index IN)]
         '''
-        self.relations = copy.deepcopy(session.relations_template)
-
-        # add this object to things list
-        session.game.things[thing_id] = self
+        self.relations = session.new_relations()
+
+        # add this object to things list (and its short names to the names index)
+        session.game.add_thing(self)
+
+    def __getattr__(self, name):
+        # only called for missing attributes: things loaded from a WorldStore get their relations
+        # from the store on first use
+        if name == 'relations':
+            store = self.__dict__.get('store', None)
+            if store is not None:
+                return store.load_relations(self)
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+
+    def __del__(self):
+        # things loaded from a WorldStore write back any changes when they're freed
+        store = self.__dict__.get('store', None)
+        if store is not None:
+            store.release(self)
 
     def __str__(self):
         return "{} (AKA \"{}\")".format(self.name, '\" or \"'.join(self.short_names))
 
-    def look(self, preposition=None):
+    def compile_capabilities(self):
+        """ Works out what can be done with this thing, as capability bits (e.g. CAN_GET), from its
+        class, its qualities, and its verbables: prepositions it takes as Y, e.g.
+        {'put': {'as_y': ['on', 'in']}} (without: any, if it 'can_put_things_on_it'), or
+        {'go': {'as_y': ['to', 'on']}} (without: any of its class's go_relations)
+
+        :return: int
+        """
+        qualities = self.qualities or {}
+        verbables = self.verbables or {}
+        capabilities = self.kind_capabilities
+        if qualities.get('movable', False):
+            capabilities |= CAN_MOVE
+        if qualities.get('liftable', False):
+            capabilities |= CAN_LIFT
+        if qualities.get('openable', False):
+            capabilities |= CAN_OPEN
+        for verb, can, relations in (
+                ('put', CAN_PUT, None if qualities.get('can_put_things_on_it', False) else ()),
+                ('go', CAN_GO, self.go_relations)):
+            prepositions_relations = session.verbs_prepositions_relations[verb]
+            prepositions = verbables.get(verb, {}).get('as_y', None)
+            if prepositions is not None:
+                for preposition in prepositions:
+                    if preposition not in prepositions_relations:
+                        msg = "(DEV) '{}' verbables: I don't know '{} {}'.".format(self.thing_id, verb, preposition)
+                        raise Exception(msg)
+                relations = [prepositions_relations[preposition] for preposition in prepositions]
+            elif relations is None:
+                relations = prepositions_relations.values()
+            for relation in relations:
+                capabilities |= can[relation]
+        return capabilities
+
+    def actions(self):
+        """ Lists what can be done with this thing (from its capabilities, see compile_capabilities)
+
+        :return: list of command phrases, e.g. ['get bag', 'open bag', 'put things on or in the bag', 'go to the bag']
+        """
+        name = self.short_names[0]
+        capabilities = self.capabilities
+        actions = []
+        if capabilities & CAN_GET == CAN_GET:
+            actions.append('get ' + name)
+        if capabilities & CAN_OPEN:
+            actions += ['open ' + name, 'close ' + name]
+        for verb, can, what in (('put', CAN_PUT, 'put things'), ('go', CAN_GO, 'go')):
+            relations_prepositions = {}  # first preposition for each relation, e.g. BY: 'to' for go
+            for preposition, relation in session.verbs_prepositions_relations[verb].items():
+                relations_prepositions.setdefault(relation, preposition)
+            prepositions = [preposition for relation, preposition in relations_prepositions.items()
+                            if capabilities & can[relation]]
+            if prepositions:
+                if len(prepositions) > 1:  # e.g. 'put things on or in the bed'
+                    prepositions[-2:] = [prepositions[-2] + ' or ' + prepositions[-1]]
+                actions.append('{} {} the {}'.format(what, ', '.join(prepositions), name))
+        return actions
+
+    def look(self, preposition=None, player=None):  # player: who is looking (default: the main player)
+        player = player or session.player
 
         is_room = isinstance(self, Room)
         is_portal = isinstance(self, Portal)
         give_state = True if is_portal else False
         give_self_description = True if (not preposition or preposition == 'at') else False
 
+        # how much light is there to see by (in the player's room)?
+        brightness = 1.0
+        if player is not None and player.room is not None:
+            brightness = session.game.lighting.level(player.room)
+        if brightness < Lighting.dark:
+            if is_room:
+                session.printw("It's too dark to see much here.")
+            else:
+                session.printw("It's too dark to make out the {}.".format(self.short_names[0]))
+            return
+        dim = brightness < Lighting.dim
+
         # defaults (changed in some cases below)
-        relations_things = {
-            'by': set(),
-            'over': set(),
-            'with': set()
-        }
+        relations = (BY, OVER, WITH)
 
         if is_room or preposition == 'in':
-            relations_things = {
-                'in': set()
-            }
+            relations = (IN,)
         elif preposition == 'under':
-            relations_things = {
-                'under': set()
-            }
+            relations = (UNDER,)
         elif preposition == 'on':
-            relations_things = {
-                'on': set()
-            }
+            relations = (ON,)
 
         # DISCOVER
-        # discover things in player-visible relations with self:
-        # loop through all things to find things in select relations with self
-        #   (expensive, but simple and acceptable for a game with just a few things)
-        # for through all things...
-        no_relations_found = True
-        for thing_x in session.game.things.values():
-            # for each relation type of interest...
-            for relation in relations_things.keys():
-                # for each thing_y in this relation type with thing_x...
-                for thing_y in thing_x.relations.get(relation, []):
-                    if (thing_y == self) and (thing_x != session.player):
-                        relations_things[relation].add(thing_x)  # thing_x is in this relation with self
-                        no_relations_found = False
+        relations_things = self.related_things(relations, player)
+        no_relations_found = not any(relations_things.values())
 
         # REPORT
         msg = ''
         if give_self_description:
             # TODO: change state / time index (use thing.states['seen']
-            msg = self.description('looks', 0)
+            if isinstance(self, Player) and self is not player:  # (a player's description is for itself)
+                msg = "You see {}.".format(self.name)
+            else:
+                msg = self.description('looks', 0)
         if give_state:  # TODO: need this now only reporting states in list
             states_list = [self.states.get(k, None) for k in ['openness', 'freshness']]  #TODO: 'very stale' for sandwich
             states_list = [i for i in states_list if i is not None]
@@ -233,10 +457,17 @@ class Thing:
         else:
             for relation, things_set in relations_things.items():
                 if not not things_set:  # i.e. if things_set not empty
-                    thing_names = list(map(lambda x: x.name, things_set))
+                    things_list = sorted(things_set, key=lambda x: x.thing_id)  # (same order every time)
+                    if dim:  # only outlines: short names, no details
+                        thing_names = list(map(lambda x: 'a ' + x.short_names[0], things_list))
+                        msg = "In the gloom, {} the {} you can just make out {}."
+                    else:
+                        thing_names = list(map(lambda x: x.name, things_list))
+                        msg = "{} the {} you see {}."
                     names_csl = session.english_list(thing_names)
-                    msg = "{} the {} you see {}.".format(
-                        relation.title(),
+                    relation_name = session.relations_list[relation]
+                    msg = msg.format(
+                        relation_name if dim else relation_name.title(),
                         self.short_names[0],
                         names_csl
                     )
@@ -244,66 +475,110 @@ class Thing:
 
         # TODO: list fixtures and portals for rooms
 
-    def open(self):  # takes no modifiers
+    def related_things(self, relations, player=None):
+        """ Discovers things in player-visible relations with this thing, e.g. the things on it
+
+        :param relations: tuple of relation ids, e.g. (BY, OVER, WITH)
+        :param player: the player looking (default: the main player), who is left out
+        :return: dict, key: relation id; value: set of things X (not the player) for which X-R-self
+        """
+        player = player or session.player
+        # relations are stored with their inverses (e.g. key-on-desk and desk-has-key), so the only
+        # candidates for X-R-self are the things self is in the inverse relation with
+        # (rather than looping through all things)
+        relations_things = {}
+        for relation in relations:
+            relations_things[relation] = set()
+            # for each candidate thing_x...
+            for thing_x in self.relations[session.inverse_relations[relation]]:
+                if (self in thing_x.relations[relation]) and (thing_x != player):
+                    relations_things[relation].add(thing_x)  # thing_x is in this relation with self
+        return relations_things
+
+    def open(self, actor=None):  # takes no modifiers; actor: player or agent opening it (default: player)
+        actor = actor or session.player
 
         # 1. check that player is near the thing
-        if not session.game.relation_test(session.player, 'near', self):
+        if not session.game.relation_test(actor, 'near', self):
             session.printw("Sorry, you are not near the {}.".format(self.short_names[0]))
             return
 
         # 2. check that the thing is not already open
-        if self.states['openness'] == 'open':
+        if self.states.get('openness', None) == 'open':
             session.printw("The {} is already open.".format(self.short_names[0]))
             return
 
         # 3. check that the thing is openable
-        if not self.openable:
+        if not self.capabilities & CAN_OPEN:
             session.printw("Sorry, the {} is not the kind of thing you can open.".format(self.short_names[0]))
             return
 
         # 4. check that the thing is unlocked
-        if self.states['openness'] == 'locked':
+        if self.states.get('openness', None) == 'locked':
             session.printw("Sorry, the {} is locked.".format(self.short_names[0]))
             return
 
         # 5. change state of the thing
-            self.states['openness'] = 'open'
+        session.game.set_state(self, 'openness', 'open')
         session.printw("The {} is now open.".format(self.short_names[0]))
+        return True
 
-    def close(self):  # takes no modifiers
+    def close(self, actor=None):  # takes no modifiers; actor: player or agent closing it (default: player)
+        actor = actor or session.player
 
         # 1. check that player is near the thing
-        if not session.game.relation_test(session.player, 'near', self):
+        if not session.game.relation_test(actor, 'near', self):
             session.printw("Sorry, you are not near the {}.".format(self.short_names[0]))
             return
 
         # 2. check that the thing is not already closed
-        if self.states['openness'] == 'closed':
+        if self.states.get('openness', None) == 'closed':
             session.printw("The {} is already closed.".format(self.short_names[0]))
             return
 
         # 3. check that the thing is openable
-        if not self.openable:
+        if not self.capabilities & CAN_OPEN:
             session.printw("Sorry, the {} is not the kind of thing you can close.".format(self.short_names[0]))
             return
 
         # 4. change state of the thing
-        self.states['openness'] = 'closed'
+        session.game.set_state(self, 'openness', 'closed')
         session.printw("The {} is now closed.".format(self.short_names[0]))
+        return True
 
     def description(self, aspect, time_index):
         """ Returns room description for an aspect and a time index
 
-        :param aspect. E.g., 'looks', 'sounds', or 'feels'
+        :param aspect. E.g., 'looks', 'sounds', 'sounds_far' (heard from other rooms), or 'feels'
         :param time_index. E.g., 0 for first time
         :return: string
         """
-        if aspect in ('looks', 'sounds', 'feels'):
+        if aspect in ('looks', 'sounds', 'sounds_far', 'feels'):
             return self.descriptions[aspect][time_index]
 
 
 class Room(Thing):
 
+    go_relations = (BY,)  # (going to a room goes into it)
+
+    default_states = {  # default states for all rooms
+        "seen_count": 0,
+        "temperature_C": 22.0,
+        "brightness": 0.7,
+    }
+
+    default_qualities = {  # default qualities for all rooms
+        "movable": False,
+        "liftable": False,
+        "is_vessel": True,
+        "openable": False,
+        "lockable": False,
+        "loudness": 0.0,  # how far its sounds carry to other rooms (see Acoustics)
+    }
+
+    default_verbables = {
+    }
+
     def __init__(
             self, thing_id, name, short_names, descriptions,
             qualities_unique=None,
@@ -317,26 +592,15 @@ class Room(Thing):
         :param verbables: dict with keys: 'as_x', 'as_y'
         """
 
-        states = {  # default states for all rooms
-            "seen_count": 0,
-            "temperature_C": 22.0,
-            "brightness": 0.7,
-        }
+        states = dict(self.default_states)
         if states_unique:
             states.update(states_unique)
 
-        qualities = {  # default qualities for all rooms
-            "movable": False,
-            "liftable": False,
-            "is_vessel": True,
-            "openable": False,
-            "lockable": False,
-        }
+        qualities = dict(self.default_qualities)
         if qualities_unique:
             qualities.update(qualities_unique)
 
-        verbables = {
-        }
+        verbables = dict(self.default_verbables)
         if verbables_unique:
             verbables.update((verbables_unique))
 
@@ -354,17 +618,8 @@ class Room(Thing):
             raise Exception(msg)
 
     def get_portal(self, target_room):
-        # loop through portals searching for both this room and target_room
-        found_portal = None
-        for portal in session.game.portals.values():
-            p1 = portal.room1_coords
-            p2 = portal.room2_coords
-            slf = self.coords
-            tgt = target_room.coords
-            if (p1==slf and p2==tgt) or (p1==tgt and p2==slf):
-                found_portal = portal
-                break
-        return found_portal
+        # look up the portal between this room and target_room (None if there's none)
+        return session.game.portal_between(self.coords, target_room.coords)
 
     @staticmethod
     def to_thing_id(coords):
@@ -386,21 +641,24 @@ class Room(Thing):
 
 class Player(Thing):
 
-    def __init__(self):
+    self_names = ['player', 'me', 'self', 'myself']  # short names besides the player's name
 
-        thing_id = 'player'
+    def __init__(self, name=None, thing_id='player'):
 
-        # ask for name
-        name = ""
-        while not name.isalpha():
-            name = input("Please enter your name:").strip()
+        # ask for name (unless given, e.g. when the engine is embedded)
+        if name is None:
+            name = ""
+            while not name.isalpha():
+                name = input("Please enter your name:").strip()
+        elif not name.isalpha():
+            raise ValueError("Player name must be letters only, but '{}' was given.".format(name))
         name = name.title()
         session.printw("Welcome, {}.".format(name))
 
-        short_names = ['player', 'me', 'self', 'myself', name.lower()]
-        descriptions = ["You are somewhat ordinary in appearance, but attractive in your own curious way."
-                        " You're a typical height and build for your age. Your hair is getting a little long."
-                        " You are wearing blue overalls and old brown boots. You have paint on your chin."]
+        short_names = self.self_names + [name.lower()]
+        descriptions = {'looks': ["You are somewhat ordinary in appearance, but attractive in your own curious way."
+                                  " You're a typical height and build for your age. Your hair is getting a little long."
+                                  " You are wearing blue overalls and old brown boots. You have paint on your chin."]}
 
         states = {  # starting states for player
             "hunger": 0.3,
@@ -448,11 +706,11 @@ class Player(Thing):
     def look(self, modifiers):
         if len(modifiers) == 0:
             # treat 'look' as 'look at room'
-            self.room.look('at')
+            self.room.look('at', self)
         elif (modifiers == ['around']) or ('room' in modifiers):
             # treat 'look around' as 'look at room'
             # treat 'look [...] room [...]' as 'look at room'
-            self.room.look('at')
+            self.room.look('at', self)
         else:
             # 1. determine preposition from first modifier word and reduce
             #   (if not known preposition, assume none)
@@ -463,13 +721,15 @@ class Player(Thing):
 
             # 2. find object of look (thing_y)
             #   try to identify y from remaining modifier words
-            thing_y = session.game.thing_by_words(modifiers)[0]  # returns None or list: [(found thing), (remaining words)]
+            thing_y = session.game.thing_by_words(modifiers, self)[0]  # returns None or list: [(found thing), (remaining words)]
             if not thing_y:
                 session.printw("Sorry, no '{}' around here.".format(' '.join(modifiers)))
                 return None
 
             # 3. thing was found, so call look method of found thing
-            thing_y.look(preposition)
+            # (Thing's: for a player or agent, look is this verb)
+            Thing.look(thing_y, preposition, self)
+        return True
 
     def go(self, modifiers):
         not_understood = False
@@ -483,18 +743,18 @@ class Player(Thing):
                 preposition = session.verb_prepositions_map['go'][next_word]  # reduce to essential prepositions
 
                 # try to identify y from remaining modifier words
-                thing_y = session.game.thing_by_words(modifiers)[0]
+                thing_y = session.game.thing_by_words(modifiers, self)[0]
                 if not thing_y:
                     msg = "Sorry, no '{}' around here.".format(' '.join(modifiers))
                     session.printw(msg)
                     return None
 
                 # execute move
-                self.go_location(preposition, thing_y)
+                return self.go_location(preposition, thing_y)
 
             elif next_word in session.directions_map.keys():  # e.g. go west
                 # FORM: GO DIRECTION
-                self.go_direction(next_word)
+                return self.go_direction(next_word)
             else:
                 # command not understood
                 not_understood = True
@@ -502,29 +762,37 @@ class Player(Thing):
             session.printw("Sorry, go where?")
 
     def go_location(self, preposition, destination):
+        game = session.game
         destination_type = type(destination)
+        if destination_type not in (Room, Portal):
+            new_relation = session.verbs_prepositions_relations['go'][preposition]
+            if not destination.capabilities & CAN_GO[new_relation]:
+                session.printw("Sorry, you can't go {} the {}.".format(
+                    session.relations_list[new_relation], destination.short_names[0]))
+                return None
 
         # delete selected relation types from player
-        for relation in self.relations.keys():
-            if relation in ['by', 'with', 'over', 'under', 'on']:
-                self.relations[relation] = set()
+        for relation in (BY, WITH, OVER, UNDER, ON):
+            for thing in list(self.relations[relation]):
+                game.unrelate(self, relation, thing)
 
         if destination_type == Room:
-            self.room = destination
-            self.room.look('at')
+            game.move(self, destination)
+            self.room.look('at', self)
 
         elif destination_type == Portal:
             # add 'by' relation between player and portal
-            self.relations['by'].add(destination)
+            game.relate(self, BY, destination)
             session.printw("You are now by the {}.".format(destination.short_names[0]))
-            destination.look('at')
+            destination.look('at', self)
 
         elif isinstance(destination, Thing):
             # add new relation between player and thing
-            new_relation = session.verbs_prepositions_relations['go'][preposition]
-            self.relations[new_relation].add(destination)
-            session.printw('You are now {} the {}.'.format(new_relation, destination.short_names[0]))
-            destination.look('at')
+            game.relate(self, new_relation, destination)
+            session.printw('You are now {} the {}.'.format(session.relations_list[new_relation],
+                                                           destination.short_names[0]))
+            Thing.look(destination, 'at', self)  # (destination may be a player or agent)
+        return True
 
     def go_direction(self, direction):
         direction = session.directions_map[direction]
@@ -546,22 +814,23 @@ class Player(Thing):
                 "There's nowhere to go in that direction, sorry."
             ]
             session.printw(random.choice(msg_list))
-            return
+            return None
 
         # 3. room exists: is there a portal between?
         portal = self.room.get_portal(target_room)
         if portal is None:
             # 4. no portal: go into room
-            self.go_location('into', target_room)
+            return self.go_location('into', target_room)
         else:
             # 5. portal: portal open?
             if portal.states['openness'] == "open":
                 # 6. portal open: go
-                self.go_location('into', target_room)
+                return self.go_location('into', target_room)
             else:
-                # 7. portal not open: go to portal
+                # 7. portal not open: go to portal (but not through it)
                 session.printw("Your path is blocked by {}.".format(portal.name))
                 self.go_location('to', portal)
+                return None
 
     def put(self, modifiers=None):
 
@@ -575,7 +844,7 @@ class Player(Thing):
             return None
 
         # Determine thing_x
-        thing_x, modifiers = session.game.thing_by_words(modifiers)
+        thing_x, modifiers = session.game.thing_by_words(modifiers, self)
         if not thing_x:
             session.printw("Sorry, I'm not sure which thing you mean.")
             return None
@@ -586,10 +855,9 @@ class Player(Thing):
         # Find preposition
         preposition = modifiers.pop(0)
         if preposition == 'down':  # 'put x down [...]' => drop x
-            self.drop(thing_x)
-            return None
+            return self.drop(thing_x)
         relation = session.verbs_prepositions_relations['put'].get(preposition, None)
-        if not relation:
+        if relation is None:
             session.printw("You want to put {} where? Please specify a preposition, "
                            "like 'on' or 'in.'".format(thing_x.short_names[0]))
             return None
@@ -598,7 +866,7 @@ class Player(Thing):
         if not modifiers:
             session.printw("You want to put {} {} what?".format(thing_x.short_names[0], preposition))
             return None
-        thing_y, modifiers = session.game.thing_by_words(modifiers)
+        thing_y, modifiers = session.game.thing_by_words(modifiers, self)
         if not thing_y:
             session.printw("Okay, I know about the {}, but I'm not sure which thing you mean by '{}'.".format(
                 thing_x.short_names[0],
@@ -607,10 +875,18 @@ class Player(Thing):
             return None
 
         # TEST FOR CONDITIONS
-        # 1. check if player has thing_x
-        if thing_x not in self.relations['has']:
+        game = session.game
+
+        # 1. check if player has thing_x (or has it in something else, e.g. a bag)
+        if not game.containment.holds(self, thing_x):
             session.printw("Sorry, you don't seem to have the {}.".format(thing_x.short_names[0]))
             return None
+        if thing_y is thing_x:
+            session.printw("Sorry, you can't put the {} {} itself.".format(thing_x.short_names[0], preposition))
+            return None
+        if game.containment.holds(thing_x, thing_y):
+            session.printw("Sorry, the {} is inside the {}.".format(thing_y.short_names[0], thing_x.short_names[0]))
+            return None
 
         # 2. check if player near thing_y
         if not session.game.relation_test(self, 'near', thing_y):
@@ -618,34 +894,34 @@ class Player(Thing):
             return None
 
         # 3. check if thing_y can accept requested relation
-        if not thing_y.qualities.get("can_put_things_on_it", False):
-            session.printw("Sorry, things can't be put on the {}.".format(thing_y.short_names[0]))
+        if not thing_y.capabilities & CAN_PUT[relation]:
+            session.printw("Sorry, things can't be put {} the {}.".format(
+                session.relations_list[relation], thing_y.short_names[0]))
             return None
 
         # EXECUTE
-
         # Remove...
-        #   from player 'has' relation to thing_x
-        self.relations['has'].discard(thing_x)
-        #   from thing_x 'with' relation to player
-        thing_x.relations['with'].discard(self)
+        #   from player 'has' relation to thing_x (and thing_x 'with' relation to player),
+        #   or from whatever thing_x was in or on
+        game.detach(thing_x)
 
         # Add...
         #   to thing_x relation to thing_y
-        thing_x.relations[relation].add(thing_y)
+        game.relate(thing_x, relation, thing_y)
         #   to thing_y inverse relation to thing_x
         inverse_relation = session.inverse_relations[relation]
-        thing_y.relations[inverse_relation].add(thing_x)
+        game.relate(thing_y, inverse_relation, thing_x)
 
         session.printw("The {} is now {} the {}.".format(
             thing_x.short_names[0],
-            relation,
+            session.relations_list[relation],
             thing_y.short_names[0]))
+        return True
 
     def get(self, modifiers):
 
         # determine thing_x
-        thing_x = session.game.thing_by_words(modifiers)[0]
+        thing_x = session.game.thing_by_words(modifiers, self)[0]
         if not thing_x:
             session.printw("Sorry, I don't know which thing you mean by '{}'.".format('.'.join(modifiers)))
             return None
@@ -655,15 +931,15 @@ class Player(Thing):
             session.printw("Sorry, you don't seem to be near the {}.".format(thing_x.short_names[0]))
             return None
 
-        # check if thing_x can be gotten
-        if not isinstance(thing_x, Furniture) and not isinstance(thing_x, Item):
-            session.printw("Sorry, the {} is not the kind of thing you can get.".format(thing_x.short_names[0]))
-            return None
-        if not thing_x.qualities.get('movable', False):
-            session.printw("Sorry, the {} can't be moved.".format(thing_x.short_names[0]))
-            return None
-        if not thing_x.qualities.get('liftable', False):
-            session.printw("Sorry, the {} can't be lifted.".format(thing_x.short_names[0]))
+        # check if thing_x can be gotten (and if not, why not)
+        capabilities = thing_x.capabilities
+        if capabilities & CAN_GET != CAN_GET:
+            if not capabilities & CAN_GET_KIND:
+                session.printw("Sorry, the {} is not the kind of thing you can get.".format(thing_x.short_names[0]))
+            elif not capabilities & CAN_MOVE:
+                session.printw("Sorry, the {} can't be moved.".format(thing_x.short_names[0]))
+            else:
+                session.printw("Sorry, the {} can't be lifted.".format(thing_x.short_names[0]))
             return None
         thing_x_kg = thing_x.qualities.get('weight_kg', 0)
         can_lift_kg = self.qualities.get('can_lift_kg', 0)
@@ -676,21 +952,17 @@ class Player(Thing):
             return None
 
         # EXECUTE
+        game = session.game
         # remove non-owning relations from thing_x (leave owning relations intact, like bag has torch)
-        for R in ['by', 'with', 'over', 'on', 'in']:
-            # first remove inverse relations from related things
-            for related_thing in thing_x.relations[R]:
-                iR = session.inverse_relations[R]
-                related_thing.relations[iR].discard(thing_x)
-            # remove relation R from thing_x
-            thing_x.relations[R] = set()
+        game.detach(thing_x, (BY, WITH, OVER, ON, IN))
         # add to thing_x a 'with' relation with player,
         #   and to player a matching 'has' relation with thing_x
-        thing_x.relations['with'].add(self)
-        self.relations['has'].add(thing_x)
+        game.relate(thing_x, WITH, self)
+        game.relate(self, HAS, thing_x)
 
         # report
         session.printw("(TODO finish this) You now have the {}.".format(thing_x.short_names[0]))
+        return True
 
     def drop(self, modifiers):
 
@@ -700,32 +972,64 @@ class Player(Thing):
 
         # determine thing_x
         if not isinstance(modifiers, Thing):
-            thing_x = session.game.thing_by_words(modifiers)[0]
+            thing_x = session.game.thing_by_words(modifiers, self)[0]
             if not thing_x:
                 session.printw("Sorry, I don't know which thing you mean by '{}'.".format('.'.join(modifiers)))
                 return None
         else:  # Thing was sent in, not string(s)
             thing_x = modifiers
 
-        # 1. does player have thing_x?
-        if not thing_x in self.relations['has']:  # TODO add indirect relation check (e.g. in bag, bag with or on player)
+        game = session.game
+
+        # 1. does player have thing_x (directly, or e.g. in a bag they have)?
+        if not game.containment.holds(self, thing_x):
             session.printw("Sorry, you don't seem to have the {}.".format(thing_x.short_names[0]))
             return None
 
         # 2. Execute
-        #   for player, remove 'has' relation to thing_x (and inverse ('with') from thing_x)
-        self.relations['has'].remove(thing_x)
-        thing_x.relations['with'].discard(self)
+        #   for player, remove 'has' relation to thing_x (and inverse ('with') from thing_x),
+        #   or take it from whatever it was in or on
+        game.detach(thing_x)
 
         #   for thing_x, add 'in' relation to current room (and inverse ('has') to room)
-        thing_x.relations['in'].add(self.room)
-        self.room.relations['has'].add(thing_x)
+        game.relate(thing_x, IN, self.room)
+        game.relate(self.room, HAS, thing_x)
 
         # 3. Report
         session.printw("You have dropped the {}.".format(thing_x.short_names[0]))
+        return True
 
     def listen(self, modifiers):
-        session.printw("(DEV) You listen (or listen to x).")  #TODO
+        # 'listen' or 'listen to x'
+        if modifiers and modifiers[0] == 'to':
+            modifiers = modifiers[1:]
+        thing_x = self.room
+        if modifiers and not (modifiers == ['room'] or modifiers == ['around']):
+            thing_x = session.game.thing_by_words(modifiers, self)[0]
+            if not thing_x:
+                session.printw("Sorry, I don't know which thing you mean by '{}'.".format(' '.join(modifiers)))
+                return None
+        if isinstance(thing_x, Room) and thing_x is not self.room:
+            session.printw("Sorry, you're not in the {}.".format(thing_x.short_names[0]))
+            return None
+        if thing_x is not self.room:
+            if thing_x.descriptions.get('sounds', None):
+                session.printw(thing_x.description('sounds', 0))
+            else:
+                session.printw("You hear nothing from the {}.".format(thing_x.short_names[0]))
+            return True
+
+        # sounds of this room...
+        msg = self.room.description('sounds', 0)
+        # ...and of rooms around it
+        for room, level, direction in session.game.acoustics.heard(self.room):
+            sound = room.descriptions['sounds_far'][0] if room.descriptions.get('sounds_far', None) else 'something'
+            msg += " From the {} you can {}hear {}.".format(
+                direction,
+                'faintly ' if level < 2 * Acoustics.cutoff else '',
+                sound)
+        session.printw(msg)
+        return True
 
     def open(self, modifiers):
         # TODO: add context test
@@ -733,13 +1037,13 @@ class Player(Thing):
             session.printw("Open what?")
             return
         # determine thing to open
-        thing_x = session.game.thing_by_words(modifiers)[0]
+        thing_x = session.game.thing_by_words(modifiers, self)[0]
         if not thing_x:  # if no thing found:
             msg = "Sorry, you can't open '{}' here.".format(' '.join(modifiers))
             session.printw(msg)
         else:  # a thing was found
             # run open function of found thing
-            thing_x.open()  # pass no modifiers
+            return Thing.open(thing_x, self)  # pass no modifiers (Thing's: thing_x may be a player)
 
     def close(self, modifiers):
         # TODO: add context test
@@ -747,30 +1051,31 @@ class Player(Thing):
             session.printw("Close what?")
             return
         # determine thing to open
-        thing_x = session.game.thing_by_words(modifiers)[0]
+        thing_x = session.game.thing_by_words(modifiers, self)[0]
         if not thing_x:  # if no thing found:
             msg = "Sorry, you can't close '{}' here.".format(' '.join(modifiers))
             session.printw(msg)
         else:  # a thing was found
             # run open function of found thing
-            thing_x.close()  # pass no modifiers
+            return Thing.close(thing_x, self)  # pass no modifiers (Thing's: thing_x may be a player)
 
     def test(self, modifiers):
 
         thing_y, relation = None, None
 
-        thing_x, modifiers = session.game.thing_by_words(modifiers)
+        thing_x, modifiers = session.game.thing_by_words(modifiers, self)
 
         if not not modifiers:
             relation = modifiers.pop(0)
-            if not relation in set().union({'near'}, session.relations_list):
+            if relation not in session.relation_args:
                 relation = None
 
         if not not modifiers:
-            thing_y, modifiers = session.game.thing_by_words(modifiers)
+            thing_y, modifiers = session.game.thing_by_words(modifiers, self)
 
         if not thing_x or not relation or not thing_y:
             session.printw("Sorry, I didn't get that. Try a question like, 'is the key on the bed'.")
+            return None
 
         tf = session.game.relation_test(thing_x, relation, thing_y)
 
@@ -781,6 +1086,73 @@ class Player(Thing):
             relation,
             thing_y.short_names[0]
         ))
+        return True
+
+    def trace(self, modifiers):
+        # (DEV) 'trace on' / 'trace off' switch relation_test tracing; 'trace' reports the counters
+        game = session.game
+        if modifiers[:1] == ['on']:
+            game.trace_relations(True)
+            session.printw("(DEV) Relation tracing is on.")
+        elif modifiers[:1] == ['off']:
+            game.trace_relations(False)
+            session.printw("(DEV) Relation tracing is off.")
+        elif game.relation_trace is None:
+            session.printw("(DEV) Relation tracing is off. Try 'trace on'.")
+        elif not game.relation_trace.counters:
+            session.printw("(DEV) No relations tested yet.")
+        else:
+            for line in game.relation_trace.report():
+                session.printw("(DEV) " + line)
+        return True
+
+    def help(self, modifiers):
+        # 'help': the verbs there are; 'help x': what can be done with x (see Thing.actions)
+        if not modifiers:
+            verbs = [verb for verb, verb_fn in self.command_map.items() if verb == verb_fn.__name__]  # (not synonyms)
+            session.printw("You can {}. Try 'help' and a thing, e.g. 'help door', to see what you can do with it.".format(
+                session.english_list(verbs)))
+            return True
+        thing_x = session.game.thing_by_words(modifiers, self)[0]
+        if not thing_x:
+            session.printw("Sorry, I don't know which thing you mean by '{}'.".format(' '.join(modifiers)))
+            return None
+        actions = thing_x.actions()
+        if not actions:
+            session.printw("There's not much you can do with the {}.".format(thing_x.short_names[0]))
+        else:
+            session.printw("With the {} you could {}.".format(thing_x.short_names[0], session.english_list(actions)))
+        return True
+
+    def undo(self, modifiers):
+        if self is not session.player:  # (the history is the main player's, see run_command)
+            session.printw("Sorry, you can't undo here.")
+            return None
+        history = session.game.history
+        command_phrase = history.undo_stack[-1][0] if history.undo_stack else None
+        undone = history.undo()
+        if undone is None:
+            session.printw("There's nothing to undo.")
+        elif undone is False:
+            session.printw("Sorry, you can't undo '{}': things have changed since.".format(command_phrase))
+        else:
+            session.printw("You undo '{}'.".format(command_phrase))
+            return True
+
+    def redo(self, modifiers):
+        if self is not session.player:
+            session.printw("Sorry, you can't redo here.")
+            return None
+        history = session.game.history
+        command_phrase = history.redo_stack[-1][0] if history.redo_stack else None
+        redone = history.redo()
+        if redone is None:
+            session.printw("There's nothing to redo.")
+        elif redone is False:
+            session.printw("Sorry, you can't redo '{}': things have changed since.".format(command_phrase))
+        else:
+            session.printw("You redo '{}'.".format(command_phrase))
+            return True
 
     command_map = {
         'look': look, 'examine': look, 'study': look, 'survey': look, 'inspect': look,
@@ -790,54 +1162,272 @@ class Player(Thing):
         'drop': drop, 'release': drop,
         'listen': listen, 'hear': listen,
         'open': open, 'close': close,
-        'is': test, 'test': test
+        'is': test, 'test': test,
+        'trace': trace,
+        'undo': undo, 'redo': redo,
+        'help': help
     }
 
-    def command_parse(self, command_phrase):
-        # split input into lowercase words
-        command_words = list(map(lambda x: x.lower(), command_phrase.split()))
+    def command_parse(self, command_line):
+        """ Runs a command line: one command, e.g. 'get torch', or several chained with 'then' or ';',
+        e.g. 'get torch then go north; open door'. Chained commands are planned first (nothing runs
+        if a verb isn't known), then run one after another, stopping at the first that fails, and
+        their output is written in one go.
 
-        # drop articles, if found
-        if 'the' in command_words: command_words.remove('the')
-        if 'a' in command_words: command_words.remove('a')
-        if 'an' in command_words: command_words.remove('an')
-
-        word1 = command_words.pop(0)
-        verb_fn = self.command_map.get(word1, None)
-        if verb_fn is None:
-            session.printw("Sorry, you don't know how to \"{}\" here.".format(word1))
+        :return: True if every command succeeded, else None
+        """
+        plan = self.plan(command_line)
+        if not plan:
             return None
-        else:
-            verb_fn(self, command_words)
-            return True
+        for command_phrase, verb_fn, command_words in plan:
+            if verb_fn is None:
+                session.printw("Sorry, you don't know how to \"{}\" here.".format(command_words[0]))
+                session.game.metrics.command('unknown', 0.0)
+                return None
+        if len(plan) == 1:
+            return self.run_command(*plan[0])
+
+        output = session.output
+        if isinstance(output, NullOutput):
+            return self.run_plan(plan)
+        buffer = io.StringIO()
+        try:
+            with session.redirect(buffer):
+                return self.run_plan(plan)
+        finally:
+            output = output or sys.stdout
+            output.write(buffer.getvalue())
+            output.flush()
+
+    def plan(self, command_line):
+        """ Splits a command line into commands, e.g. 'put the key on bed then go north' =>
+        [('put the key on bed', Player.put, ['key', 'on', 'bed']), ('go north', Player.go, ['north'])]
+
+        :return: list of (command phrase, verb function (None if not known), modifier words
+            (or, if the verb isn't known, [verb]))
+        """
+        plan = []
+        for part in command_line.split(';'):
+            phrase_words = []
+            for word in part.split() + ['then']:
+                if word.lower() != 'then':
+                    phrase_words.append(word)
+                    continue
+                # split input into lowercase words
+                command_words = list(map(lambda x: x.lower(), phrase_words))
+
+                # drop articles, if found
+                if 'the' in command_words: command_words.remove('the')
+                if 'a' in command_words: command_words.remove('a')
+                if 'an' in command_words: command_words.remove('an')
+
+                if command_words:
+                    verb_fn = self.command_map.get(command_words[0], None)
+                    plan.append((' '.join(phrase_words), verb_fn,
+                                 command_words[1:] if verb_fn is not None else command_words[:1]))
+                phrase_words = []
+        return plan
+
+    def run_plan(self, plan):
+        # runs planned commands until one fails
+        for i, step in enumerate(plan):
+            if not self.run_command(*step):
+                if i + 1 < len(plan):
+                    session.printw("You stop there, before '{}'.".format(plan[i + 1][0]))
+                return None
+        return True
+
+    def run_command(self, command_phrase, verb_fn, command_words):
+        """ Runs one planned command (see plan), keeping it for undo (if it's the player's) and saving it
+
+        :return: True if it succeeded, else None
+        """
+        started = time.perf_counter()
+        game = session.game
+        journal = game.journal
+        room, words = self.room, list(command_words)  # (as they were, for others to see; see Broadcasts)
+        try:
+            if self is not session.player or verb_fn in (Player.undo, Player.redo):
+                succeeded = verb_fn(self, command_words)
+            else:
+                # the player's commands can be undone
+                history = session.game.history
+                history.begin(command_phrase)
+                try:
+                    succeeded = verb_fn(self, command_words)
+                finally:
+                    history.end()
+        finally:
+            if journal is not None:
+                journal.end(command_phrase)
+        if succeeded:
+            game.broadcasts.report(self, room, verb_fn, words)
+        game.metrics.command(verb_fn.__name__, time.perf_counter() - started)
+        return True if succeeded else None
+
+
+class Agent(Player):
+    """
+    A non-player character. Agents act through the same verbs as the player (via command_parse),
+    with their output discarded, when a Simulation wakes them.
+    """
+
+    self_names = []
+
+    def __init__(self, name, thing_id, room, priority=0, patience=5):
+        """
+        :param name: e.g. 'Gertrude'
+        :param thing_id: e.g. 'ag_0001'
+        :param room: room object to start in
+        :param priority: agents with higher priority act first when due in the same tick
+        :param patience: most ticks to wait between actions
+        """
+        self.output = NullOutput()  # what the agent sees
+        with session.redirect(self.output):
+            super().__init__(name, thing_id)
+        self.room = room
+        self.priority = priority
+        self.patience = patience
+        self.active = True  # False once removed from its simulation
+        self.actions_taken = 0
+
+    def decide(self):
+        """ Picks something to do (a command, as the player would type it) """
+        options = ['go ' + random.choice(['north', 'east', 'south', 'west'])]
+        items = [thing for thing in self.room.relations[HAS] if isinstance(thing, Item)]
+        if items:
+            item = random.choice(items)
+            options += ['go to ' + item.short_names[0], 'get ' + item.short_names[0]]
+        if self.relations[HAS]:
+            options.append('drop ' + random.choice(list(self.relations[HAS])).short_names[0])
+        for portal in self.relations[BY]:
+            if isinstance(portal, Portal):
+                options.append(random.choice(['open ', 'close ']) + portal.short_names[0])
+        return random.choice(options)
+
+    def act(self):
+        """ Does one thing
+
+        :return: ticks until the agent wants to act again
+        """
+        with session.redirect(self.output):
+            self.command_parse(self.decide())
+        self.actions_taken += 1
+        return random.randint(1, self.patience)
+
+
+class Simulation:
+    """
+    Shared tick loop for agents, alongside human input.
+    Agents sleep until their wake tick in a heap, so a tick only touches the agents due to act,
+    and at most max_actions_per_tick of those (earliest due, then highest priority, first);
+    agents left over stay due and go first next tick.
+    """
+
+    def __init__(self, game, tick_seconds=0.5, max_actions_per_tick=100):
+        self.game = game
+        self.tick_seconds = tick_seconds
+        self.max_actions_per_tick = max_actions_per_tick
+        self.tick_count = 0
+        self.queue = []  # heap of (wake tick, -priority, sequence number, agent)
+        self.sequence = 0  # tie-breaker, so agents themselves are never compared
+        self.agents = {}  # key: thing_id
+
+    def add_agent(self, agent, delay=0):
+        self.agents[agent.thing_id] = agent
+        if self.game.journal is not None:  # (an agent added after restoring gets back what it had)
+            self.game.journal.add(agent)
+        self.schedule(agent, delay)
+
+    def remove_agent(self, agent):
+        # the agent's queue entry is skipped when it comes up
+        agent.active = False
+        del self.agents[agent.thing_id]
+        self.game.remove_thing(agent)
+
+    def schedule(self, agent, delay):
+        self.sequence += 1
+        heapq.heappush(self.queue, (self.tick_count + delay, -agent.priority, self.sequence, agent))
+
+    def tick(self):
+        """ Runs one tick
+
+        :return: number of agents that acted
+        """
+        acted = 0
+        while self.queue and self.queue[0][0] <= self.tick_count and acted < self.max_actions_per_tick:
+            agent = heapq.heappop(self.queue)[3]
+            if not agent.active:
+                continue
+            self.schedule(agent, max(1, agent.act()))
+            acted += 1
+        self.tick_count += 1
+        return acted
+
+    async def run(self, ticks=None):
+        """ Ticks every tick_seconds (for ticks ticks, or until cancelled) """
+        import asyncio  # only needed when simulating (slow to import)
+        while ticks is None or ticks > 0:
+            self.tick()
+            if ticks is not None:
+                ticks -= 1
+            await asyncio.sleep(self.tick_seconds)
+
+    async def run_interactive(self):
+        """ Plays the game (as Game.run does) while the agents act on the tick loop """
+        import asyncio  # only needed when simulating (slow to import)
+        loop = asyncio.get_running_loop()
+        ticker = asyncio.ensure_future(self.run())
+        session.player.room.look('at')
+        try:
+            while True:
+                print('', file=session.output)
+                # read input on a thread, so ticks carry on while the player thinks
+                inp = (await loop.run_in_executor(None, input, "What's next?:")).lower()
+                if inp in ('q', 'quit', 'exit', 'leave', 'stop', 'end'):
+                    session.printw("Thanks for playing. Bye.")
+                    break
+                session.player.command_parse(inp)
+        finally:
+            ticker.cancel()
+            if self.game.journal is not None:
+                self.game.journal.close()
 
 
 class Portal(Thing):
 
+    go_relations = (BY,)
+
+    default_states = {  # default states for all portals
+        "openness": "closed"
+    }
+
+    default_qualities = {  # default qualities for all portals
+        "movable": False,
+        "liftable": False,
+        "is_vessel": False,
+        "openable": True,
+        "lockable": False
+    }
+
+    default_verbables = {
+    }
+
     def __init__(self, thing_id, name, short_names, descriptions,
                  room1_thing_id, room2_thing_id,
                  qualities_unique=None,
                  states_unique=None,
                  verbables_unique=None):
 
-        states = {  # default states for all portals
-            "openness": "closed"
-        }
+        states = dict(self.default_states)
         if states_unique:
             states.update(states_unique)
 
-        qualities = {  # default qualities for all portals
-            "movable": False,
-            "liftable": False,
-            "is_vessel": False,
-            "openable": True,
-            "lockable": False
-        }
+        qualities = dict(self.default_qualities)
         if qualities_unique:
             qualities.update(qualities_unique)
 
-        verbables = {
-        }
+        verbables = dict(self.default_verbables)
         if verbables_unique:
             verbables.update((verbables_unique))
 
@@ -856,28 +1446,34 @@ class Portal(Thing):
 
 class Fixture(Thing):
 
+    default_states = {  # default states for all fixtures
+    }
+
+    default_qualities = {  # default qualities for all fixtures
+        "movable": False,
+        "liftable": False,
+        "is_vessel": False,
+        "openable": False,
+        "lockable": False
+    }
+
+    default_verbables = {
+    }
+
     def __init__(self, thing_id, name, short_names, descriptions,
                  qualities_unique=None,
                  states_unique=None,
                  verbables_unique=None):
 
-        states = {  # default states for all fixtures
-        }
+        states = dict(self.default_states)
         if states_unique:
             states.update(states_unique)
 
-        qualities = {  # default qualities for all fixtures
-            "movable": False,
-            "liftable": False,
-            "is_vessel": False,
-            "openable": False,
-            "lockable": False
-        }
+        qualities = dict(self.default_qualities)
         if qualities_unique:
             qualities.update(qualities_unique)
 
-        verbables = {
-        }
+        verbables = dict(self.default_verbables)
         if verbables_unique:
             verbables.update((verbables_unique))
 
@@ -890,32 +1486,40 @@ class Fixture(Thing):
 
 class Furniture(Thing):
 
+    kind_capabilities = CAN_GET_KIND
+
+    default_states = {  # default states for all furniture
+    }
+
+    default_qualities = {  # default qualities for all furniture
+        "movable": True,
+        "liftable": False,
+        "is_vessel": True,
+        "openable": False,
+        "lockable": False,
+        "size_like": None,  # ref session.litres_map
+        "weight_kg": None,
+        "can_hold_L": None,
+        "can_put_things_on_it": True
+    }
+
+    default_verbables = {
+    }
+
     def __init__(self, thing_id, name, short_names, descriptions,
                  qualities_unique=None,
                  states_unique=None,
                  verbables_unique=None):
 
-        states = {  # default states for all furniture
-        }
+        states = dict(self.default_states)
         if states_unique:
             states.update(states_unique)
 
-        qualities = {  # default qualities for all furniture
-            "movable": True,
-            "liftable": False,
-            "is_vessel": True,
-            "openable": False,
-            "lockable": False,
-            "size_like": None,  # ref session.litres_map
-            "weight_kg": None,
-            "can_hold_L": None,
-            "can_put_things_on_it": True
-        }
+        qualities = dict(self.default_qualities)
         if qualities_unique:
             qualities.update(qualities_unique)
 
-        verbables = {
-        }
+        verbables = dict(self.default_verbables)
         if verbables_unique:
             verbables.update((verbables_unique))
 
@@ -928,31 +1532,39 @@ class Furniture(Thing):
 
 class Item(Thing):
 
+    kind_capabilities = CAN_GET_KIND
+
+    default_states = {  # default states for all items
+    }
+
+    default_qualities = {  # default qualities for all itesm
+        "movable": True,
+        "liftable": True,
+        "is_vessel": False,
+        "openable": False,
+        "lockable": False,
+        "size_like": None,  # ref session.litres_map
+        "weight_kg": None,
+        "can_hold_L": None
+    }
+
+    default_verbables = {
+    }
+
     def __init__(self, thing_id, name, short_names, descriptions,
                  qualities_unique=None,
                  states_unique=None,
                  verbables_unique=None):
 
-        states = {  # default states for all items
-        }
+        states = dict(self.default_states)
         if states_unique:
             states.update(states_unique)
 
-        qualities = {  # default qualities for all itesm
-            "movable": True,
-            "liftable": True,
-            "is_vessel": False,
-            "openable": False,
-            "lockable": False,
-            "size_like": None,  # ref session.litres_map
-            "weight_kg": None,
-            "can_hold_L": None
-        }
+        qualities = dict(self.default_qualities)
         if qualities_unique:
             qualities.update(qualities_unique)
 
-        verbables = {
-        }
+        verbables = dict(self.default_verbables)
         if verbables_unique:
             verbables.update((verbables_unique))
 
@@ -963,17 +1575,1980 @@ class Item(Thing):
                          )
 
 
-class Game:
+class RelationTrace:
+    """
+    Records how Game.relation_test reaches its answers.
+    Each query gives a record: which rule fired (direct, IR_un, IR_ss or none), the relation
+    that fired it, and the sizes of the sets built along the way.
+    Counters are aggregated per relation argument for the whole session.
+    """
+
+    rules = ('direct', 'IR_un', 'IR_ss', 'none')
+
+    def __init__(self, max_records=1000):
+        self.records = collections.deque(maxlen=max_records)  # most recent queries only
+        self.counters = {}  # key: relation_arg, e.g. 'near'
+
+    def record(self, thing_x, relation_arg, thing_y, rule, fired_relation, set_sizes, seconds):
+        """ Stores one query and adds it to the session counters
+
+        :param rule: one of RelationTrace.rules
+        :param fired_relation: relation id that gave the answer, e.g. ON for a 'near' query (or None)
+        :param set_sizes: list of tuples: (rule, relation id, size of X's set, size of Y's set)
+        :param seconds: time taken by the query
+        """
+        # records keep relation names (ids are only for the hot path)
+        names = session.relations_list
+        if not isinstance(relation_arg, str):
+            relation_arg = names[relation_arg]
+        if fired_relation is not None:
+            fired_relation = names[fired_relation]
+        set_sizes = [(rule_name, names[R], size_x, size_y) for (rule_name, R, size_x, size_y) in set_sizes]
+        self.records.append({
+            'x': thing_x.thing_id,
+            'relation': relation_arg,
+            'y': thing_y.thing_id,
+            'result': rule != 'none',
+            'rule': rule,
+            'fired_relation': fired_relation,
+            'set_sizes': set_sizes,
+            'seconds': seconds
+        })
+
+        counter = self.counters.get(relation_arg, None)
+        if counter is None:
+            counter = {'queries': 0, 'seconds': 0.0, 'set_elements': 0}
+            counter.update({rule_name: 0 for rule_name in self.rules})
+            self.counters[relation_arg] = counter
+        counter['queries'] += 1
+        counter['seconds'] += seconds
+        counter[rule] += 1
+        counter['set_elements'] += sum(size_x + size_y for (_, _, size_x, size_y) in set_sizes)
+
+    def report(self):
+        """ Returns counters as lines of text, most expensive relation first
+
+        :return: list of strings
+        """
+        lines = []
+        by_cost = sorted(self.counters.items(), key=lambda kv: kv[1]['seconds'], reverse=True)
+        for relation_arg, counter in by_cost:
+            lines.append("{}: {} queries, {:.3f}ms, {} set elements built; {}".format(
+                relation_arg,
+                counter['queries'],
+                counter['seconds'] * 1000,
+                counter['set_elements'],
+                ', '.join('{} {}'.format(rule, counter[rule]) for rule in self.rules)
+            ))
+        return lines
+
+
+class NameIndex:
+    """
+    Index of things' short names for exact and typo-tolerant (fuzzy) lookup, e.g. 'bakpack'.
+    Fuzzy lookup scores names by the trigrams they share with the query, found through
+    posting lists (trigram -> names), so only names sharing a trigram are ever looked at.
+    """
 
     def __init__(self):
+        self.exact = {}  # key: short name; value: list of thing_ids, in order added
+        self.grams = {}  # key: trigram, e.g. 'bag'; value: set of short names
+        self.hits, self.misses, self.fuzzy_lookups = 0, 0, 0  # lookups, for metrics
+
+    @staticmethod
+    def trigrams(name):
+        # pad so that word starts and ends count, e.g. 'bag' -> {'  b', ' ba', 'bag', 'ag '}
+        padded = '  ' + name + ' '
+        return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+    def add(self, thing_id, short_names):
+        for name in short_names:
+            thing_ids = self.exact.setdefault(name, [])
+            if not thing_ids:  # new name: index its trigrams
+                for gram in self.trigrams(name):
+                    self.grams.setdefault(gram, set()).add(name)
+            thing_ids.append(thing_id)
+
+    def remove(self, thing_id, short_names):
+        for name in short_names:
+            thing_ids = self.exact.get(name, [])
+            if thing_id in thing_ids:
+                thing_ids.remove(thing_id)
+            if not thing_ids and name in self.exact:  # name no longer used: drop its trigrams
+                del self.exact[name]
+                for gram in self.trigrams(name):
+                    self.grams[gram].discard(name)
+
+    def lookup(self, name):
+        """ Returns the first thing_id added with this short name (or None) """
+        thing_ids = self.exact.get(name, None)
+        if not thing_ids:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return thing_ids[0]
+
+    def fuzzy(self, query, min_score=0.5, limit=5):
+        """ Finds short names similar to query
+
+        :param min_score: minimum Dice similarity of trigram sets (0-1)
+        :return: list of tuples (score, short name), best first
+        """
+        self.fuzzy_lookups += 1
+        query_grams = self.trigrams(query)
+        shared = collections.Counter()
+        for gram in query_grams:
+            shared.update(self.grams.get(gram, ()))
+
+        scored = []
+        for name, count in shared.items():
+            score = 2.0 * count / (len(query_grams) + len(self.trigrams(name)))
+            if score >= min_score:
+                scored.append((score, name))
+
+        # best score first; among equal scores, fewest edits first
+        scored.sort(key=lambda sn: (-sn[0], self.edit_distance(query, sn[1])))
+        return scored[:limit]
+
+    @staticmethod
+    def edit_distance(a, b):
+        # Levenshtein distance, keeping only one row of the table
+        row = list(range(len(b) + 1))
+        for i, ca in enumerate(a, 1):
+            previous, row[0] = row[0], i
+            for j, cb in enumerate(b, 1):
+                previous, row[j] = row[j], min(row[j] + 1, row[j-1] + 1, previous + (ca != cb))
+        return row[-1]
+
+
+class WorldStore:
+    """
+    Optional SQLite storage for a world, for worlds too big to load up front.
+    Thing records load on first access (their relations on first use) and are dropped again,
+    oldest first, when the loaded records exceed the memory budget; changed things are written
+    back, in batched transactions. Relations are stored both ways in an indexed table.
+    A dropped thing is let go of (see unload): it's freed unless it's still in use, e.g. in the
+    player's room, or held by the player.
+    Play changes the database, so build a fresh copy (see build) for a fresh world.
+
+    Usage:
+        store = WorldStore.build('world.db', 'content_dir')  # once
+        game = Game(content_source=WorldStore('world.db'), player_name='Alice', initial_room=(1,7))
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS things (
+            thing_id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,  -- content name, e.g. 'portals'
+            key TEXT NOT NULL,  -- key in the content, e.g. 'po_0001'
+            record TEXT NOT NULL,  -- json thing dict, as in the content
+            states TEXT  -- json states, once changed by play
+        );
+        CREATE INDEX IF NOT EXISTS things_kind_key ON things (kind, key);
+        CREATE TABLE IF NOT EXISTS relations (
+            x TEXT NOT NULL, relation TEXT NOT NULL, y TEXT NOT NULL,
+            PRIMARY KEY (x, relation, y)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS relations_y ON relations (y, relation);
+        CREATE TABLE IF NOT EXISTS names (name TEXT NOT NULL, thing_id TEXT NOT NULL);
+    """
+
+    def __init__(self, path, memory_budget=8000000, batch_size=100):
+        """
+        :param path: SQLite database file, e.g. 'world.db'
+        :param memory_budget: rough bytes of thing records to keep loaded
+        :param batch_size: changed things to write back per transaction
+        """
+        import sqlite3  # optional backend: imported only when used
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.schema)
+        self.memory_budget = memory_budget
+        self.batch_size = batch_size
+        self.game = None  # set by attach
+
+        self.live = weakref.WeakValueDictionary()  # key: thing_id; every loaded thing still in memory
+        self.resident = collections.OrderedDict()  # key: thing_id; value: (thing, bytes), oldest first
+        self.resident_bytes = 0
+        self.loaded = {}  # key: thing_id; value: (states json, relation edges or None) as loaded
+        self.pending = {}  # key: thing_id; value: (states json, relation edges or None) to write
+        self.loading = set()  # thing_ids of things being made, or having their relations loaded (see unload)
+        self.hits, self.misses, self.evictions, self.writes = 0, 0, 0, 0
+
+    @classmethod
+    def build(cls, path, content_dir='', batch_size=10000):
+        """ Creates (or replaces) a store from json content files
+
+        :param content_dir: directory of the json content files
+        :return: the new WorldStore
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        store = cls(path)
+        with store.db:  # one transaction per batch of rows
+            for name in content_names[:-1]:
+                # (streamed, a batch of rows at a time: the content may be bigger than memory)
+                rows, names = [], []
+                for key, thing_dict in iter_content_file(os.path.join(content_dir, name + '.json')):
+                    thing_id = thing_dict.get('thing_id', key)
+                    rows.append((thing_id, name, key, json.dumps(thing_dict), None))
+                    names.extend((short_name, thing_id) for short_name in thing_dict['short_names'])
+                    if len(rows) >= batch_size:
+                        store.db.executemany("INSERT INTO things VALUES (?, ?, ?, ?, ?)", rows)
+                        store.db.executemany("INSERT INTO names VALUES (?, ?)", names)
+                        rows, names = [], []
+                store.db.executemany("INSERT INTO things VALUES (?, ?, ?, ?, ?)", rows)
+                store.db.executemany("INSERT INTO names VALUES (?, ?)", names)
+
+            edges = set()
+            names = session.relations_list
+            for thing_id_x, relations in iter_content_file(os.path.join(content_dir, 'relations.json')):
+                for thing_id_x, relation, thing_id_y in Game.relation_edges({thing_id_x: relations}):
+                    edges.add((thing_id_x, names[relation], thing_id_y))
+                    edges.add((thing_id_y, names[session.inverse_relations[relation]], thing_id_x))
+            store.db.executemany("INSERT INTO relations VALUES (?, ?, ?)", sorted(edges))
+        return store
+
+    def attach(self, game):
+        # connects the store to a game: names are indexed now, things load when used
+        self.game = game
+        for name, thing_id in self.db.execute("SELECT name, thing_id FROM names ORDER BY rowid"):
+            game.names.add(thing_id, [name])
+
+    def __contains__(self, thing_id):
+        return self.db.execute("SELECT 1 FROM things WHERE thing_id = ?", (thing_id,)).fetchone() is not None
+
+    def get(self, thing_id):
+        """ Gets a thing, loading it if it isn't in memory
+
+        :return: thing, or None if not in the store
+        """
+        thing = self.live.get(thing_id, None)
+        if thing is not None:
+            self.hits += 1
+            self.touch(thing)
+            return thing
+
+        row = self.db.execute("SELECT kind, record, states FROM things WHERE thing_id = ?",
+                              (thing_id,)).fetchone()
+        if row is None:
+            return None
+        self.misses += 1
+        kind, record, states_json = row
+        pending = self.pending.get(thing_id, None)
+        if pending is not None:  # changes not yet written
+            states_json = pending[0]
+
+        self.loading.add(thing_id)  # (not to be unloaded half made, as other things load)
+        try:
+            thing = Game.content_classes[kind](**json.loads(record))  # Thing.__init__ makes it resident
+            if states_json is not None:
+                thing.states = json.loads(states_json)
+            if kind == 'portals':
+                thing.room1 = self.game.get_room(thing.room1_coords)
+                thing.room2 = self.game.get_room(thing.room2_coords)
+            del thing.relations  # loaded on first use (see Thing.__getattr__)
+        finally:
+            self.loading.discard(thing_id)
+        thing.store = self
+        self.loaded[thing_id] = (json.dumps(thing.states, sort_keys=True), None)
+        return thing
+
+    def add(self, thing):
+        # makes a newly created thing resident (most recently used)
+        self.live[thing.thing_id] = thing
+        size = 200 + len(str(thing.descriptions)) + len(str(thing.states))
+        self.resident[thing.thing_id] = (thing, size)
+        self.resident_bytes += size
+        self.evict()
+
+    def touch(self, thing):
+        if thing.thing_id in self.resident:
+            self.resident.move_to_end(thing.thing_id)
+        else:  # loaded, evicted, but still referenced: make it resident again
+            self.add(thing)
+
+    def evict(self):
+        # drops the least recently used things until within the memory budget
+        while self.resident_bytes > self.memory_budget and len(self.resident) > 1:
+            thing_id, (thing, size) = self.resident.popitem(last=False)
+            self.resident_bytes -= size
+            self.evictions += 1
+            self.write_back(thing)
+            self.unload(thing)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def stored_edges(self, thing_id):
+        # a stored thing's relation edges, (relation id, thing_id) pairs: as written back, or as in the store
+        pending = self.pending.get(thing_id, None)
+        if pending is not None and pending[1] is not None:
+            return pending[1]
+        # relations are stored by name, so a store doesn't depend on the order of relation ids
+        relation_ids = session.relation_ids
+        return frozenset((relation_ids[relation], thing_id_y) for relation, thing_id_y in
+                         self.db.execute("SELECT relation, y FROM relations WHERE x = ?", (thing_id,)))
+
+    def load_relations(self, thing):
+        """ Builds a thing's relations from the store (loading the related things) """
+        edges = self.stored_edges(thing.thing_id)
+        relations = session.new_relations()
+        thing.relations = relations  # set first: related things may refer back to this one
+        self.loading.add(thing.thing_id)  # (not to be unloaded half built, as related things load)
+        try:
+            for relation, thing_id_y in edges:
+                relations[relation].add(self.game.things[thing_id_y])
+        finally:
+            self.loading.discard(thing.thing_id)
+        self.loaded[thing.thing_id] = (self.loaded[thing.thing_id][0], edges)
+        return relations
+
+    def unload(self, thing):
+        """ Lets go of an evicted (and written back) thing, so it's freed unless still in use: drops
+        its relations, the relations of loaded things referring to it, and the game's caches of it
+        (relations load again from the store when next used) """
+        if thing.thing_id not in self.loaded or thing.thing_id in self.loading:
+            return
+        relations = thing.__dict__.get('relations', None)
+        edges = self.image(thing)[1] if relations is not None else self.stored_edges(thing.thing_id)
+        for relation, thing_id_y in edges:
+            thing_y = self.live.get(thing_id_y, None)  # (None if not loaded, or not from the store)
+            if (thing_y is not None and thing_y is not thing and 'relations' in thing_y.__dict__
+                    and thing_id_y in self.loaded and thing_id_y not in self.loading):
+                self.write_back(thing_y)
+                del thing_y.relations
+        if relations is not None:
+            del thing.relations
+        self.game.forget(thing)
+
+    @staticmethod
+    def image(thing):
+        # (states json, relation edges or None if relations weren't used) of a loaded thing
+        relations = thing.__dict__.get('relations', None)
+        edges = None
+        if relations is not None:
+            edges = frozenset((relation, thing_y.thing_id) for relation, things in enumerate(relations) for thing_y in things)
+        return json.dumps(thing.states, sort_keys=True), edges
+
+    def write_back(self, thing):
+        # queues a thing's changes (if any) for writing
+        loaded = self.loaded.get(thing.thing_id, None)
+        if loaded is None or thing.thing_id in self.loading:  # not from the store (e.g. the player), or half loaded
+            return
+        states_json, edges = self.image(thing)
+        if states_json == loaded[0] and (edges is None or edges == loaded[1]):
+            return
+        self.pending[thing.thing_id] = (states_json, edges if edges != loaded[1] else None)
+        self.loaded[thing.thing_id] = (states_json, edges if edges is not None else loaded[1])
+
+    def release(self, thing):
+        # called as a loaded thing is freed
+        try:
+            self.write_back(thing)
+            self.loaded.pop(thing.thing_id, None)
+        except Exception:  # e.g. at interpreter exit
+            pass
+
+    def flush(self):
+        """ Writes all queued changes in one transaction """
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        with self.db:
+            for thing_id, (states_json, edges) in pending.items():
+                self.db.execute("UPDATE things SET states = ? WHERE thing_id = ?", (states_json, thing_id))
+                if edges is not None:
+                    self.db.execute("DELETE FROM relations WHERE x = ?", (thing_id,))
+                    names = session.relations_list
+                    self.db.executemany("INSERT INTO relations VALUES (?, ?, ?)",
+                                        [(thing_id, names[relation], thing_id_y) for relation, thing_id_y in edges])
+        self.writes += len(pending)
+
+    def close(self):
+        """ Writes back every changed thing still in memory, then closes the database """
+        for thing in list(self.live.values()):
+            self.write_back(thing)
+        self.flush()
+        self.db.close()
+
+    def thing_ids(self, kind=None):
+        # all thing_ids in the store (of a kind, e.g. 'portals', if given), in content order
+        if kind is None:
+            return [row[0] for row in self.db.execute("SELECT thing_id FROM things ORDER BY rowid")]
+        return [row[0] for row in self.db.execute("SELECT thing_id FROM things WHERE kind = ? ORDER BY rowid", (kind,))]
+
+    def thing_ids_mentioning(self, text):
+        # thing_ids of things whose record contains text, e.g. '"light"' (a quick filter before loading)
+        return [row[0] for row in self.db.execute(
+            "SELECT thing_id FROM things WHERE instr(record, ?) > 0 ORDER BY rowid", (text,))]
+
+    def portal_rooms(self):
+        # (thing_id, room1 coords, room2 coords) of every portal in the store, read from the records
+        rows = self.db.execute("SELECT thing_id, json_extract(record, '$.room1_thing_id'), "
+                               "json_extract(record, '$.room2_thing_id') FROM things WHERE kind = 'portals' ORDER BY rowid")
+        return [(thing_id, Room.to_coords(room1), Room.to_coords(room2)) for thing_id, room1, room2 in rows]
+
+    def thing_id_by_key(self, kind, key):
+        row = self.db.execute("SELECT thing_id FROM things WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        return None if row is None else row[0]
+
+
+class DescriptionStore:
+    """
+    All description text of a world compiled into one file and memory-mapped, so each string
+    is only read and decoded when Thing.description asks for it.
+    File: header, then the utf-8 text of every description, then an offsets table
+    (string i is text[offsets[i]:offsets[i+1]]), then a json index
+    (key: thing_id, value: {aspect: [first string, string count]}).
+    """
+
+    header = struct.Struct('<8sQQQ')  # magic, offsets position, string count, index position
+    magic = b'TADDESC1'
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, offsets_position, count, index_position = self.header.unpack_from(self.mm, 0)
+        if magic != self.magic:
+            raise Exception("'{}' is not a description store.".format(path))
+        self.offsets = array.array('Q')
+        self.offsets.frombytes(self.mm[offsets_position:offsets_position + 8 * (count + 1)])
+        self.index = json.loads(self.mm[index_position:].decode('utf-8'))
+        self.decoded = 0  # strings decoded so far
+
+    @classmethod
+    def compile(cls, path, content_source):
+        """ Writes the descriptions of all things in the content to a description store file
+
+        :param content_source: directory of the json content files
+        """
+        index = {}
+        offsets = array.array('Q')
+        with open(path, 'wb') as f:
+            f.write(b'\0' * cls.header.size)  # header written last
+            position = cls.header.size
+            for name in content_names[:-1]:
+                for thing_id, thing_dict in iter_content_file(os.path.join(content_source, name + '.json')):
+                    thing_index = {}
+                    for aspect, texts in thing_dict.get('descriptions', {}).items():
+                        thing_index[aspect] = [len(offsets), len(texts)]
+                        for text in texts:
+                            data = text.encode('utf-8')
+                            offsets.append(position)
+                            f.write(data)
+                            position += len(data)
+                    index[thing_dict.get('thing_id', thing_id)] = thing_index
+            offsets.append(position)  # end of the last string
+            count = len(offsets) - 1
+            f.write(offsets.tobytes())
+            index_position = position + 8 * len(offsets)
+            f.write(json.dumps(index).encode('utf-8'))
+            f.seek(0)
+            f.write(cls.header.pack(cls.magic, position, count, index_position))
+
+    @classmethod
+    def open_compiled(cls, path, content_source):
+        """ Opens a description store, (re)compiling it first if any content file is newer """
+        if not os.path.exists(path) or any(
+                os.path.getmtime(os.path.join(content_source, name + '.json')) > os.path.getmtime(path)
+                for name in content_names[:-1]):
+            cls.compile(path, content_source)
+        return cls(path)
+
+    def text(self, i):
+        self.decoded += 1
+        return self.mm[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def descriptions(self, thing_id):
+        """ Gets a thing's descriptions, to be decoded as used (None if the thing isn't in the store) """
+        thing_index = self.index.get(thing_id, None)
+        return None if thing_index is None else LazyDescriptions(self, thing_index)
+
+
+class LazyDescriptions(collections.abc.Mapping):
+    # a thing's descriptions in a DescriptionStore, e.g. descriptions['looks'][0]
+
+    def __init__(self, store, thing_index):
+        self.store = store
+        self.thing_index = thing_index  # key: aspect; value: [first string, string count]
+
+    def __getitem__(self, aspect):
+        first, count = self.thing_index[aspect]
+        return LazyTexts(self.store, first, count)
+
+    def __iter__(self):
+        return iter(self.thing_index)
+
+    def __len__(self):
+        return len(self.thing_index)
+
+
+class LazyTexts(collections.abc.Sequence):
+    # one aspect's descriptions (list index as a time index), decoded when indexed
+
+    def __init__(self, store, first, count):
+        self.store = store
+        self.first = first
+        self.count = count
+
+    def __getitem__(self, time_index):
+        if time_index < 0:
+            time_index += self.count
+        if not 0 <= time_index < self.count:
+            raise IndexError(time_index)
+        return self.store.text(self.first + time_index)
+
+    def __len__(self):
+        return self.count
+
+
+class Containment:
+    """
+    Transitive containment: what a thing is ultimately in, on or with (e.g. a key in a bag the
+    player has), and everything inside a thing, recursively.
+    Each thing's chain of holders is cached; a change to what a thing is in, on or with (or to
+    a player's room) drops the cached chains of that thing and of everything inside it only.
+    """
+
+    holder_relations = (IN, ON, WITH, OF)  # relations to the thing holding X, in order of preference
+
+    def __init__(self, game):
+        self.game = game
+        self.chains = {}  # key: thing; value: tuple of its holders, innermost first (e.g. bag, player, room)
+        self.hits = 0
+        self.misses = 0
+
+    def holder(self, thing):
+        # thing directly holding a thing (a player's room for a player), or None
+        if isinstance(thing, Player):
+            return thing.room
+        relations = thing.relations
+        for R in self.holder_relations:
+            for holder in relations[R]:
+                return holder
+        return None
+
+    def ancestors(self, thing):
+        """ Gets the chain of things holding a thing, e.g. (bag, player, room) for a key in a bag
+
+        :return: tuple of things, innermost first
+        """
+        chain = self.chains.get(thing, None)
+        if chain is not None:
+            self.hits += 1
+            return chain
+        self.misses += 1
+        # walk up to the first holder with a cached chain (or to the top)...
+        uncached = [thing]
+        holder = self.holder(thing)
+        while holder is not None and holder not in self.chains and holder not in uncached:
+            uncached.append(holder)
+            holder = self.holder(holder)
+        chain = () if holder is None or holder in uncached else (holder,) + self.chains[holder]
+        # ...then cache chains on the way back down
+        for thing_x in reversed(uncached):
+            self.chains[thing_x] = chain
+            chain = (thing_x,) + chain
+        return self.chains[thing]
+
+    def holds(self, thing_y, thing_x):
+        """ Is X ultimately held by Y? E.g. holds(player, key) for a key in a bag the player has """
+        return thing_y in self.ancestors(thing_x)
+
+    def contents(self, thing_y):
+        """ Gets everything inside Y, recursively (things in, on or with it, and things in those...)
+
+        :return: set of things
+        """
+        found = set()
+        stack = [thing_y]
+        while stack:
+            for thing in stack.pop().relations[HAS]:
+                if thing not in found and thing is not thing_y:
+                    found.add(thing)
+                    stack.append(thing)
+        return found
+
+    def invalidate(self, thing):
+        # drops cached chains of a thing and everything inside it (a thing's holders are always
+        # cached before it is, so an uncached thing has nothing cached inside it)
+        stack = [thing]
+        while stack:
+            thing = stack.pop()
+            if self.chains.pop(thing, None) is not None:
+                stack.extend(thing.relations[HAS])
+
+    def forget(self, thing):
+        # drops cached chains of a thing and of anything held by it (without loading its relations)
+        for thing_x in [thing_x for thing_x, chain in self.chains.items() if thing_x is thing or thing in chain]:
+            del self.chains[thing_x]
+
+    def on_change(self, change):
+        # change listener (see Game.changed)
+        kind = change[0]
+        if kind == 'room':
+            self.invalidate(change[1])
+        elif (kind == 'relate' or kind == 'unrelate') and change[2] in self.holder_relations:
+            self.invalidate(change[1])
+
+    def clear(self):
+        self.chains = {}
+
+
+class Lighting:
+    """
+    Effective brightness of rooms. A room's own light (its 'brightness' state plus the 'light'
+    quality of light sources in it) spreads to neighbouring rooms, through open portals or
+    open passages (no portal), losing half with each room, down to a cutoff. Each room gets the
+    brightest light reaching it.
+    A room's level is worked out when it is first asked for, from the rooms within reach of it
+    (only those are loaded, on a WorldStore), and kept by coords; after that, a change (a portal
+    opened or closed, a light source moved) only drops the levels of rooms within reach of it.
+    """
+
+    dark = 0.15  # below this, nothing can be seen
+    dim = 0.4  # below this, only outlines can be seen
+    falloff = 0.5  # share of light passing into a neighbouring room
+    cutoff = 0.05  # light below this doesn't spread
+    reach = 5  # most rooms light can spread from its room (own light is at most 1.0)
+
+    def __init__(self, game):
+        self.game = game
+        self.levels = {}  # key: room coords; value: effective brightness (of rooms asked for so far)
+        self.sources = None  # key: light source thing_id; value: coords of room it's lighting (None until first use)
+        self.updates = 0  # incremental updates made
+        self.rooms_updated = 0  # room levels dropped by those updates
+
+    def level(self, room):
+        """ Gets effective brightness of a room (0.0: pitch black) """
+        if self.sources is None:
+            self.find_sources()
+        level = self.levels.get(room.coords, None)
+        if level is None:
+            level = self.levels[room.coords] = self.propagate(room)
+        return level
+
+    def find_sources(self):
+        if self.game.store is not None:  # only load things that might be light sources
+            things = (self.game.things[thing_id] for thing_id in self.game.store.thing_ids_mentioning('"light"'))
+        else:
+            things = self.game.things.values()
+        self.sources = {thing.thing_id: self.coords_of(thing) for thing in things
+                        if thing.qualities and thing.qualities.get('light', 0)}
+
+    def room_of(self, thing):
+        # room a thing is in: directly, or via whatever it's in, on, or with (e.g. a player)
+        if isinstance(thing, Room):
+            return thing
+        for holder in self.game.containment.ancestors(thing):
+            if isinstance(holder, Room):
+                return holder
+        return None
+
+    def coords_of(self, thing):
+        room = self.room_of(thing)
+        return None if room is None else room.coords
+
+    def own_light(self, room):
+        light = room.states.get('brightness', 0.0)
+        light += sum(self.game.things[thing_id].qualities['light']
+                     for thing_id, coords in self.sources.items() if coords == room.coords)
+        return min(light, 1.0)
+
+    def neighbours(self, room):
+        # neighbouring rooms light can pass into, with the share of light that passes
+        y, x = room.coords
+        for coords in ((y - 1, x), (y, x + 1), (y + 1, x), (y, x - 1)):
+            neighbour = self.game.rooms.get(coords, None)
+            if neighbour is None:
+                continue
+            portal = self.game.portal_between(room.coords, coords)
+            if portal is None or portal.states.get('openness', None) == 'open':
+                yield neighbour, self.falloff
+            elif portal.qualities.get('light_transmission', 0.0):  # e.g. frosted glass
+                yield neighbour, self.falloff * portal.qualities['light_transmission']
+
+    def region(self, room):
+        # rooms within reach of a room (through portals open or not): all that light reaching it can come from
+        found = {room}
+        edge = [room]
+        for _ in range(self.reach):
+            next_edge = []
+            for room in edge:
+                y, x = room.coords
+                for coords in ((y - 1, x), (y, x + 1), (y + 1, x), (y, x - 1)):
+                    neighbour = self.game.rooms.get(coords, None)
+                    if neighbour is not None and neighbour not in found:
+                        found.add(neighbour)
+                        next_edge.append(neighbour)
+            edge = next_edge
+        return found
+
+    def propagate(self, target):
+        """ Works out the level of a room, spreading light from the rooms within reach of it
+
+        :return: effective brightness of the room
+        """
+        levels = {}
+        heap = []  # of (-level, sequence number, room): brightest first
+        for room in self.region(target):
+            levels[room] = self.own_light(room)
+            heap.append((-levels[room], len(heap), room))
+        heapq.heapify(heap)
+
+        sequence = len(heap)
+        while heap:
+            level, _, room = heapq.heappop(heap)
+            level = -level
+            if level < levels[room]:  # room has already had brighter light
+                continue
+            if level < self.cutoff:
+                continue
+            for neighbour, share in self.neighbours(room):
+                if neighbour in levels and level * share > levels[neighbour]:
+                    levels[neighbour] = level * share
+                    sequence += 1
+                    heapq.heappush(heap, (-level * share, sequence, neighbour))
+        return levels[target]
+
+    def update(self, coords_list):
+        # drops the levels of rooms within reach of changed rooms (by coords), to be worked out again
+        if not self.levels:
+            return
+        coords_list = [coords for coords in coords_list if coords is not None]
+        dropped = [coords for coords in self.levels
+                   if any(abs(coords[0] - y) + abs(coords[1] - x) <= self.reach for y, x in coords_list)]
+        for coords in dropped:
+            del self.levels[coords]
+        self.updates += 1
+        self.rooms_updated += len(dropped)
+
+    def on_change(self, change):
+        # change listener (see Game.changed)
+        if change[0] == 'state':
+            thing, key = change[1], change[2]
+            if key == 'openness' and isinstance(thing, Portal):
+                self.portal_changed(thing)
+            elif key == 'brightness' and isinstance(thing, Room):
+                self.update([thing.coords])
+        elif change[0] == 'room' or change[2] in Containment.holder_relations:
+            # a thing (or a player) moved: light sources it is or holds may have changed room
+            self.check_sources(change[1])
+
+    def portal_changed(self, portal):
+        self.update([portal.room1_coords, portal.room2_coords])
+
+    def check_sources(self, thing):
+        # moves light sources that have moved to another room with a thing (the thing itself, or
+        # whatever is inside it, e.g. a torch in a bag the player carries)
+        if not self.sources:
+            return
+        for source in [thing] + list(self.game.containment.contents(thing)):
+            old_coords = self.sources.get(source.thing_id, Game.missing)
+            if old_coords is Game.missing:
+                continue
+            new_coords = self.coords_of(source)
+            if new_coords != old_coords:
+                self.sources[source.thing_id] = new_coords
+                self.update([old_coords, new_coords])
+
+    def clear(self):
+        # drop levels and sources, to be worked out again on next use (e.g. after content is reloaded)
+        self.levels = {}
+        self.sources = None
+
+
+class Acoustics:
+    """
+    What can be heard from a room. Sound from a room (its 'loudness' quality) spreads to
+    neighbouring rooms through open portals or open passages (no portal), losing half with each
+    room, out to a reach. The rooms reachable from a room, with their attenuation, are worked
+    out when it is first listened from; after that, a portal opening or closing only drops the
+    results of rooms that reached it.
+    """
+
+    falloff = 0.5  # share of sound passing into a neighbouring room
+    cutoff = 0.1  # sound below this can't be heard
+    reach = 3  # most rooms sound can spread from its room
+    directions = {(-1, 0): 'north', (0, 1): 'east', (1, 0): 'south', (0, -1): 'west'}  # by coords delta
+
+    def __init__(self, game):
+        self.game = game
+        self.reachable = {}  # key: room; value: dict (key: room reached; value: (attenuation, direction heard from))
+        self.listeners = {}  # key: room; value: set of rooms that reached it (whose results it can change)
+        self.searches = 0  # room graph searches made
+
+    def neighbours(self, room):
+        # rooms sound passes into from a room, with the direction of each
+        y, x = room.coords
+        for (dy, dx), direction in self.directions.items():
+            coords = (y + dy, x + dx)
+            neighbour = self.game.rooms.get(coords, None)
+            if neighbour is None:
+                continue
+            portal = self.game.portal_between(room.coords, coords)
+            if portal is None or portal.states.get('openness', None) == 'open':
+                yield neighbour, direction
+
+    def reach_from(self, room):
+        """ Gets the rooms sound can reach a room from
+
+        :return: dict, key: room; value: tuple (attenuation, direction heard from), e.g. (0.25, 'south')
+        """
+        reachable = self.reachable.get(room, None)
+        if reachable is not None:
+            return reachable
+        self.searches += 1
+        reachable = {room: (1.0, None)}
+        edge = [(room, None)]
+        attenuation = 1.0
+        for _ in range(self.reach):
+            attenuation *= self.falloff
+            next_edge = []
+            for edge_room, direction in edge:
+                for neighbour, step in self.neighbours(edge_room):
+                    if neighbour not in reachable:
+                        reachable[neighbour] = (attenuation, direction or step)
+                        next_edge.append((neighbour, direction or step))
+            edge = next_edge
+        self.reachable[room] = reachable
+        for reached in reachable:
+            self.listeners.setdefault(reached, set()).add(room)
+        return reachable
+
+    def heard(self, room):
+        """ Gets sounds from other rooms that can be heard in a room, loudest first
+
+        :return: list of tuples (room heard, level, direction heard from)
+        """
+        heard = []
+        for other, (attenuation, direction) in self.reach_from(room).items():
+            level = other.qualities.get('loudness', 0.0) * attenuation
+            if other is not room and level >= self.cutoff:
+                heard.append((other, level, direction))
+        heard.sort(key=lambda sound: -sound[1])
+        return heard
+
+    def on_change(self, change):
+        # change listener (see Game.changed)
+        if change[0] == 'state' and change[2] == 'openness' and isinstance(change[1], Portal):
+            self.portal_changed(change[1])
+
+    def portal_changed(self, portal):
+        # only rooms that reached either side of the portal can reach differently now
+        for room in (portal.room1, portal.room2):
+            self.forget(room)
+
+    def forget(self, room):
+        # drops the results of rooms that reached a room (its own included)
+        for listener in self.listeners.pop(room, ()):
+            for reached in self.reachable.pop(listener, ()):
+                listeners = self.listeners.get(reached, None)
+                if listeners is not None:
+                    listeners.discard(listener)
+
+    def clear(self):
+        self.reachable = {}
+        self.listeners = {}
+
+
+class Triggers:
+    """
+    Puzzle rules from content ('triggers'), e.g. when the key is in the lock, unlock the door:
+        "tr_0001": {
+            "when": [{"thing": "it_0014", "relation": "in", "other": "fx_0010"},
+                     {"thing": "po_0001", "state": "openness", "is": "locked"}],
+            "then": [{"thing": "po_0001", "state": "openness", "to": "closed"}],
+            "message": "Click! The door unlocks."
+        }
+    A condition is a relation (thing-relation-other) or a state (thing's state is a value), and
+    holds the other way round with "not": true. A rule fires when a change makes one of its
+    conditions hold while the others already do (so not for conditions holding at the start),
+    setting the states in its actions. Conditions are indexed by the relation or state they
+    watch, so a change only looks at the rules that mention it, however many rules there are.
+    """
+
+    max_firings = 1000  # most rules fired by one change (more means rules are setting each other off)
+
+    def __init__(self, game):
+        self.game = game
+        self.rules = {}  # key: rule_id; value: tuple (conditions, actions, message)
+        # conditions: list of ('relation', thing_id, relation id, thing_id_other, not) or
+        #   ('state', thing_id, key, value, not); actions: list of (thing_id, key, value)
+        self.index = {}  # key: (thing_id, relation id, thing_id_other) or (thing_id, key); value: list of (rule_id, condition)
+        self.due = collections.deque()  # rule_ids to check and fire (see run)
+        self.running = False
+        self.paused = False  # True while changes shouldn't fire rules (e.g. going back to a state already reached)
+        self.checks = 0  # rules looked at because of a change
+        self.firings = 0
+
+    def load(self, json_dict):
+        """ Compiles rules from trigger content
+
+        :param json_dict: e.g. {'tr_0001': {'when': [...], 'then': [...], 'message': '...'}, ...}
+        """
+        things = self.game.things
+        self.rules = {}
+        self.index = {}
+        for rule_id, rule_dict in json_dict.items():
+            conditions = []
+            for condition_dict in rule_dict['when']:
+                if 'relation' in condition_dict:
+                    relation = session.relation_ids.get(condition_dict['relation'], None)
+                    if relation is None:
+                        msg = "(DEV) Trigger '{}': I don't know the relation '{}'.".format(
+                            rule_id, condition_dict['relation'])
+                        raise Exception(msg)
+                    condition = ('relation', condition_dict['thing'], relation, condition_dict['other'],
+                                 condition_dict.get('not', False))
+                    key = condition[1:4]
+                else:
+                    condition = ('state', condition_dict['thing'], condition_dict['state'], condition_dict['is'],
+                                 condition_dict.get('not', False))
+                    key = condition[1:3]
+                conditions.append(condition)
+                self.index.setdefault(key, []).append((rule_id, condition))
+            actions = [(action_dict['thing'], action_dict['state'], action_dict['to'])
+                       for action_dict in rule_dict.get('then', [])]
+            for thing_id in [condition[1] for condition in conditions] + [
+                    condition[3] for condition in conditions if condition[0] == 'relation'] + [
+                    action[0] for action in actions]:
+                if thing_id not in things:
+                    msg = "(DEV) Trigger '{}': '{}' is not a known thing.".format(rule_id, thing_id)
+                    raise Exception(msg)
+            self.rules[rule_id] = (conditions, actions, rule_dict.get('message', None))
+
+    def holds(self, condition):
+        # does a condition hold now?
+        things = self.game.things
+        if condition[0] == 'relation':
+            held = things[condition[3]] in things[condition[1]].relations[condition[2]]
+        else:
+            held = things[condition[1]].states.get(condition[2], Game.missing) == condition[3]
+        return held != condition[4]
+
+    def on_change(self, change):
+        # change listener (see Game.changed): notes the rules a change may fire (run fires them)
+        game = self.game
+        if self.paused or game.history.replaying or (game.journal is not None and game.journal.restoring):
+            return  # (undoing, redoing or restoring makes changes already made, triggered ones included)
+        kind = change[0]
+        if kind in ('relate', 'unrelate'):
+            for rule_id, condition in self.index.get((change[1].thing_id, change[2], change[3].thing_id), ()):
+                self.checks += 1
+                if (kind == 'relate') != condition[4]:  # (the change made it hold)
+                    self.due.append(rule_id)
+        elif kind == 'state':
+            for rule_id, condition in self.index.get((change[1].thing_id, change[2]), ()):
+                self.checks += 1
+                held = (change[3] == condition[3]) != condition[4]
+                if not held and (change[4] == condition[3]) != condition[4]:
+                    self.due.append(rule_id)
+
+    def run(self):
+        """ Fires the rules due (see on_change), and any their actions set off, in turn """
+        if self.running:
+            return  # (rules set off by actions are fired by the run already going)
+        self.running = True
+        try:
+            firings = 0
+            while self.due:
+                conditions, actions, message = self.rules[self.due.popleft()]
+                if not all(self.holds(condition) for condition in conditions):
+                    continue
+                firings += 1
+                if firings > self.max_firings:
+                    msg = "(DEV) Trigger rules fired more than {} times from one change.".format(self.max_firings)
+                    raise Exception(msg)
+                self.firings += 1
+                if message:
+                    session.printw(message)
+                for thing_id, key, value in actions:
+                    self.game.set_state(self.game.things[thing_id], key, value)
+        finally:
+            self.due.clear()
+            self.running = False
+
+
+class Connection:
+    """
+    A player's connection (e.g. a socket, for a server): a file-like output sink for the player's
+    own output, queued as messages until the server takes them (see drain). The queue is bounded
+    (backpressure): once it's full, messages broadcast by others are dropped (and counted), and
+    the player's commands are held back (see Broadcasts.command) until it's drained.
+    """
+
+    def __init__(self, player, max_queued=100):
+        """
+        :param player: player (or agent) whose output this is
+        :param max_queued: most messages to queue
+        """
+        self.player = player
+        self.max_queued = max_queued
+        self.queue = collections.deque()  # of message texts
+        self.dropped = 0  # messages broadcast to it while it was full
+
+    def write(self, text):
+        # the player's own output (always kept: commands stop being taken while the queue is full)
+        self.queue.append(text)
+
+    def flush(self):
+        pass
+
+    def offer(self, text):
+        """ Queues a message broadcast by others, unless the queue is full
+
+        :return: True if queued, else None
+        """
+        if len(self.queue) >= self.max_queued:
+            self.dropped += 1
+            return None
+        self.queue.append(text)
+        return True
+
+    @property
+    def full(self):
+        return len(self.queue) >= self.max_queued
+
+    def drain(self):
+        """ Takes everything queued
+
+        :return: text
+        """
+        text = ''.join(self.queue)
+        self.queue.clear()
+        return text
+
+
+class Broadcasts:
+    """
+    What players see of each other. Connections (see connect) are kept in sets by the room their
+    player is in, moved as players move (a change listener), so a broadcast goes only to the
+    connections in one room: its cost depends on the room's population, not on how many players
+    are connected. Players (and agents) are seen doing things by the others in the room (see
+    report), and coming into it.
+    """
+
+    # third person of verbs others see being done, by verb function name
+    verbs_seen = {'look': 'looks', 'go': 'goes', 'put': 'puts', 'get': 'gets', 'drop': 'drops',
+                  'listen': 'listens', 'open': 'opens', 'close': 'closes'}
+
+    def __init__(self, game):
+        self.game = game
+        self.rooms = {}  # key: room; value: set of connections of players in it
+        self.connections = {}  # key: player; value: connection
+        self.deliveries = 0  # messages queued for others
+
+    def connect(self, player, max_queued=100):
+        """ Makes a connection for a player (see Connection), to send its output to and broadcast to
+
+        :return: the connection
+        """
+        if self.game.journal is not None:  # (a player joining after restoring gets back what it had)
+            self.game.journal.add(player)
+        connection = Connection(player, max_queued)
+        self.connections[player] = connection
+        self.rooms.setdefault(player.room, set()).add(connection)
+        return connection
+
+    def disconnect(self, connection):
+        self.connections.pop(connection.player, None)
+        subscribers = self.rooms.get(connection.player.room, None)
+        if subscribers is not None:
+            subscribers.discard(connection)
+            if not subscribers:
+                del self.rooms[connection.player.room]
+
+    def command(self, connection, command_line):
+        """ Runs a command line for a connected player, with its output queued on its connection
+
+        :return: True if it succeeded, None if it failed, or False if it was held back (the
+            connection's queue is full: drain it first)
+        """
+        if connection.full:
+            return False
+        with session.redirect(connection):
+            return connection.player.command_parse(command_line)
+
+    def broadcast(self, room, msg, exclude=None):
+        """ Sends a message to the players in a room (but not to exclude, e.g. the player it's about)
+
+        :return: number of connections it was queued for
+        """
+        subscribers = self.rooms.get(room, None)
+        if not subscribers:
+            return 0
+        text = session.wrapped(msg)  # (wrapped once for all of them)
+        queued = 0
+        for connection in subscribers:
+            if connection.player is not exclude and connection.offer(text):
+                queued += 1
+        self.deliveries += queued
+        return queued
+
+    def report(self, actor, room, verb_fn, words):
+        # lets others in the room see a command done, e.g. 'Alice puts key on bed.' (see Player.run_command)
+        verb = self.verbs_seen.get(verb_fn.__name__, None)
+        if verb is not None and self.rooms.get(room, None):
+            self.broadcast(room, "{} {}.".format(actor.name, ' '.join([verb] + words)), exclude=actor)
+
+    def on_change(self, change):
+        # change listener (see Game.changed): moves a connected player's connection with it
+        if change[0] != 'room':
+            return
+        player, old_room, new_room = change[1:]
+        connection = self.connections.get(player, None)
+        if connection is not None:
+            subscribers = self.rooms.get(old_room, None)
+            if subscribers is not None:
+                subscribers.discard(connection)
+                if not subscribers:
+                    del self.rooms[old_room]
+        self.broadcast(new_room, "{} comes in.".format(player.name), exclude=player)
+        if connection is not None:
+            self.rooms.setdefault(new_room, set()).add(connection)
+
+
+class Metrics:
+    """
+    Live engine numbers: counters, latency histograms, and gauges.
+    Recording is a dict update and a bisect, so it's cheap enough to leave on.
+    Export is in Prometheus' text format, on demand (export), over a local HTTP or Unix socket
+    endpoint (serve), or to a file every so often (dump_every).
+    Gauges read the world, which only the game's thread may touch (e.g. a WorldStore's SQLite
+    connection), so they are sampled there: as commands are recorded, at most every
+    sample_seconds, and whenever export runs on that thread. Exports on other threads give the
+    last sample.
+    """
+
+    prefix = 'tadventure_'
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)  # seconds
+    quantiles = (0.5, 0.9, 0.99)
+    rate_window = 60.0  # seconds over which commands per second is worked out
+    sample_seconds = 5.0  # most time between samples of the gauges while commands are run
+
+    def __init__(self):
+        self.lock = threading.Lock()  # exports may run on another thread
+        self.thread = threading.get_ident()  # the game's thread (see sample)
+        self.counters = {}  # key: (name, labels); labels: tuple of (label, value) pairs
+        self.histograms = {}  # key: (name, labels); value: list of bucket counts (last: +Inf), count, sum
+        self.gauges = {}  # key: name; value: (help, function giving a number, or a dict of labels: number, live)
+        self.samples = {}  # key: gauge name; value: number or dict, as last sampled
+        self.sampled_at = None  # time of the last sample
+        self.recent_commands = collections.deque(maxlen=10000)  # times of recent commands
+
+    def count(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, labels=()):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0, 0.0]
+            histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    def gauge(self, name, help_text, function, live=False):
+        """
+        :param function: gives the gauge's number (or a dict, key: labels; value: number)
+        :param live: True if function is safe to call from any thread (it's then called as
+            exported, rather than sampled on the game's thread)
+        """
+        self.gauges[name] = (help_text, function, live)
+
+    def sample(self):
+        """ Reads the gauges that aren't live (on the game's thread), for exports to give """
+        samples = {}
+        for name, (help_text, function, live) in self.gauges.items():
+            if not live:
+                try:
+                    samples[name] = function()
+                except Exception as e:  # (a broken gauge shouldn't stop play)
+                    print("(DEV) Metrics: gauge '{}' failed: {!r}".format(name, e), file=sys.stderr)
+        with self.lock:
+            self.samples = samples
+        self.sampled_at = time.perf_counter()
+
+    def command(self, verb, seconds):
+        # records a command run (see Player.command_parse)
+        labels = (('verb', verb),)
+        self.count('commands_total', labels)
+        self.observe('command_latency_seconds', seconds, labels)
+        with self.lock:
+            self.recent_commands.append(time.time())
+        if self.sampled_at is None or time.perf_counter() - self.sampled_at >= self.sample_seconds:
+            self.sample()
+
+    def commands_per_second(self):
+        since = time.time() - self.rate_window
+        with self.lock:
+            return sum(1 for t in self.recent_commands if t >= since) / self.rate_window
+
+    def quantile(self, histogram, q):
+        # estimates a quantile from histogram buckets (linear within a bucket)
+        count = histogram[-2]
+        if count == 0:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(histogram[:-2]):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    @staticmethod
+    def label_text(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(label, value) for label, value in labels) + '}'
+
+    def export(self):
+        """ Gets all metrics as text, in Prometheus' text exposition format """
+        if threading.get_ident() == self.thread:  # on the game's thread: gauges can be read now
+            self.sample()
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(histogram) for key, histogram in self.histograms.items()}
+            samples = dict(self.samples)
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append('# TYPE {}{} counter'.format(self.prefix, name))
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append('{}{}{} {}'.format(self.prefix, name, self.label_text(labels), value))
+        for name in sorted({name for name, _ in histograms}):
+            lines.append('# TYPE {}{} histogram'.format(self.prefix, name))
+            for (histogram_name, labels), histogram in sorted(histograms.items()):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), histogram[:-2]):
+                    cumulative += bucket_count
+                    lines.append('{}{}_bucket{} {}'.format(
+                        self.prefix, name, self.label_text(labels + (('le', bound),)), cumulative))
+                lines.append('{}{}_sum{} {}'.format(self.prefix, name, self.label_text(labels), histogram[-1]))
+                lines.append('{}{}_count{} {}'.format(self.prefix, name, self.label_text(labels), histogram[-2]))
+            lines.append('# TYPE {}{}_quantile gauge'.format(self.prefix, name))
+            for (histogram_name, labels), histogram in sorted(histograms.items()):
+                if histogram_name == name:
+                    for q in self.quantiles:
+                        lines.append('{}{}_quantile{} {:.6f}'.format(
+                            self.prefix, name, self.label_text(labels + (('quantile', q),)), self.quantile(histogram, q)))
+        for name, (help_text, function, live) in sorted(self.gauges.items()):
+            if live:
+                value = function()
+            elif name in samples:
+                value = samples[name]
+            else:  # not sampled yet (or its gauge failed)
+                continue
+            lines.append('# HELP {}{} {}'.format(self.prefix, name, help_text))
+            lines.append('# TYPE {}{} gauge'.format(self.prefix, name))
+            values = value.items() if isinstance(value, dict) else [((), value)]
+            for labels, number in values:
+                lines.append('{}{}{} {}'.format(self.prefix, name, self.label_text(labels), number))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, address=('127.0.0.1', 9100)):
+        """ Serves export over a local endpoint, on a background thread
+
+        :param address: (host, port) for HTTP (any path), or a Unix socket path, e.g. '/tmp/tadventure.sock'
+        :return: the server (call shutdown() to stop it)
+        """
+        import socketserver  # only needed when serving
+        metrics = self
+
+        if isinstance(address, str):
+            class Handler(socketserver.StreamRequestHandler):
+                def handle(self):
+                    try:
+                        self.wfile.write(metrics.export().encode('utf-8'))
+                    except Exception as e:
+                        print("(DEV) Metrics: export failed: {!r}".format(e), file=sys.stderr)
+            if os.path.exists(address):
+                os.remove(address)
+            server = socketserver.ThreadingUnixStreamServer(address, Handler)
+        else:
+            import http.server
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    try:
+                        body = metrics.export().encode('utf-8')
+                    except Exception as e:
+                        print("(DEV) Metrics: export failed: {!r}".format(e), file=sys.stderr)
+                        self.send_error(500)
+                        return
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):  # keep requests out of the game's output
+                    pass
+            server = http.server.ThreadingHTTPServer(address, Handler)
+        self.sample()  # (so the first export has gauges)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def dump_every(self, path, seconds=10.0):
+        """ Writes export to a file every so many seconds, on a background thread
+
+        :return: threading.Event; set it to stop dumping
+        """
+        stop = threading.Event()
+
+        def dump():
+            while not stop.wait(seconds):
+                try:
+                    self.dump(path)
+                except Exception as e:  # (keep dumping: e.g. the disk may have been full this time)
+                    print("(DEV) Metrics: dump to '{}' failed: {!r}".format(path, e), file=sys.stderr)
+        self.sample()  # (so the first dump has gauges)
+        threading.Thread(target=dump, daemon=True).start()
+        return stop
+
+    def dump(self, path):
+        # (written to a temporary file first, so readers never see half a dump)
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.export())
+        os.replace(path + '.tmp', path)
+
+
+class History:
+    """
+    Undo and redo for the player's commands. The changes a command makes (see Game.changed)
+    are kept as a list of small deltas, so undoing a command costs time in proportion to what
+    it changed, and memory grows only with the deltas kept.
+    Others (agents, other players) change the world too, so a command is only undone (or redone)
+    if what it changed is still as it left it (see changed_since); if not, it is dropped instead.
+    Deltas name things by thing_id (see compact), so the history doesn't keep things in memory
+    (e.g. things a WorldStore has let go of).
+    """
+
+    thing_places = {'relate': (1, 3), 'unrelate': (1, 3), 'state': (1,), 'room': (1, 2, 3)}  # of things in changes
+
+    def __init__(self, game, max_commands=1000):
+        self.game = game
+        self.undo_stack = collections.deque(maxlen=max_commands)  # of (command phrase, changes)
+        self.redo_stack = []
+        self.current = None  # (command phrase, changes) of the command being run
+        self.replaying = False  # True while undoing or redoing (changes made then aren't kept)
+
+    def begin(self, command_phrase):
+        self.current = (command_phrase, [])
+
+    def end(self):
+        if self.current is not None and self.current[1]:  # (commands that changed nothing aren't kept)
+            self.undo_stack.append(self.current)
+            self.redo_stack.clear()
+        self.current = None
+
+    def on_change(self, change):
+        # change listener (see Game.changed)
+        if self.current is not None and not self.replaying:
+            self.current[1].append(self.compact(change))
+
+    def compact(self, change):
+        # a change tuple with thing_ids in place of things (a room may be None)
+        places = self.thing_places[change[0]]
+        return tuple(item.thing_id if i in places and item is not None else item for i, item in enumerate(change))
+
+    def expand(self, changes):
+        """ Changes with things in place of thing_ids (see compact)
+
+        :return: list of change tuples, or None if a thing is no longer in the world
+        """
+        things = self.game.things
+        expanded = []
+        for change in changes:
+            places = self.thing_places[change[0]]
+            if not all(change[i] is None or change[i] in things for i in places):
+                return None
+            expanded.append(tuple(things[item] if i in places and item is not None else item
+                                  for i, item in enumerate(change)))
+        return expanded
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+
+    @staticmethod
+    def inverse(change):
+        kind = change[0]
+        if kind == 'relate':
+            return ('unrelate',) + change[1:]
+        if kind == 'unrelate':
+            return ('relate',) + change[1:]
+        # 'state' or 'room': swap old and new
+        return change[:-2] + (change[-1], change[-2])
+
+    def changed_since(self, changes):
+        """ Checks whether anything the changes touched has changed since they were made
+
+        :param changes: list of changes, in the order made
+        :return: True if any edge, state or player's room isn't as the changes left it
+        """
+        left = {}  # key: what was changed; value: what the last change to it left
+        for change in changes:
+            kind = change[0]
+            if kind in ('relate', 'unrelate'):
+                left[change[1:]] = kind == 'relate'
+            elif kind == 'state':
+                left[('state', change[1], change[2])] = change[4]
+            else:  # 'room'
+                left[('room', change[1])] = change[3]
+        for key, value in left.items():
+            if key[0] == 'state':
+                now = key[1].states.get(key[2], Game.missing)
+                if now is not value and now != value:
+                    return True
+            elif key[0] == 'room':
+                if key[1].room is not value:
+                    return True
+            elif (key[2] in key[0].relations[key[1]]) != value:
+                return True
+        return False
+
+    def replay(self, changes):
+        self.replaying = True
+        try:
+            for change in changes:
+                self.game.apply(change)
+        finally:
+            self.replaying = False
+
+    def undo(self):
+        """ Undoes the last command that changed anything
+
+        :return: the command phrase undone, e.g. 'get key'; None if there's nothing to undo; or
+            False if what it changed has changed since (e.g. an agent took the key): it is dropped
+        """
+        if not self.undo_stack:
+            return None
+        command_phrase, changes = self.undo_stack.pop()
+        expanded = self.expand(changes)
+        if expanded is None or self.changed_since(expanded):
+            return False
+        self.replay([self.inverse(change) for change in reversed(expanded)])
+        self.redo_stack.append((command_phrase, changes))
+        return command_phrase
+
+    def redo(self):
+        """ Redoes the last command undone
+
+        :return: the command phrase redone; None if there's nothing to redo; or False if what it
+            changed has changed since it was undone: it is dropped
+        """
+        if not self.redo_stack:
+            return None
+        command_phrase, changes = self.redo_stack.pop()
+        expanded = self.expand(changes)
+        if expanded is None or self.changed_since([self.inverse(change) for change in reversed(expanded)]):
+            return False
+        self.replay(expanded)
+        self.undo_stack.append((command_phrase, changes))
+        return command_phrase
+
+
+class Journal:
+    """
+    Saving as play goes, in two files: an append-only journal of the changes each command made
+    (see Game.changed), and a checkpoint of the world's net changes from its content, rewritten
+    every so often so the journal can start afresh. Restoring loads the checkpoint over the
+    content, then replays the journal's tail.
+    Journal records are written in groups (group commit): one write and fsync once group_commands
+    commands are waiting, or, as a command ends, if the first waiting has waited group_seconds
+    (there's no timer: while play is idle, waiting commands stay waiting until close), so a crash
+    loses fewer than group_commands commands. Saving
+    a command costs time in proportion to what it changed; restoring costs a checkpoint (no
+    bigger than the world's net changes, since changes undone cancel out) and at most
+    checkpoint_commands commands of journal.
+    Saved changes about things not in the world when restoring (e.g. agents, added by whoever runs
+    the game after it is restored) wait until the things are added back (see add), so whatever
+    an agent held comes back with the agent.
+    """
+
+    def __init__(self, game, path, group_commands=20, group_seconds=1.0, checkpoint_commands=1000):
+        """
+        :param path: save path without extension, e.g. 'save' (for 'save.journal' and 'save.checkpoint')
+        :param group_commands: most commands to keep before writing them
+        :param group_seconds: longest to keep a command before writing it (checked as commands end)
+        :param checkpoint_commands: commands to journal between checkpoints
+        """
+        self.game = game
+        self.journal_path = path + '.journal'
+        self.checkpoint_path = path + '.checkpoint'
+        self.group_commands = group_commands
+        self.group_seconds = group_seconds
+        self.checkpoint_commands = checkpoint_commands
+        self.file = None  # the journal, open for appending (once restored)
+        self.restoring = False  # True while restoring (changes made then are already saved)
+        self.waiting = []  # saved changes (as json lists) about things not in the world (see add)
+        self.adding = False  # True while making waiting changes (already saved and counted)
+        self.seq = 0  # number of the last command recorded
+        self.checkpoint_seq = 0  # number of the last command in the checkpoint
+        self.changes = []  # changes (as json lists, see encode) made since the last command was recorded
+        self.pending = []  # records (lines of json) not yet written
+        self.pending_since = None  # time the first of them was made
+        # net changes from the content (see checkpoint)
+        self.edges = {}  # key: (thing_id_x, relation name, thing_id_y); value: True if added, False if removed
+        self.states = {}  # key: (thing_id, key); value: [value in the content, value now] (each as in encode)
+        self.rooms = {}  # key: (player (or agent) thing_id,); value: [first room thing_id, room thing_id now]
+        self.writes = 0
+        self.checkpoints = 0
+
+    @staticmethod
+    def encode(change):
+        """ A change tuple as a json list, e.g. ['relate', 'it_0001', 'in', 'fu_0003'];
+        state values are wrapped in a list ([] for a missing state), room ids may be None
+        """
+        kind = change[0]
+        if kind == 'state':
+            return [kind, change[1].thing_id, change[2]] + [
+                [] if value is Game.missing else [value] for value in change[3:]]
+        if kind == 'room':
+            return [kind, change[1].thing_id] + [
+                None if room is None else room.thing_id for room in change[2:]]
+        return [kind, change[1].thing_id, session.relations_list[change[2]], change[3].thing_id]
+
+    def decode(self, change):
+        """ A change tuple from a json list (see encode)
+
+        :return: change tuple, or None if it's about a thing not in the world (e.g. an agent not added)
+        """
+        things = self.game.things
+        kind = change[0]
+        thing_ids = [change[1]] + ([change[3]] if kind in ('relate', 'unrelate') else
+                                   [room_id for room_id in change[2:] if kind == 'room' and room_id is not None])
+        if not all(thing_id in things for thing_id in thing_ids):
+            return None
+        if kind == 'state':
+            return (kind, things[change[1]], change[2]) + tuple(
+                value[0] if value else Game.missing for value in change[3:])
+        if kind == 'room':
+            return (kind, things[change[1]]) + tuple(
+                None if room_id is None else things[room_id] for room_id in change[2:])
+        return (kind, things[change[1]], session.relation_ids[change[2]], things[change[3]])
+
+    def on_change(self, change):
+        # change listener (see Game.changed)
+        if self.adding:
+            return
+        encoded = self.encode(change)
+        if not self.restoring:
+            self.changes.append(encoded)
+        self.count(encoded)
+
+    def count(self, encoded):
+        # counts a change (as a json list) in the net changes from the content
+        kind = encoded[0]
+        if kind in ('relate', 'unrelate'):
+            # a relation is either back as in the content, or now added (or removed)
+            edge = tuple(encoded[1:])
+            if edge in self.edges:
+                del self.edges[edge]
+            else:
+                self.edges[edge] = (kind == 'relate')
+        else:
+            # 'state' or 'room': keep the first value and the value now, unless they're the same
+            net = self.states if kind == 'state' else self.rooms
+            key = tuple(encoded[1:-2])
+            first = net[key][0] if key in net else encoded[-2]
+            if first == encoded[-1]:
+                net.pop(key, None)
+            else:
+                net[key] = [first, encoded[-1]]
+
+    def end(self, command_phrase):
+        """ Records the changes made by a command (if any), writing records and a checkpoint when due """
+        started = time.perf_counter()
+        if self.changes:
+            self.seq += 1
+            record = {'seq': self.seq, 'command': command_phrase, 'changes': self.changes}
+            self.pending.append(json.dumps(record))
+            self.changes = []
+            if self.pending_since is None:
+                self.pending_since = time.time()
+        if self.pending and (len(self.pending) >= self.group_commands
+                             or time.time() - self.pending_since >= self.group_seconds):
+            self.commit()
+        if self.seq - self.checkpoint_seq >= self.checkpoint_commands:
+            self.checkpoint()
+        self.game.metrics.observe('save_seconds', time.perf_counter() - started)
+
+    def commit(self):
+        # writes the pending records to the journal, and makes sure they're on disk
+        if self.pending:
+            self.file.write('\n'.join(self.pending) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending = []
+            self.pending_since = None
+            self.writes += 1
+
+    def checkpoint(self):
+        """ Writes the world's net changes from its content (replacing the last checkpoint), then
+        empties the journal (if interrupted in between, the records in the checkpoint are skipped
+        on restoring)
+        """
+        self.commit()
+        checkpoint = {
+            'seq': self.seq,
+            'edges': [list(edge) + [added] for edge, added in self.edges.items()],
+            'states': [list(key) + [now] for key, (first, now) in self.states.items()],
+            'rooms': [list(key) + [now] for key, (first, now) in self.rooms.items()]
+        }
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.checkpoint_path)  # (so a checkpoint is never half written)
+        self.checkpoint_seq = self.seq
+        self.file.seek(0)
+        self.file.truncate()
+        os.fsync(self.file.fileno())
+        self.checkpoints += 1
+
+    def restore(self):
+        """ Makes the saved changes (if any) to the world as loaded from its content: the checkpoint,
+        then the journal's records after it (up to the first not completely written), then opens the
+        journal to record more
+
+        :return: dict report: 'checkpoint' (commands in it), 'replayed' (journal records),
+            'waiting' (changes about things not in the world, see add), 'seconds'
+        """
+        started = time.perf_counter()
+        game = self.game
+        report = {'checkpoint': 0, 'replayed': 0, 'waiting': 0}
+        changes = []
+        self.restoring = True
+        try:
+            if os.path.exists(self.checkpoint_path):
+                with open(self.checkpoint_path, 'r') as f:
+                    checkpoint = json.load(f)
+                self.seq = self.checkpoint_seq = report['checkpoint'] = checkpoint['seq']
+                for thing_id_x, relation, thing_id_y, added in checkpoint['edges']:
+                    changes.append(['relate' if added else 'unrelate', thing_id_x, relation, thing_id_y])
+                for thing_id, key, now in checkpoint['states']:
+                    changes.append(['state', thing_id, key, None, now])
+                for thing_id, now in checkpoint['rooms']:
+                    changes.append(['room', thing_id, None, now])
+
+            good_bytes = 0  # journal length up to the last whole record
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'rb') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            break  # (the rest was being written when play stopped)
+                        if not line.endswith(b'\n'):
+                            break
+                        good_bytes += len(line)
+                        if record['seq'] > self.seq:
+                            self.seq = record['seq']
+                            changes.extend(record['changes'])
+                            report['replayed'] += 1
+
+            for change in changes:
+                decoded = self.decode(change)
+                if decoded is None:
+                    self.waiting.append(change)
+                    self.count(change)
+                    report['waiting'] += 1
+                else:
+                    game.apply(decoded)
+        finally:
+            self.restoring = False
+
+        self.file = open(self.journal_path, 'a')
+        self.file.truncate(good_bytes)  # (drops a record left half written)
+        report['seconds'] = game.timings['restore'] = time.perf_counter() - started
+        return report
+
+    def add(self, thing):
+        """ Makes the saved changes that were waiting for a thing added since restoring (e.g. an
+        agent's room, and what it held), once the other things they are about are in the world too
+        """
+        if not self.waiting:
+            return
+        waiting = self.waiting
+        self.waiting = []
+        self.restoring = self.adding = True
+        try:
+            for change in waiting:
+                decoded = self.decode(change)
+                if decoded is None:
+                    self.waiting.append(change)
+                else:
+                    self.game.apply(decoded)
+        finally:
+            self.restoring = self.adding = False
+
+    def discard(self):
+        # deletes the saved play (to start a new game)
+        for path in (self.journal_path, self.checkpoint_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        self.commit()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class StoreThings(collections.abc.MutableMapping):
+    # Game.things for a game on a WorldStore: stored things load on access;
+    # things not from the store (e.g. the player) are simply kept
+
+    def __init__(self, store):
+        self.store = store
+        self.kept = {}  # key: thing_id
+
+    def __getitem__(self, thing_id):
+        thing = self.kept.get(thing_id, None)
+        if thing is None:
+            thing = self.store.get(thing_id)
+            if thing is None:
+                raise KeyError(thing_id)
+        return thing
+
+    def __setitem__(self, thing_id, thing):
+        if thing_id in self.store.loaded or thing_id in self.store:
+            self.store.add(thing)
+        else:
+            self.kept[thing_id] = thing
+
+    def __delitem__(self, thing_id):
+        if thing_id in self.kept:
+            del self.kept[thing_id]
+            return
+        thing = self.store.live.pop(thing_id, None)
+        if thing is not None:
+            thing.store = None
+        if thing_id in self.store.resident:
+            self.store.resident_bytes -= self.store.resident.pop(thing_id)[1]
+        self.store.loaded.pop(thing_id, None)
+        self.store.pending.pop(thing_id, None)
+        with self.store.db:
+            self.store.db.execute("DELETE FROM things WHERE thing_id = ?", (thing_id,))
+            self.store.db.execute("DELETE FROM relations WHERE x = ? OR y = ?", (thing_id, thing_id))
+            self.store.db.execute("DELETE FROM names WHERE thing_id = ?", (thing_id,))
+
+    def __contains__(self, thing_id):
+        return thing_id in self.kept or thing_id in self.store.live or thing_id in self.store
+
+    def __iter__(self):
+        yield from self.store.thing_ids()
+        yield from list(self.kept)
+
+    def __len__(self):
+        return self.store.db.execute("SELECT COUNT(*) FROM things").fetchone()[0] + len(self.kept)
+
+
+class StoreKind(collections.abc.Mapping):
+    # Game.rooms, Game.portals etc. for a game on a WorldStore (rooms keyed by coords)
+
+    def __init__(self, store, things, kind):
+        self.store = store
+        self.things = things
+        self.kind = kind
+
+    def __getitem__(self, key):
+        content_key = Room.to_thing_id(key) if self.kind == 'rooms' else key
+        thing_id = self.store.thing_id_by_key(self.kind, content_key)
+        if thing_id is None:
+            raise KeyError(key)
+        return self.things[thing_id]
+
+    def __iter__(self):
+        for thing_id in self.store.thing_ids(self.kind):
+            yield Room.to_coords(thing_id) if self.kind == 'rooms' else thing_id
+
+    def __len__(self):
+        return self.store.db.execute("SELECT COUNT(*) FROM things WHERE kind = ?", (self.kind,)).fetchone()[0]
+
+    def values(self):
+        return [self.things[thing_id] for thing_id in self.store.thing_ids(self.kind)]
+
+
+class Game:
+
+    def __init__(self, content_source='', player_name=None, output=None, initial_room=None,
+                 description_store=None, parallel_load='auto'):
+        """ Creates a game and makes it the current game (session.game)
+
+        :param content_source: directory of the json content files, or a dict of already loaded
+            content keyed by name (see content_names), e.g. {'rooms': {...}, 'portals': {...}, ...},
+            or a WorldStore
+        :param player_name: e.g. 'Alice' (None: ask for a name at setup)
+        :param output: file-like sink for game text, e.g. io.StringIO() (None: stdout)
+        :param initial_room: room coords tuple, e.g. (1,7); if given, setup is run straight away
+        :param description_store: file to keep description text in, memory-mapped and decoded only
+            as used (see DescriptionStore), e.g. 'descriptions.blob'; for content from files only
+        :param parallel_load: how content files are read and parsed (see load_content): 'threads',
+            'processes' (parsing in parallel), None (one after another), 'stream' (entry by entry,
+            for content too big to hold as text and dicts), or 'auto' (by content size)
+        """
+        started = time.perf_counter()
         self.start_time = time.time()
+        self.content_source = content_source
+        self.player_name = player_name
+        self.relation_trace = None  # RelationTrace when tracing is on (see trace_relations)
+        self.timings = {}  # key: stage, e.g. 'construct', 'setup'; value: seconds
         # set up dicts for later population of rooms, portals, fixtures, furniture, and items
         self.things = {}  # key: thing_id
+        self.names = NameIndex()  # short names of all things
         self.rooms = {}  # key: room coords tuple
         self.portals = {}  # key: thing_id
         self.fixtures = {}  # key: thing_id
         self.furniture = {}  # key: thing_id
         self.items = {}  # key: thing_id
+        self.content_mtimes = {}  # key: content name; value: file modification time when loaded
+        self.content_fingerprints = {}  # key: content name; value: what was loaded (see fingerprint_content)
+        self.description_store_path = description_store
+        self.parallel_load = parallel_load
+        self.descriptions = None  # DescriptionStore, if used
+
+        self.portal_index = None  # key: frozenset of two room coords; value: portal thing_id (see portal_between)
+        self.containment = Containment(self)
+        self.lighting = Lighting(self)
+        self.acoustics = Acoustics(self)
+        self.history = History(self)
+        self.triggers = Triggers(self)
+        self.broadcasts = Broadcasts(self)
+        # see changed (containment first: the others may ask it about the change)
+        self.change_listeners = [self.containment.on_change, self.history.on_change, self.lighting.on_change,
+                                 self.acoustics.on_change, self.broadcasts.on_change, self.triggers.on_change]
+        self.metrics = Metrics()
+        self.journal = None  # Journal, once play is being saved (see persist)
+
+        self.store = None  # WorldStore, if the content source is one
+        if isinstance(content_source, WorldStore):
+            self.store = content_source
+            self.things = StoreThings(self.store)
+            for name in content_names[:-1]:
+                setattr(self, name, StoreKind(self.store, self.things, name))
+
+        session.game = self
+        session.output = output
+        self.add_metrics()
+
+        if initial_room is not None:
+            self.setup(initial_room)
+        self.timings['construct'] = time.perf_counter() - started
+
+    def add_metrics(self):
+        # gauges of world size and cache use, sampled on the game's thread (see Metrics)
+        metrics = self.metrics
+        metrics.gauge('commands_per_second', "Commands run per second, over the last minute",
+                      metrics.commands_per_second, live=True)
+        metrics.gauge('things', "Things in the world", lambda: len(self.things))
+        metrics.gauge('rooms', "Rooms in the world", lambda: len(self.rooms))
+        metrics.gauge('portals', "Portals in the world", lambda: len(self.portals))
+        if self.store is None:
+            metrics.gauge('relations', "Relations between things (each way counted)", lambda: sum(
+                len(things) for thing in list(self.things.values()) for things in thing.relations))
+        else:  # (as last written to the store, rather than loading every thing)
+            metrics.gauge('relations', "Relations between things (each way counted)",
+                          lambda: self.store.db.execute("SELECT COUNT(*) FROM relations").fetchone()[0])
+        metrics.gauge('name_lookups', "Exact short name lookups", lambda: {
+            (('result', 'hit'),): self.names.hits,
+            (('result', 'miss'),): self.names.misses,
+            (('result', 'fuzzy'),): self.names.fuzzy_lookups})
+        metrics.gauge('lighting_updates', "Incremental lighting updates", lambda: self.lighting.updates)
+        metrics.gauge('sound_searches', "Room graph searches for sounds", lambda: self.acoustics.searches)
+        metrics.gauge('containment_lookups', "Cached holder chain lookups", lambda: {
+            (('result', 'hit'),): self.containment.hits,
+            (('result', 'miss'),): self.containment.misses})
+        metrics.gauge('trigger_checks', "Trigger rules looked at because of a change", lambda: self.triggers.checks)
+        metrics.gauge('trigger_firings', "Trigger rules fired", lambda: self.triggers.firings)
+        metrics.gauge('connections', "Players connected (see Broadcasts)", lambda: len(self.broadcasts.connections))
+        metrics.gauge('broadcast_messages', "Messages broadcast to players in a room", lambda: {
+            (('result', 'queued'),): self.broadcasts.deliveries,
+            (('result', 'dropped'),): sum(connection.dropped for connection in self.broadcasts.connections.values())})
+        metrics.gauge('undo_history', "Commands that can be undone", lambda: len(self.history.undo_stack))
+        if self.store is not None:
+            metrics.gauge('store_loads', "Things got from the world store", lambda: {
+                (('result', 'hit'),): self.store.hits,
+                (('result', 'miss'),): self.store.misses})
+            metrics.gauge('store_evictions', "Things evicted from memory", lambda: self.store.evictions)
+            metrics.gauge('store_resident_bytes', "Rough size of things in memory", lambda: self.store.resident_bytes)
+
+    def load_content(self):
+        """ Yields (name, entries) for each of content_names, in order, where entries are the content's
+        (key, value) pairs, e.g. ('rm_0107', {...room dict...}). Content files are read and parsed
+        concurrently (see parallel_load), so later files parse while earlier ones are being made
+        into objects, or streamed ('stream': each entry is parsed as it's taken, so no file's text
+        or whole dict is ever held, for content too big for that).
+        Per-file timings (seconds) go in self.timings['load'], key: name; value: dict with
+        'read', 'parse' (in the worker, or while streaming), 'wait' (for the worker) and
+        'construct' (set by the caller).
+        """
+        timings = self.timings['load'] = {}
+        parallel_load = self.parallel_load
+        if parallel_load == 'auto' and isinstance(self.content_source, str):
+            # workers only pay for themselves with bigger content; the biggest would need too much memory
+            size = sum(os.path.getsize(os.path.join(self.content_source, name + '.json')) for name in content_names)
+            parallel_load = (None if size < 1000000 else 'threads' if size < 50000000
+                             else 'processes' if size < 500000000 else 'stream')
+        if not isinstance(self.content_source, str) or parallel_load is None:
+            for name in content_names:
+                started = time.perf_counter()
+                json_dict = self.content(name)
+                timings[name] = {'read': 0.0, 'parse': time.perf_counter() - started, 'wait': 0.0}
+                yield name, json_dict.items()
+            return
+        if parallel_load == 'stream':
+            for name in content_names:
+                timings[name] = {'read': 0.0, 'parse': 0.0, 'wait': 0.0}
+                yield name, iter_content_file(os.path.join(self.content_source, name + '.json'), timings[name])
+            return
+
+        import concurrent.futures  # only needed for parallel loading
+        if parallel_load == 'processes':  # parse in parallel (for big content)
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(len(content_names), os.cpu_count() or 1))
+        else:  # 'threads': overlap file reading with making objects
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(content_names))
+        with executor:
+            futures = {name: executor.submit(parse_content_file, os.path.join(self.content_source, name + '.json'))
+                       for name in content_names}
+            for name in content_names:
+                started = time.perf_counter()
+                json_dict, read_seconds, parse_seconds = futures.pop(name).result()
+                timings[name] = {'read': read_seconds, 'parse': parse_seconds, 'wait': time.perf_counter() - started}
+                yield name, json_dict.items()
+
+    def load_report(self):
+        """ Gets per-file load timings (see load_content) as lines of text """
+        lines = []
+        for name, timing in self.timings.get('load', {}).items():
+            lines.append("{}: read {:.1f}ms, parse {:.1f}ms, waited {:.1f}ms, construct {:.1f}ms".format(
+                name, *[timing.get(stage, 0.0) * 1000 for stage in ('read', 'parse', 'wait', 'construct')]))
+        return lines
+
+    def content(self, name):
+        """ Gets a content dict, e.g. 'rooms', from the content source
+
+        :param name: one of content_names or optional_content_names
+        :return: dict keyed by thing_id (or rule_id, for triggers; empty if optional content isn't there)
+        """
+        if isinstance(self.content_source, dict):
+            return self.content_source.get(name, {})
+        if name in optional_content_names and not os.path.exists(os.path.join(self.content_source, name + '.json')):
+            return {}
+        return get_json_dict(name, self.content_source)
 
     def get_room(self, room_coords):
         """Gets room object based on room key (coords tuple)
@@ -988,73 +3563,451 @@ class Game:
             return ret
 
     def setup(self, initial_room):
+        started = time.perf_counter()
+        if self.store is not None:
+            # things load from the store as they are used (trigger rules aren't kept in it)
+            self.store.attach(self)
+            self.setup_player(initial_room)
+            self.timings['setup'] = time.perf_counter() - started
+            return
+        self.content_mtimes = {name: self.content_mtime(name) for name in content_names}
+        if self.description_store_path is not None and isinstance(self.content_source, str):
+            self.descriptions = DescriptionStore.open_compiled(self.description_store_path, self.content_source)
+
+        # create objects from json files (parsed concurrently, or streamed; each file's objects are
+        # created as soon as it and the files before it are parsed, or entry by entry)...
+        fingerprinted = isinstance(self.content_source, str)  # (see fingerprint_content)
+        for name, entries in self.load_content():
+            construct_started = time.perf_counter()
+            timing = self.timings['load'][name]
+            parse_seconds = timing['parse']  # (grows as entries are taken, if streamed)
+            fingerprints = set() if name == 'relations' else {}
+            if name != 'relations':
+                # ...set up rooms, portals, fixtures, furniture, and items (rooms first: portals need them)
+                for thing_id, thing_dict in entries:  # (thing_id, {...thing dict...})
+                    self.new_thing(name, thing_id, thing_dict)
+                    if fingerprinted:
+                        fingerprints[thing_id] = self.fingerprints(thing_dict)
+            else:
+                # ...set up relations now objects have been created
+                for thing_id_x, relations in entries:  # (thing_id_x, {relation: [thing_id_y, ...]})
+                    edges = self.relation_edges({thing_id_x: relations})
+                    for thing_id_x, relation, thing_id_y in edges:
+                        self.things[thing_id_x].relations[relation].add(self.things[thing_id_y])
+                        # e.g. (thing_x).relations[IN] = {thing_y, ... }
+                        # Add inverse relation? (e.g. for bed-in-room, inverse: room-has-bed)
+                        inverse_relation = session.inverse_relations[relation]
+                        self.things[thing_id_y].relations[inverse_relation].add(self.things[thing_id_x])
+                    if fingerprinted:
+                        fingerprints.update(edges)
+            if fingerprinted:
+                self.content_fingerprints[name] = fingerprints
+            timing['construct'] = time.perf_counter() - construct_started - (timing['parse'] - parse_seconds)
+
+        self.setup_player(initial_room)
+        self.triggers.load(self.content('triggers'))  # (rules may be about the player)
+        self.timings['setup'] = time.perf_counter() - started
+
+    def setup_player(self, initial_room):
+        # initialise player and starting location
+        session.player = Player(self.player_name)
+        session.player.room = self.get_room(initial_room)
+
+    # content file name: class of the things it holds
+    content_classes = {
+        'rooms': Room,
+        'portals': Portal,
+        'fixtures': Fixture,
+        'furniture': Furniture,
+        'items': Item
+    }
+
+    def new_thing(self, name, thing_id, thing_dict):
+        """ Creates a thing from its content dict and files it with others of its kind
 
-        # create objects from json files...
-        # ...set up rooms
-        json_dict = get_json_dict('rooms')
-        for room_tuple in json_dict.items():  # room as tuple: (thing_id, {...room dict...})
-            new_room = Room(**room_tuple[1])
-            self.rooms[new_room.coords] = new_room  # room keys are coords tuples, e.g. (1,2) for rm_0102
-
-        # ...set up portals
-        json_dict = get_json_dict('portals')
-        for portal_tuple in json_dict.items():  # portal as tuple: (thing_id, {... portal dict...})
-            # create new portal with portal dict
-            new_portal = Portal(**portal_tuple[1])
-            portal_thing_id = portal_tuple[0]
-            self.portals[portal_thing_id] = new_portal  # key is thing_id
+        :param name: content name, e.g. 'portals'
+        :param thing_id: key of the thing in the content, e.g. 'po_0001'
+        :param thing_dict: e.g. {'thing_id': 'po_0001', 'name': 'a yellow door', ...}
+        :return: the new thing
+        """
+        if self.descriptions is not None:
+            # description text stays in the description store until it's used
+            descriptions = self.descriptions.descriptions(thing_dict.get('thing_id', thing_id))
+            if descriptions is not None:
+                thing_dict = dict(thing_dict, descriptions=descriptions)
+        new_thing = self.content_classes[name](**thing_dict)
+        if name == 'rooms':
+            self.rooms[new_thing.coords] = new_thing  # room keys are coords tuples, e.g. (1,2) for rm_0102
+        else:
+            getattr(self, name)[thing_id] = new_thing  # key is thing_id
+        if name == 'portals':
             # associate room objects with portal
-            new_portal.room1 = self.get_room(new_portal.room1_coords)
-            new_portal.room2 = self.get_room(new_portal.room2_coords)
-
-        # ...set up fixture
-        json_dict = get_json_dict('fixtures')
-        for fx_tuple in json_dict.items():  # tuple: (thing_id, {...fixture dict...})
-            new_fx = Fixture(**fx_tuple[1])
-            self.fixtures[fx_tuple[0]] = new_fx  # key is thing_id
-
-        # ...set up furniture
-        json_dict = get_json_dict('furniture')
-        for fr_tuple in json_dict.items():  # tuple: (thing_id, {...furniture dict...})
-            new_fr = Furniture(**fr_tuple[1])
-            self.furniture[fr_tuple[0]] = new_fr  # key is thing_id
-
-        # ...set up items
-        json_dict = get_json_dict('items')
-        for it_tuple in json_dict.items():  # tuple: (thing_id, {...item dict...})
-            new_it = Item(**it_tuple[1])
-            self.items[it_tuple[0]] = new_it  # key is thing_id
-
-        # ...set up relations now objects have been created
-        json_dict = get_json_dict('relations')
-        for relation_tuple in json_dict.items():
-            thing_id_x = relation_tuple[0]
-            # tuple form: ('fr_0099', {'in': ['rm_1010', ...]}, ...)
-            # ..............|............|...........|
-            # ..............thing_id_x...relation....thing_id_y
-            for relation in relation_tuple[1].keys():
-                for thing_id_y in relation_tuple[1][relation]:
-                    self.things[thing_id_x].relations[relation].add(self.things[thing_id_y])
-                    # e.g. (thing_x).relations['in'] = {thing_y, ... }
-                    # Add inverse relation? (e.g. for bed-in-room, inverse: room-has-bed)
-                    inverse_relation = session.inverse_relations[relation]
-                    self.things[thing_id_y].relations[inverse_relation].add(self.things[thing_id_x])
+            new_thing.room1 = self.get_room(new_thing.room1_coords)
+            new_thing.room2 = self.get_room(new_thing.room2_coords)
+            self.portal_index = None
+        return new_thing
 
-        # initialise player and starting location
-        session.player = Player()
-        session.player.room = self.get_room(initial_room)
+    def portal_between(self, room1_coords, room2_coords):
+        """ Gets the portal between two rooms
+
+        :param room1_coords: coords tuple of one room, e.g. (1,7)
+        :param room2_coords: coords tuple of the other, e.g. (2,7)
+        :return: portal, or None if there's no portal between them
+        """
+        if self.portal_index is None:  # (re)build: first portal found for each pair of rooms
+            self.portal_index = {}
+            if self.store is not None:  # (from the store's records, without loading the portals)
+                portal_rooms = self.store.portal_rooms()
+            else:
+                portal_rooms = ((portal.thing_id, portal.room1_coords, portal.room2_coords)
+                                for portal in self.portals.values())
+            for thing_id, room1, room2 in portal_rooms:
+                self.portal_index.setdefault(frozenset((room1, room2)), thing_id)
+        thing_id = self.portal_index.get(frozenset((room1_coords, room2_coords)), None)
+        return None if thing_id is None else self.things[thing_id]
+
+    def forget(self, thing):
+        """ Drops what's cached about a thing (e.g. as a WorldStore lets go of it) """
+        self.containment.forget(thing)
+        if isinstance(thing, Room):
+            self.acoustics.forget(thing)
+
+    def remove_thing(self, thing):
+        """ Removes a thing from the game, along with all relations to and from it """
+        self.containment.invalidate(thing)  # (before its relations go: things inside it are found by them)
+        for things in thing.relations:
+            for related_thing in things:
+                for related_things in related_thing.relations:
+                    related_things.discard(thing)
+        for things in session.player.relations:  # player relations have no inverse
+            things.discard(thing)
+
+        del self.things[thing.thing_id]
+        self.names.remove(thing.thing_id, thing.short_names)
+        self.portal_index = None
+        if isinstance(thing, Room):
+            del self.rooms[thing.coords]
+        else:
+            for kind in (self.portals, self.fixtures, self.furniture, self.items):
+                if kind.get(thing.thing_id, None) is thing:
+                    del kind[thing.thing_id]
+
+    @staticmethod
+    def relation_edges(json_dict):
+        """ Lists relations in relations content
+
+        :param json_dict: e.g. {'fr_0099': {'in': ['rm_1010', ...]}, ...}
+        :return: list of tuples (thing_id_x, relation id, thing_id_y), e.g. ('fr_0099', IN, 'rm_1010')
+        """
+        relation_ids = session.relation_ids
+        return [(thing_id_x, relation_ids[relation], thing_id_y)
+                for thing_id_x, relations in json_dict.items()
+                for relation, thing_ids_y in relations.items()
+                for thing_id_y in thing_ids_y]
+
+    # ********** HOT RELOAD **********
+    # Content files are polled for changes (see poll_content). Only changed files are parsed, and
+    # only the fields (or state/quality keys) that changed in the file are applied to the things,
+    # so states changed by play and relations made by play are left alone.
+
+    def content_mtime(self, name):
+        # modification time of a content file (None if content isn't from files)
+        if not isinstance(self.content_source, str):
+            return None
+        try:
+            return os.stat(os.path.join(self.content_source, name + '.json')).st_mtime_ns
+        except OSError:
+            return None
+
+    @staticmethod
+    def fingerprints(thing_dict):
+        """ Fingerprints each field of a thing's content; dict fields (e.g. 'states_unique') by key
+
+        :return: dict, key: field or (field, key), e.g. 'name' or ('states_unique', 'openness')
+        """
+        ret = {}
+        for field, value in thing_dict.items():
+            if field.endswith('_unique') and isinstance(value, dict):
+                for key, key_value in value.items():
+                    ret[(field, key)] = hash(json.dumps(key_value, sort_keys=True))
+            else:
+                ret[field] = hash(json.dumps(value, sort_keys=True))
+        return ret
+
+    def fingerprint_content(self, name, json_dict):
+        # remembers what was loaded, for diffing on reload (only needed for content from files)
+        if not isinstance(self.content_source, str):
+            return
+        if name == 'relations':
+            self.content_fingerprints[name] = set(self.relation_edges(json_dict))
+        else:
+            self.content_fingerprints[name] = {thing_id: self.fingerprints(thing_dict)
+                                               for thing_id, thing_dict in json_dict.items()}
+
+    def poll_content(self):
+        """ Reloads any content files modified since they were loaded
+
+        :return: reload report (see reload), or None if no file changed
+        """
+        changed = [name for name in content_names
+                   if self.content_mtime(name) != self.content_mtimes.get(name, None)]
+        return self.reload(changed) if changed else None
+
+    def reload(self, names):
+        """ Reparses content files and applies their changes to the loaded game
+
+        :param names: content names, e.g. ['rooms', 'items']
+        :return: dict report: 'files', 'added', 'removed' and 'kept' (lists of thing_ids),
+            'changed' (dict, key: thing_id, value: list of changed fields),
+            'relations_added', 'relations_removed' (counts), 'seconds'
+        """
+        started = time.perf_counter()
+        report = {'files': [], 'added': [], 'removed': [], 'kept': [], 'changed': {},
+                  'relations_added': 0, 'relations_removed': 0}
+
+        for name in content_names:  # in load order, so that e.g. new rooms exist before new portals
+            if name not in names:
+                continue
+            self.content_mtimes[name] = self.content_mtime(name)
+            json_dict = self.content(name)
+            report['files'].append(name)
+            if name == 'relations':
+                self.reload_relations(json_dict, report)
+            else:
+                self.reload_things(name, json_dict, report)
+            self.fingerprint_content(name, json_dict)
+
+        self.history.clear()  # undoing across content changes could mix old and new content
+        self.containment.clear()  # (relations were changed directly)
+        self.acoustics.clear()  # (rooms or portals may have changed)
+        self.lighting.clear()  # (so may brightness, light sources, and portals letting light through)
+        report['seconds'] = time.perf_counter() - started
+        return report
+
+    def reload_things(self, name, json_dict, report):
+        old_fingerprints = self.content_fingerprints.get(name, {})
+
+        # removed things (but never the player's room)
+        for thing_id in old_fingerprints.keys() - json_dict.keys():
+            thing = self.things.get(thing_id, None)
+            if thing is None:
+                continue
+            if thing is session.player.room:
+                report['kept'].append(thing_id)
+                continue
+            self.remove_thing(thing)
+            report['removed'].append(thing_id)
+
+        for thing_id, thing_dict in json_dict.items():
+            thing = self.things.get(thing_dict.get('thing_id', thing_id), None)
+            if thing_id not in old_fingerprints or thing is None:
+                # added thing
+                self.new_thing(name, thing_id, thing_dict)
+                report['added'].append(thing_id)
+                continue
+
+            # changed thing: apply only the fields that changed in the file
+            new_fingerprints = self.fingerprints(thing_dict)
+            old = old_fingerprints[thing_id]
+            changed = [field for field in old.keys() | new_fingerprints.keys()
+                       if old.get(field, None) != new_fingerprints.get(field, None)]
+            for field in changed:
+                self.reload_field(thing, thing_dict, field)
+            if changed:
+                report['changed'][thing_id] = sorted(str(field) for field in changed)
+
+    def reload_field(self, thing, thing_dict, field):
+        if isinstance(field, tuple):  # e.g. ('states_unique', 'openness')
+            field, key = field
+            kind = field[:-len('_unique')]  # 'states', 'qualities' or 'verbables'
+            values = getattr(thing, kind)
+            defaults = getattr(thing, 'default_' + kind, {})
+            if key in thing_dict.get(field, {}):
+                values[key] = thing_dict[field][key]
+            elif key in defaults:
+                values[key] = defaults[key]
+            else:
+                values.pop(key, None)
+            if kind != 'states':
+                thing.capabilities = thing.compile_capabilities()
+        elif field == 'short_names':
+            self.names.remove(thing.thing_id, thing.short_names)
+            thing.short_names = thing_dict['short_names']
+            self.names.add(thing.thing_id, thing.short_names)
+        elif field in ('name', 'descriptions'):
+            setattr(thing, field, thing_dict[field])
+        elif field in ('room1_thing_id', 'room2_thing_id'):
+            attribute = field[:len('room1')]
+            coords = Room.to_coords(thing_dict[field])
+            setattr(thing, attribute + '_coords', coords)
+            setattr(thing, attribute, self.get_room(coords))
+            self.portal_index = None
+
+    def reload_relations(self, json_dict, report):
+        old_edges = self.content_fingerprints.get('relations', set())
+        new_edges = set(self.relation_edges(json_dict))
+        for edges, add in ((old_edges - new_edges, False), (new_edges - old_edges, True)):
+            for thing_id_x, relation, thing_id_y in edges:
+                thing_x = self.things.get(thing_id_x, None)
+                thing_y = self.things.get(thing_id_y, None)
+                if thing_x is None or thing_y is None:
+                    continue
+                inverse_relation = session.inverse_relations[relation]
+                if add:
+                    thing_x.relations[relation].add(thing_y)
+                    thing_y.relations[inverse_relation].add(thing_x)
+                    report['relations_added'] += 1
+                else:
+                    thing_x.relations[relation].discard(thing_y)
+                    thing_y.relations[inverse_relation].discard(thing_x)
+                    report['relations_removed'] += 1
+
+    def persist(self, path, new=False, **options):
+        """ Restores play saved at path (if any), then saves play there as it goes (see Journal)
+
+        :param path: save path without extension, e.g. 'save'
+        :param new: True to start a new game, deleting play saved at path
+        :param options: Journal options, e.g. group_commands=20, checkpoint_commands=1000
+        :return: dict report of the restore (see Journal.restore)
+        """
+        self.journal = Journal(self, path, **options)
+        if new:
+            self.journal.discard()
+        self.change_listeners.append(self.journal.on_change)
+        report = self.journal.restore()
+        self.metrics.gauge('journal_commands', "Commands journaled since the last checkpoint",
+                           lambda: self.journal.seq - self.journal.checkpoint_seq)
+        self.metrics.gauge('journal_writes', "Group commits to the journal", lambda: self.journal.writes)
+        self.metrics.gauge('checkpoints', "Checkpoints written", lambda: self.journal.checkpoints)
+        return report
 
     def run(self):
 
         session.player.room.look('at')
 
-        while True:
-            print('')
-            inp = input("What's next?:").lower()
-            if inp in ('q', 'quit', 'exit', 'leave', 'stop', 'end'):
-                session.printw("Thanks for playing. Bye.")
+        try:
+            while True:
+                print('')
+                inp = input("What's next?:").lower()
+                if inp in ('q', 'quit', 'exit', 'leave', 'stop', 'end'):
+                    session.printw("Thanks for playing. Bye.")
+                    break
+                reload_report = self.poll_content()
+                if reload_report:
+                    session.printw("(DEV) Reloaded {} in {:.1f}ms: {} added, {} removed, {} changed.".format(
+                        session.english_list(reload_report['files']),
+                        reload_report['seconds'] * 1000,
+                        len(reload_report['added']),
+                        len(reload_report['removed']),
+                        len(reload_report['changed'])))
+                session.player.command_parse(inp)
+        finally:  # (also on end of input or Ctrl-C: write what's waiting to be saved)
+            if self.journal is not None:
+                self.journal.close()
+
+    def command(self, command_line):
+        """ Runs a command line for the player, e.g. 'put key on bed' or 'get key then go north'
+        (for embedding; see run and Player.command_parse)
+
+        :return: True if it succeeded, else None
+        """
+        return session.player.command_parse(command_line)
+
+    def commands(self, command_lines, stop_on_failure=False):
+        """ Runs many command lines for the player in one call, keeping each one's output apart rather
+        than writing it to session.output (for headless clients, e.g. a server batching requests)
+
+        :param command_lines: e.g. ['get torch', 'go north then open door']
+        :param stop_on_failure: if True, stop at the first command line that fails
+        :return: list of (output text, True if it succeeded, else None), one per command line run
+        """
+        results = []
+        for command_line in command_lines:
+            buffer = io.StringIO()
+            with session.redirect(buffer):
+                succeeded = session.player.command_parse(command_line)
+            results.append((buffer.getvalue(), succeeded))
+            if stop_on_failure and not succeeded:
                 break
-            session.player.command_parse(inp)
+        return results
+
+    def add_thing(self, thing):
+        new = thing.thing_id not in self.things  # (things loaded from a store are already named)
+        self.things[thing.thing_id] = thing
+        if new:
+            self.names.add(thing.thing_id, thing.short_names)
+
+    # ********** CHANGES **********
+    # Play changes the world only through relate, unrelate, set_state and move, which pass each
+    # change to the change listeners as a tuple:
+    #   ('relate', thing_x, relation, thing_y), ('unrelate', thing_x, relation, thing_y),
+    #   ('state', thing, key, old value, new value), ('room', player, old room, new room)
+    # (a missing state is given as Game.missing)
+
+    missing = object()  # placeholder for a state that isn't set
+
+    def changed(self, change):
+        for listener in self.change_listeners:
+            listener(change)
+        if self.triggers.due:  # (once every listener has the change, as rules make changes of their own)
+            self.triggers.run()
+
+    def relate(self, thing_x, relation, thing_y):
+        """ Puts X in relation R with Y (one way only: the caller relates the inverse, if any) """
+        things = thing_x.relations[relation]
+        if thing_y not in things:
+            things.add(thing_y)
+            self.changed(('relate', thing_x, relation, thing_y))
+
+    def unrelate(self, thing_x, relation, thing_y):
+        """ Takes X out of relation R with Y (one way only) """
+        things = thing_x.relations[relation]
+        if thing_y in things:
+            things.discard(thing_y)
+            self.changed(('unrelate', thing_x, relation, thing_y))
+
+    def detach(self, thing_x, relations=(BY, WITH, OVER, UNDER, ON, IN)):
+        """ Takes X out of relations with other things, both ways (e.g. from a bag, before it is dropped)
+
+        :param relations: relations of X to undo (owning relations, like bag has torch, are usually left)
+        """
+        inverse_relations = session.inverse_relations
+        for R in relations:
+            for related_thing in list(thing_x.relations[R]):
+                # first remove inverse relation from related thing
+                self.unrelate(related_thing, inverse_relations[R], thing_x)
+                # remove relation R from thing_x
+                self.unrelate(thing_x, R, related_thing)
+
+    def set_state(self, thing, key, value):
+        """ Sets a state of a thing, e.g. set_state(door, 'openness', 'open') (Game.missing: unset it) """
+        old = thing.states.get(key, self.missing)
+        if old == value:
+            return
+        if value is self.missing:
+            del thing.states[key]
+        else:
+            thing.states[key] = value
+        self.changed(('state', thing, key, old, value))
+
+    def move(self, player, room):
+        """ Moves a player (or agent) into a room """
+        old = player.room
+        if old is not room:
+            player.room = room
+            self.changed(('room', player, old, room))
+
+    def apply(self, change):
+        # makes a change given as a change tuple (e.g. to undo or replay one)
+        kind = change[0]
+        if kind == 'relate':
+            self.relate(*change[1:])
+        elif kind == 'unrelate':
+            self.unrelate(*change[1:])
+        elif kind == 'state':
+            self.set_state(change[1], change[2], change[4])
+        elif kind == 'room':
+            self.move(change[1], change[3])
 
     def thing(self, thing_id):
         try:
@@ -1064,16 +4017,67 @@ class Game:
             return None
         return thing
 
-    def thing_by_shortname(self, short_name):
-        # TODO filter by context? (so 'door' yields nearby door?")
+    def thing_by_shortname(self, short_name, player=None):
+        # a name shared by several things (e.g. 'door') yields one around the player, if any
+        # (and the player's own names, e.g. 'me', yield the player)
+        player = player or session.player
+        if player is not None and short_name in player.short_names:
+            return player
         if type(short_name) == str:
-            for thing in self.things.values():  # loop through objects in things dict TODO can do this smarter
-                for nm in thing.short_names:
-                    if nm == short_name:
-                        return thing
+            thing_id = self.names.lookup(short_name)
+            if thing_id is not None:
+                thing_ids = self.names.exact[short_name]
+                if len(thing_ids) > 1:
+                    context = self.context_thing_ids(player)
+                    thing_id = next((thing_id for thing_id in thing_ids if thing_id in context), thing_id)
+                return self.things[thing_id]
         return None
 
-    def thing_by_words(self, words):
+    def thing_by_fuzzy_name(self, short_name, player=None):
+        """ Finds the thing with a short name most like short_name, e.g. 'bakpack' -> backpack.
+        Things in the player's context (see context_thing_ids) win over equally good matches.
+
+        :param player: whose context (default: the main player)
+        :return: tuple (thing, score) or (None, 0.0)
+        """
+        candidates = self.names.fuzzy(short_name)
+        if not candidates:
+            return None, 0.0
+        context = self.context_thing_ids(player)
+        best = None
+        for score, name in candidates:
+            for thing_id in self.names.exact[name]:
+                rank = (score, thing_id in context)
+                if best is None or rank > best[0]:
+                    best = (rank, thing_id)
+        return self.things[best[1]], best[0][0]
+
+    def context_thing_ids(self, player=None):
+        """ Gets thing_ids of things around the player: the room, its portals, things in it (and
+        on or in those), and things the player has
+
+        :param player: whose surroundings (default: the main player)
+        :return: set of thing_ids
+        """
+        player = player or session.player
+        if player is None or player.room is None:
+            return set()
+        room = player.room
+        context = {room}
+        for things in room.relations:
+            context.update(things)
+        for thing in list(context):
+            for things in thing.relations:
+                context.update(things)
+        context.update(player.relations[HAS])
+        y, x = room.coords
+        for coords in ((y - 1, x), (y, x + 1), (y + 1, x), (y, x - 1)):  # (portals join neighbouring rooms)
+            portal = self.portal_between(room.coords, coords)
+            if portal is not None:
+                context.add(portal)
+        return {thing.thing_id for thing in context}
+
+    def thing_by_words(self, words, player=None):  # player: whose surroundings to prefer (default: main player)
 
         if not words:
             return [None, words]
@@ -1085,18 +4089,29 @@ class Game:
         remaining_words = []
 
         # a. try first word
-        thing = self.thing_by_shortname(words[0])
+        thing = self.thing_by_shortname(words[0], player)
         if not not thing:  # a thing was just found
             remaining_words = words[1:]
         elif len(words) > 1:
             # b. try first two words
-            thing = self.thing_by_shortname(' '.join(words[0:2]))
+            thing = self.thing_by_shortname(' '.join(words[0:2]), player)
             if not thing:  # no thing found
                 # c. try second word
-                thing = self.thing_by_shortname(words[1])
+                thing = self.thing_by_shortname(words[1], player)
             if not not thing:  # a thing has been found
                 remaining_words = words[2:]
 
+        if thing is None:
+            # d. no exact match: try the same words allowing for typos, e.g. 'yelow door'
+            best_score = 0.0
+            tries = [(words[0], words[1:])]
+            if len(words) > 1:
+                tries = [(' '.join(words[0:2]), words[2:])] + tries + [(words[1], words[2:])]
+            for name, remaining in tries:
+                fuzzy_thing, score = self.thing_by_fuzzy_name(name, player)
+                if score > best_score:
+                    thing, remaining_words, best_score = fuzzy_thing, remaining, score
+
         return [None, words] if thing is None else [thing, remaining_words]
 
     def relation_test(self, thing_x, relation_arg, thing_y):
@@ -1126,80 +4141,199 @@ class Game:
             ball on bat = False
         """
 
-        IR_un_map = {
-            'by': ['by', 'with', 'has', 'over', 'under', 'on', 'in'],
-            'over': ['under', 'with', 'in', 'on'],
-            'under': ['over', 'with', 'in', 'on']
-        }
-        IR_ss_map = {
-            'by': ['by', 'with', 'over', 'under', 'on', 'in']
-        }
+        relations = self.relation_query_check(relation_arg, [thing_x, thing_y])
+        return self.relation_query(thing_x, relation_arg, relations, thing_y)
 
-        # test for valid inputs
-        if thing_x not in self.things.values():
-            msg = "(DEV) '{}' is not a known thing.".format(str(thing_x))
-            raise Exception(msg)
-        if thing_y not in self.things.values():
-            msg = "(DEV) '{}' is not a known thing.".format(str(thing_y))
-            raise Exception(msg)
-        if relation_arg not in set().union({'near'}, session.relations_list):
+    def relation_test_many(self, thing_x, relation_arg, things_y):
+        """ Batch relation_test: is X in relation R with each of things_y?
+        Inputs are validated once, and the related-things sets built for X (and for any Y seen
+        before) are shared across all candidates.
+
+        :param things_y: iterable of things, e.g. the things in the player's room
+        :return: dict, key: thing_y, value: True/False (as relation_test would give)
+        """
+        things_y = list(things_y)
+        relations = self.relation_query_check(relation_arg, [thing_x] + things_y)
+        unions = {}
+        return {thing_y: self.relation_query(thing_x, relation_arg, relations, thing_y, unions)
+                for thing_y in things_y}
+
+    def relation_pairs(self, relation_arg, things):
+        """ Finds all ordered pairs (X, Y) of distinct things for which relation_test(X, R, Y) is True.
+        Each thing's related-things sets are built once and shared across all pairs.
+
+        :param things: iterable of things, e.g. all things in a room
+        :return: set of tuples (thing_x, thing_y)
+        """
+        things = list(things)
+        relations = self.relation_query_check(relation_arg, things)
+        unions = {}
+        pairs = set()
+        for thing_x in things:
+            for thing_y in things:
+                if thing_x is not thing_y and \
+                        self.relation_query(thing_x, relation_arg, relations, thing_y, unions):
+                    pairs.add((thing_x, thing_y))
+        return pairs
+
+    def relation_query_check(self, relation_arg, things):
+        """ Validates relation query inputs (raises on unknown things or relation)
+
+        :return: tuple of relation ids to test, e.g. (BY,), or session.near_relations for 'near'
+        """
+        for thing in things:
+            if self.things.get(getattr(thing, 'thing_id', None), None) is not thing:
+                msg = "(DEV) '{}' is not a known thing.".format(str(thing))
+                raise Exception(msg)
+        relations = session.relation_args.get(relation_arg, None)
+        if relations is None:
             msg = "Sorry, I don't know the relation '{}'.".format(str(relation_arg))
             raise Exception(msg)
-
-        if relation_arg == 'near':
-            relations = session.near_relations.copy()
-        else:
-            relations = [relation_arg]
+        return relations
+
+    def relation_query(self, thing_x, relation_arg, relations, thing_y, unions=None):
+        # answers an already validated query (tracing it, if tracing is on)
+        trace = self.relation_trace
+        if trace is None:
+            return self.relation_rule(thing_x, relations, thing_y, unions=unions)[0] is not None
+
+        # traced query: also collect set sizes and timing
+        started = time.perf_counter()
+        set_sizes = []
+        rule, fired_relation = self.relation_rule(thing_x, relations, thing_y, set_sizes, unions)
+        trace.record(thing_x, relation_arg, thing_y, rule or 'none', fired_relation, set_sizes,
+                     time.perf_counter() - started)
+        return rule is not None
+
+    # Indirect relation rules (see relation_test), indexed by relation id (None: no rule)
+    IR_un_map = (
+        None,  # of
+        (BY, WITH, HAS, OVER, UNDER, ON, IN),  # by
+        None, None,  # with, has
+        (UNDER, WITH, IN, ON),  # over
+        (OVER, WITH, IN, ON),  # under
+        None, None  # on, in
+    )
+    IR_ss_map = (
+        None,  # of
+        (BY, WITH, OVER, UNDER, ON, IN),  # by
+        None, None, None, None, None, None  # with, has, over, under, on, in
+    )
+
+    @classmethod
+    def relation_rule(cls, thing_x, relations, thing_y, set_sizes=None, unions=None):
+        """ Finds the rule by which X is in one of the relations with Y (see relation_test)
+
+        :param relations: relation ids to try in order, e.g. (BY,) or session.near_relations
+        :param set_sizes: optional list; (rule, relation, size of X's set, size of Y's set) is
+            appended for every set intersection made
+        :param unions: optional dict for sharing related_union results between queries
+        :return: tuple (rule, relation id), e.g. ('IR_un', BY), or (None, None) if no rule fired
+        """
+        x_relations = thing_x.relations
 
         for relation in relations:
 
             # A. TEST DIRECT RELATION
-            if thing_y in thing_x.relations.get(relation, []):
-                return True
+            if thing_y in x_relations[relation]:
+                return 'direct', relation
 
             # B. TEST INDIRECT RELATION
 
             # B1. TEST INDIRECT_UN RELATION (UNCLE-NEPHEW)
-            IR_un = IR_un_map.get(relation, None)
-            if not not IR_un:  # relation is in IR_un_map
+            IR_un = cls.IR_un_map[relation]
+            if IR_un is not None:  # relation has an IR_un rule
                 # find any Z for which X-R-Z and Y-IR_un-Z
 
                 # get things in R relation to X
-                s1 = thing_x.relations.get(relation, set())
+                s1 = x_relations[relation]
 
                 # get things in IR_un relation to Y
-                s2 = set().union(*[things for (R, things) in thing_y.relations.items() if R in IR_un])
+                s2 = cls.related_union(thing_y, IR_un, unions)
+
+                if set_sizes is not None:
+                    set_sizes.append(('IR_un', relation, len(s1), len(s2)))
 
                 # any things in both (Z)?
-                if s1.intersection(s2):
-                    return True
+                if not s1.isdisjoint(s2):
+                    return 'IR_un', relation
 
             # B2. TEST INDIRECT_SS RELATION (SIBLING-SIBLING)
-            IR_ss = IR_ss_map.get(relation, None)
-            if not not IR_ss:  # relation is in IR_ss_map
+            IR_ss = cls.IR_ss_map[relation]
+            if IR_ss is not None:  # relation has an IR_ss rule
                 # find any Z for which X-IR_ss-Z and Y-IR_ss-Z
 
                 # get things in IR_ss relation to X
-                s1 = set().union(*[things for (R, things) in thing_x.relations.items() if R in IR_ss])
+                s1 = cls.related_union(thing_x, IR_ss, unions)
 
                 # get things in IR_ss relation to Y
-                s2 = set().union(*[things for (R, things) in thing_y.relations.items() if R in IR_ss])
+                s2 = cls.related_union(thing_y, IR_ss, unions)
+
+                if set_sizes is not None:
+                    set_sizes.append(('IR_ss', relation, len(s1), len(s2)))
 
                 # any things in both (Z)?
-                if s1.intersection(s2):
-                    return True
+                if not s1.isdisjoint(s2):
+                    return 'IR_ss', relation
 
-        return False
+        return None, None
+
+    @staticmethod
+    def related_union(thing, relations, unions=None):
+        """ Gets all things in any of the relations with thing, e.g. everything it is by, on or in
+
+        :param relations: tuple of relation ids, e.g. Game.IR_ss_map[BY]
+        :param unions: optional dict to memoise results in (only while relations can't change)
+        :return: set of things
+        """
+        thing_relations = thing.relations
+        if unions is not None:
+            ret = unions.get((thing, relations), None)
+            if ret is None:
+                ret = set().union(*[thing_relations[R] for R in relations])
+                unions[(thing, relations)] = ret
+            return ret
+        return set().union(*[thing_relations[R] for R in relations])
+
+    def trace_relations(self, on=True):
+        """ Turns relation_test tracing on (fresh counters) or off
+
+        :return: the RelationTrace that was collecting (None if tracing was off)
+        """
+        previous = self.relation_trace
+        self.relation_trace = RelationTrace() if on else None
+        return previous
 
     @staticmethod
     def time_passed(self):
         return time.time() - self.start_time
 
 
+import_seconds = time.perf_counter() - _import_started
+
+
+def main(argv=None):
+    import argparse  # only needed when run as a script
+    parser = argparse.ArgumentParser(description="Plays the game, carrying on from where the player left off.")
+    parser.add_argument('--save', default=None,
+                        help="save path without extension (default: 'save_<player name>' beside the content)")
+    parser.add_argument('--new', action='store_true', help="start a new game, deleting the save")
+    args = parser.parse_args(argv)
+
+    content_dir = os.path.dirname(os.path.abspath(__file__))
+    game = Game(content_source=content_dir, description_store=os.path.join(content_dir, 'descriptions.blob'))
+    game.setup((1,7))  # initial room is rm_0107
+    save_path = args.save or os.path.join(content_dir, 'save_' + session.player.name.lower())  # (one per player)
+    restored = game.persist(save_path, new=args.new)
+    if restored['checkpoint'] or restored['replayed']:
+        session.printw("(DEV) Restored {} commands in {:.1f}ms.".format(
+            restored['checkpoint'] + restored['replayed'], restored['seconds'] * 1000))
+    game.run()
+
+
 # ********************************* MAIN SCRIPT ********************************
 
-session.game = Game()
-session.game.setup((1,7))  # initial room is rm_0307
-session.game.run()
+if __name__ == '__main__':
+    main()
 
 # ******************************************************************************
@@ -0,0 +1,376 @@
+"""
+Puzzle solvability checker: searches the world states reachable by playing the player's verbs
+for a shortest command sequence reaching a goal, or shows that no sequence does.
+
+A world state is the player's room plus what play has changed: relation edges added and removed,
+and states changed (see StateTracker). States are deduplicated by a hash of that canonical form.
+The search is breadth-first, one depth at a time; each depth's states are expanded across a
+process pool, each worker playing its own copy of the game.
+
+Usage, e.g.:
+    python solver.py --goal "player has it_0014" --goal "po_0009.openness=closed"
+Goals are direct relations ('thing relation thing'), states ('thing.key=value') or the
+player's room ('player in rm_0308'), by thing_id or short name.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import sys
+import time
+
+import main
+from main import session, Game, NullOutput, Room, Player, BY, CAN_GET, CAN_OPEN, CAN_PUT, CAN_GO
+
+
+class StateTracker:
+    """
+    Keeps the canonical state of a game up to date as it changes (a change listener, see
+    Game.changed): the player's room, relation edges added and removed since the start, and
+    states changed since the start.
+    """
+
+    def __init__(self, game):
+        self.game = game
+        self.room = session.player.room.thing_id
+        self.added = set()  # of edges (thing_id_x, relation name, thing_id_y)
+        self.removed = set()
+        self.changed = {}  # key: (thing_id, key); value: state value
+        self.initial = {}  # key: (thing_id, key); value: state value at the start (Game.missing if unset)
+        game.change_listeners.append(self.on_change)
+
+    def on_change(self, change):
+        kind = change[0]
+        if kind == 'relate' or kind == 'unrelate':
+            edge = (change[1].thing_id, session.relations_list[change[2]], change[3].thing_id)
+            undone, done = (self.removed, self.added) if kind == 'relate' else (self.added, self.removed)
+            if edge in undone:
+                undone.discard(edge)
+            else:
+                done.add(edge)
+        elif kind == 'state':
+            key = (change[1].thing_id, change[2])
+            initial = self.initial.setdefault(key, change[3])
+            if change[4] is initial or change[4] == initial:
+                self.changed.pop(key, None)
+            else:
+                self.changed[key] = change[4]
+        elif kind == 'room' and change[1] is session.player:
+            self.room = change[3].thing_id
+
+    def state(self):
+        """ Gets the canonical state: tuple (room thing_id, edges added, edges removed, states changed)
+        (states as tuples (thing_id, key, json value or None if unset))
+        """
+        return (self.room, tuple(sorted(self.added)), tuple(sorted(self.removed)),
+                tuple(sorted((thing_id, key, None if value is Game.missing else json.dumps(value, sort_keys=True))
+                             for (thing_id, key), value in self.changed.items())))
+
+    def goto(self, state):
+        # changes the game to a canonical state, through the usual change API
+        game = self.game
+        things = game.things
+        relation_ids = session.relation_ids
+        room, added, removed, changed = state
+        added, removed = set(added), set(removed)
+        game.triggers.paused = True  # (the state reached already has whatever the rules did)
+        try:
+            for edges, relate in ((self.added - added, False), (removed - self.removed, False),
+                                  (added - self.added, True), (self.removed - removed, True)):
+                for thing_id_x, relation, thing_id_y in edges:
+                    (game.relate if relate else game.unrelate)(
+                        things[thing_id_x], relation_ids[relation], things[thing_id_y])
+            changed = {(thing_id, key): Game.missing if value is None else json.loads(value)
+                       for thing_id, key, value in changed}
+            for key in set(self.changed) | set(changed):
+                game.set_state(things[key[0]], key[1], changed.get(key, self.initial.get(key, Game.missing)))
+            if room != self.room:
+                game.move(session.player, things[room])
+        finally:
+            game.triggers.paused = False
+
+
+def state_digest(state):
+    # 16 bytes standing in for a canonical state in the seen table
+    return hashlib.blake2b(pickle.dumps(state, protocol=4), digest_size=16).digest()
+
+
+def phrase_name(game, thing):
+    # a short name the parser takes to mean this thing (None if there is none)
+    for short_name in thing.short_names:
+        if short_name and game.thing_by_words(short_name.split())[0] is thing:
+            return short_name
+    return None
+
+
+def relations_prepositions(verb):
+    # a preposition the parser takes to mean each relation of the verb, e.g. {BY: 'to', ...} for go
+    relations_prepositions = {}
+    for preposition, relation in session.verbs_prepositions_relations[verb].items():
+        relations_prepositions.setdefault(relation, preposition)
+    return sorted(relations_prepositions.items())
+
+
+def candidate_commands(game):
+    """ Lists the commands worth trying from the current state: every verb with every thing the
+    parser can name, anywhere in the world (e.g. 'go to hammer' from another room), and every
+    preposition the thing allows; commands that change nothing are dropped by expand
+
+    :return: list of command phrases, e.g. ['go north', ..., 'get key', 'put key in bag']
+    """
+    player = session.player
+    put_prepositions = relations_prepositions('put')
+    go_prepositions = [(relation, preposition) for relation, preposition in relations_prepositions('go')
+                       if relation != BY]  # 'go to' is tried for every thing
+    commands = ['go ' + direction for direction in ('north', 'east', 'south', 'west')]
+    things = [game.things[thing_id] for thing_id in sorted(game.things)]
+    held = sorted(game.containment.contents(player), key=lambda thing: thing.thing_id)
+    names = {thing: phrase_name(game, thing) for thing in things}
+    targets = [thing for thing in things if names[thing] is not None and not isinstance(thing, (Room, Player))]
+    for thing in targets:
+        name = names[thing]
+        commands.append('go to ' + name)
+        commands += ['go {} {}'.format(preposition, name) for relation, preposition in go_prepositions
+                     if thing.capabilities & CAN_GO[relation]]
+        if thing not in held and thing.capabilities & CAN_GET == CAN_GET:
+            commands.append('get ' + name)
+        if thing.capabilities & CAN_OPEN:
+            commands += ['open ' + name, 'close ' + name]
+    for thing_x in held:
+        if names.get(thing_x) is None:
+            continue
+        commands.append('drop ' + names[thing_x])
+        for thing_y in targets:
+            if thing_y is not thing_x:
+                commands += ['put {} {} {}'.format(names[thing_x], preposition, names[thing_y])
+                             for relation, preposition in put_prepositions
+                             if thing_y.capabilities & CAN_PUT[relation]]
+    return commands
+
+
+# each worker process plays its own game (see start_worker)
+worker = None
+
+
+def start_worker(content_dir, start_room):
+    global worker
+    game = Game(content_source=content_dir, player_name='Solver', output=NullOutput(), initial_room=start_room)
+    worker = StateTracker(game)
+
+
+def expand(states):
+    """ Tries every candidate command from each of the states (run by workers)
+
+    :param states: list of canonical states
+    :return: list (for each state) of lists of tuples (command phrase, next canonical state, None),
+        or (command phrase, None, error message) for commands that raised
+    """
+    game = worker.game
+    history = game.history
+    ret = []
+    for state in states:
+        worker.goto(state)
+        next_states = []
+        for command in candidate_commands(game):
+            undoable = len(history.undo_stack)
+            try:
+                game.command(command)
+            except Exception as e:  # an engine bug: note it, and carry on without this command
+                history.end()  # (keeps whatever the command changed, to undo)
+                next_states.append((command, None, '{}: {}'.format(type(e).__name__, e)))
+            else:
+                if len(history.undo_stack) > undoable:  # the command changed something: note it
+                    next_states.append((command, worker.state(), None))
+            if len(history.undo_stack) > undoable:
+                history.undo()
+        history.clear()
+        ret.append(next_states)
+    return ret
+
+
+class Goal:
+    """
+    Conditions on a canonical state, all of which must hold, e.g. 'player has it_0014',
+    'po_0009.openness=open' or 'player in rm_0308'.
+    """
+
+    def __init__(self, game, conditions):
+        """
+        :param game: game at the start state (how things stand before play, for the parts of the
+            goal play hasn't changed)
+        :param conditions: list of strings
+        """
+        self.game = game
+        self.edges = []  # of tuples ((thing_id_x, relation name, thing_id_y), whether it holds at the start)
+        self.states = []  # of tuples (thing_id, key, value wanted, value at the start)
+        self.room = None
+        for condition in conditions:
+            if '=' in condition:
+                thing_key, value = condition.split('=', 1)
+                if '.' not in thing_key:
+                    raise Exception("Sorry, I don't understand the goal '{}'.".format(condition))
+                thing_name, key = thing_key.strip().rsplit('.', 1)
+                try:
+                    value = json.loads(value)
+                except ValueError:  # e.g. open (rather than "open")
+                    value = value.strip()
+                thing = game.things[self.thing_id(thing_name)]
+                self.states.append((thing.thing_id, key.strip(), value, thing.states.get(key.strip(), Game.missing)))
+                continue
+            words = condition.split()
+            if len(words) != 3 or words[1] not in session.relation_ids:
+                raise Exception("Sorry, I don't understand the goal '{}'.".format(condition))
+            thing_x, thing_y = game.things[self.thing_id(words[0])], game.things[self.thing_id(words[2])]
+            if thing_x is session.player and words[1] == 'in':
+                self.room = thing_y.thing_id
+            else:
+                edge = (thing_x.thing_id, words[1], thing_y.thing_id)
+                self.edges.append((edge, thing_y in thing_x.relations[session.relation_ids[words[1]]]))
+
+    def thing_id(self, name):
+        if name in self.game.things:
+            return name
+        thing = self.game.thing_by_words(name.split())[0]
+        if thing is None:
+            raise Exception("Sorry, I don't know the thing '{}'.".format(name))
+        return thing.thing_id
+
+    def reached(self, state):
+        room, added, removed, changed = state
+        if self.room is not None and room != self.room:
+            return False
+        for edge, at_start in self.edges:
+            if not (edge in added or (at_start and edge not in removed)):
+                return False
+        if self.states:
+            changed = {(thing_id, key): value for thing_id, key, value in changed}
+            for thing_id, key, value, at_start in self.states:
+                current = changed.get((thing_id, key), at_start)
+                if current is not at_start:
+                    current = Game.missing if current is None else json.loads(current)
+                if current != value:
+                    return False
+        return True
+
+
+# rough memory use, for the memory budget
+seen_entry_bytes = 200  # a digest in the seen table, with its parent and command
+state_bytes_per_pickled_byte = 3  # a canonical state in memory, per byte pickled
+
+
+def solve(content_dir, start_room, goal_conditions, workers=None, memory_budget=500000000, max_depth=None,
+          progress=None):
+    """ Searches breadth-first for the shortest command sequence that reaches a goal
+
+    :param content_dir: directory of the json content files
+    :param start_room: coords of the player's first room, e.g. (1,7)
+    :param goal_conditions: list of goal strings (see Goal)
+    :param workers: processes to expand states in (1: none, just this one; None: one per cpu)
+    :param memory_budget: rough bytes the search may use (seen table and frontier) before giving up
+    :param max_depth: most commands to try in a row (None: no limit)
+    :param progress: optional function called with a line of text after each depth
+    :return: dict with 'result' ('solved', 'unreachable' or 'gave up'), 'commands' (shortest
+        solution if solved, else None), 'states' (distinct states seen), 'depth', 'seconds' and
+        'errors' (list of tuples (commands, error message) for commands that raised, first few only)
+    """
+    started = time.perf_counter()
+    start_worker(content_dir, start_room)  # this process's game: the start state, and expanding without a pool
+    goal = Goal(worker.game, goal_conditions)
+    workers = workers or os.cpu_count() or 1
+
+    def report(result, depth, commands=None):
+        return {'result': result, 'commands': commands, 'states': len(seen), 'depth': depth,
+                'seconds': time.perf_counter() - started, 'errors': errors}
+
+    def solution(digest):
+        commands = []
+        while seen[digest] is not None:
+            digest, command = seen[digest]
+            commands.append(command)
+        return commands[::-1]
+
+    errors = []
+    max_errors = 10
+    start = worker.state()
+    seen = {state_digest(start): None}  # key: state digest; value: (parent state digest, command) or None for the start
+    if goal.reached(start):
+        return report('solved', 0, [])
+    frontier = [(state_digest(start), start)]
+    frontier_bytes = 0
+    depth = 0
+
+    executor = None
+    if workers > 1:
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=start_worker, initargs=(content_dir, start_room))
+    try:
+        while frontier:
+            if max_depth is not None and depth >= max_depth:
+                return report('gave up', depth)
+            depth += 1
+            chunk_size = max(1, len(frontier) // (workers * 4))
+            chunks = [frontier[i:i + chunk_size] for i in range(0, len(frontier), chunk_size)]
+            results = (executor.map(expand, [[state for _, state in chunk] for chunk in chunks]) if executor
+                       else map(expand, [[state for _, state in chunk] for chunk in chunks]))
+            next_frontier = []
+            frontier_bytes = 0
+            for chunk, chunk_results in zip(chunks, results):
+                for (parent, _), next_states in zip(chunk, chunk_results):
+                    for command, state, error in next_states:
+                        if error is not None:
+                            if len(errors) < max_errors:
+                                errors.append((solution(parent) + [command], error))
+                            continue
+                        pickled = pickle.dumps(state, protocol=4)
+                        digest = hashlib.blake2b(pickled, digest_size=16).digest()
+                        if digest in seen:
+                            continue
+                        seen[digest] = (parent, command)
+                        if goal.reached(state):
+                            return report('solved', depth, solution(digest))
+                        next_frontier.append((digest, state))
+                        frontier_bytes += len(pickled) * state_bytes_per_pickled_byte
+                if len(seen) * seen_entry_bytes + frontier_bytes > memory_budget:
+                    return report('gave up', depth)
+            frontier = next_frontier
+            if progress is not None:
+                progress("depth {}: {} new states, {} seen".format(depth, len(frontier), len(seen)))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return report('unreachable', depth)
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Checks that a goal can be reached by playing, "
+                                                 "and finds the shortest way to it.")
+    parser.add_argument('--goal', action='append', required=True,
+                        help="e.g. 'player has it_0014', 'po_0009.openness=open', 'player in rm_0308' (repeatable)")
+    parser.add_argument('--content', default=os.path.dirname(os.path.abspath(main.__file__)),
+                        help="directory of the json content files")
+    parser.add_argument('--start', default='1,7', help="coords of the player's first room, e.g. 1,7")
+    parser.add_argument('--workers', type=int, default=None, help="processes to use (default: one per cpu)")
+    parser.add_argument('--memory-mb', type=float, default=500, help="rough memory budget for the search")
+    parser.add_argument('--max-depth', type=int, default=None, help="most commands in a solution")
+    args = parser.parse_args(argv)
+
+    start_room = tuple(int(coord) for coord in args.start.split(','))
+    result = solve(args.content, start_room, args.goal, workers=args.workers,
+                   memory_budget=int(args.memory_mb * 1000000), max_depth=args.max_depth, progress=print)
+    if result['result'] == 'solved':
+        print("Solved in {} commands: {}".format(len(result['commands']), '; '.join(result['commands'])))
+    elif result['result'] == 'unreachable':
+        print("Unreachable: no sequence of the commands tried reaches the goal.")
+    else:
+        print("Gave up at depth {} (memory budget or depth limit reached).".format(result['depth']))
+    print("{} states seen in {:.2f}s.".format(result['states'], result['seconds']))
+    for commands, error in result['errors']:
+        print("(DEV) '{}' raised {}".format('; '.join(commands), error))
+    return {'solved': 0, 'unreachable': 1}.get(result['result'], 2)
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())